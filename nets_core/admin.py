@@ -78,4 +78,12 @@ class EmailTemplateAdmin(admin.ModelAdmin):
     def save_model(self, request, obj, form, change):
         if not obj.user:
             obj.user = request.user
-        obj.save()
\ No newline at end of file
+        obj.save()
+
+@admin.register(models.FieldChange)
+class FieldChangeAdmin(admin.ModelAdmin):
+    model = models.FieldChange
+
+    list_display = ('content_type', 'object_id', 'field', 'old', 'new', 'created')
+    list_filter = ('content_type', 'created')
+    search_fields = ('object_id', 'field')
@@ -1,4 +1,5 @@
 from django.apps import AppConfig
+from django.conf import settings
 from django.db.models.signals import post_migrate
 import logging
 logger = logging.getLogger(__name__)
@@ -16,4 +17,9 @@ class UsersConfig(AppConfig):
     
     def ready(self):
         import nets_core.listeners
-        post_migrate.connect(post_migrate_handler, sender=self)
\ No newline at end of file
+        nets_core.listeners.connect_json_cache_handlers()
+        post_migrate.connect(post_migrate_handler, sender=self)
+        if getattr(settings, "NETS_CORE_WARM_JSON_SPECS", True):
+            # resolve JSON_DATA_FIELDS of models once, to_json only executes the query
+            from nets_core.serializers import warm_json_specs
+            warm_json_specs()
\ No newline at end of file
@@ -0,0 +1,151 @@
+"""
+Writer of FieldChange rows.
+
+Changes found by NetsCoreBaseModel.save are buffered per connection and
+transaction and written with one bulk_create when it commits (nothing is
+written for saves rolled back, savepoints included), or sent to the
+write_field_changes celery task.
+
+NETS_CORE_FIELD_CHANGES_WRITER:
+    sync: bulk_create on every save
+    on_commit: bulk_create once per transaction (default)
+    celery: nets_core.tasks.write_field_changes once per transaction,
+    written synchronously if the task can not be queued
+"""
+import logging
+import threading
+import weakref
+
+from django.conf import settings
+from django.db import connections, transaction
+
+logger = logging.getLogger(__name__)
+
+FIELD_CHANGES_WRITER = getattr(settings, "NETS_CORE_FIELD_CHANGES_WRITER", "on_commit")
+# rows buffered per savepoint of a transaction, beyond this they are written at once
+FIELD_CHANGES_BUFFER_SIZE = getattr(settings, "NETS_CORE_FIELD_CHANGES_BUFFER_SIZE", 5000)
+
+# weak references to the buffer of each connection, the on_commit hook holds it
+_local = threading.local()
+
+
+def _bulk_create(rows: list, using: str):
+    from nets_core.models import FieldChange
+
+    FieldChange.objects.using(using).bulk_create(rows, batch_size=1000)
+
+
+def serialize_field_changes(rows: list) -> list:
+    # FieldChange rows as json values for celery
+    return [
+        {
+            "content_type_id": row.content_type_id,
+            "object_id": row.object_id,
+            "field": row.field,
+            "old": row.old,
+            "new": row.new,
+            "created": row.created.isoformat(),
+        }
+        for row in rows
+    ]
+
+
+def write_field_changes(rows: list, using: str = "default"):
+    """
+    Write rows now, with the celery task if NETS_CORE_FIELD_CHANGES_WRITER is celery
+    """
+    if not rows:
+        return
+    if FIELD_CHANGES_WRITER == "celery":
+        try:
+            from nets_core.tasks import write_field_changes as write_field_changes_task
+
+            write_field_changes_task.delay(serialize_field_changes(rows), using)
+            return
+        except Exception as e:
+            # broker not available, changes are not lost
+            logger.warning(f"Field changes written synchronously, task not queued: {e}")
+    _bulk_create(rows, using)
+
+
+class SavepointMarker():
+    """
+    on_commit callback of the rows added inside a savepoint, django drops it
+    if the savepoint rolls back
+    """
+
+    __slots__ = ("__weakref__",)
+
+    def __call__(self):
+        pass
+
+
+class FieldChangeBuffer():
+    """
+    Rows of a transaction, written by this on_commit hook.
+
+    Rows are kept by the savepoint ids they were added in, with a weak
+    reference to an on_commit callback registered there: django discards the
+    callbacks of rolled back savepoints and transactions, a dead reference
+    means the rows were rolled back. Rows of the savepoint the buffer was
+    created in use the buffer itself.
+    """
+
+    __slots__ = ("using", "savepoints", "__weakref__")
+
+    def __init__(self, using: str, savepoint_ids: tuple):
+        self.using = using
+        # savepoint ids: (reference of the on_commit callback, rows)
+        self.savepoints = {savepoint_ids: (weakref.ref(self), [])}
+
+    def add(self, rows: list, savepoint_ids: tuple):
+        pending = self.savepoints.get(savepoint_ids)
+        if pending is None or pending[0]() is None:
+            marker = SavepointMarker()
+            transaction.on_commit(marker, using=self.using)
+            pending = (weakref.ref(marker), [])
+            self.savepoints[savepoint_ids] = pending
+
+        buffered = pending[1]
+        buffered.extend(rows)
+        if len(buffered) >= FIELD_CHANGES_BUFFER_SIZE:
+            # bounded buffer, written in the savepoint so it rolls back with it
+            _bulk_create(buffered, self.using)
+            buffered.clear()
+
+    def __call__(self):
+        buffers = getattr(_local, "buffers", {})
+        if buffers.get(self.using) is not None and buffers[self.using]() is self:
+            del buffers[self.using]
+        rows = []
+        for reference, buffered in self.savepoints.values():
+            if reference() is not None:
+                rows.extend(buffered)
+        self.savepoints = {}
+        write_field_changes(rows, self.using)
+
+
+def add_field_changes(rows: list, using: str = "default"):
+    """
+    Write FieldChange rows as set in NETS_CORE_FIELD_CHANGES_WRITER
+    """
+    if not rows:
+        return
+    connection = connections[using]
+    if FIELD_CHANGES_WRITER == "sync" or not connection.in_atomic_block:
+        # autocommit, the save is already committed
+        write_field_changes(rows, using)
+        return
+
+    if not hasattr(_local, "buffers"):
+        _local.buffers = {}
+    savepoint_ids = tuple(connection.savepoint_ids)
+    reference = _local.buffers.get(using)
+    buffer = reference() if reference is not None else None
+    if buffer is None:
+        # first rows of the transaction, a buffer of a rolled back one was dropped
+        buffer = FieldChangeBuffer(using, savepoint_ids)
+        _local.buffers[using] = weakref.ref(buffer)
+        transaction.on_commit(buffer, using=using)
+
+    buffer.add(rows, savepoint_ids)
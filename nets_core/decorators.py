@@ -8,9 +8,10 @@ from django.utils.translation import gettext_lazy as _
 from django.conf import settings
 
 from nets_core.handlers import get_request_obj, request_params_handler
-from nets_core.params import RequestParam
-from nets_core.responses import permission_denied
-from nets_core.utils import get_client_ip, check_perm
+from nets_core.params import RequestParam, RequestParamsSchema
+from nets_core.responses import error_response, permission_denied
+from nets_core.security import RateLimit
+from nets_core.utils import get_client_ip, get_remote_ip, check_perms, register_permissions
 
 
 
@@ -25,7 +26,11 @@ def request_handler(
     allow_anonymous=False, 
     public=False,
     project_required=False,
-    index_field: str = 'id'):
+    index_field: str = 'id',
+    allow_unknown_keys: bool = True,
+    max_body_size: int = None,
+    max_json_depth: int = None,
+    rate_limit: RateLimit | list[RateLimit] = None):
     """
         Decorator for request params handler
         check if customer is required, permissions and obj
@@ -41,26 +46,52 @@ def request_handler(
         customer_required: if True, check if customer_id is present in request
             and retrieve customer from db append to request object
         index_field: field to use as index for obj
+        allow_unknown_keys: if False, only declared params (and project_id, action,
+            page, paginated_by, index_field) are kept from JSON bodies,
+            values of unknown keys are not materialized, see handlers.parse_json_body
+        max_body_size: max request body size in bytes, default settings.NETS_CORE_MAX_BODY_SIZE
+        max_json_depth: max nesting depth of JSON bodies, default settings.NETS_CORE_MAX_JSON_DEPTH
+        rate_limit: RateLimit or list of RateLimit, requests over the limit get 429.
+            Limits by ip are checked first, limits by data keys once the body is read,
+            before params are parsed and any query
     """
 
+    permissions = can_do
+    if isinstance(permissions, str):
+        permissions = [permissions]
+    if permissions:
+        permissions = tuple(permissions)
+        # created once by post_migrate or nets-sync-permissions command
+        register_permissions(*permissions)
+
+    # compile params once, each request only executes the schema
+    schema = RequestParamsSchema(params)
+
+    rate_limits = rate_limit or ()
+    if isinstance(rate_limits, RateLimit):
+        rate_limits = (rate_limits,)
+    ip_limits = tuple(limit for limit in rate_limits if limit.by == "ip")
+    data_limits = tuple(limit for limit in rate_limits if limit.by != "ip")
+
     def decorator(view_func):
+        # counters are kept per view
+        rate_limit_scope = f"{view_func.__module__}.{view_func.__qualname__}"
+
         @csrf_exempt
         @wraps(view_func)
         def _wrapped_view(request, *args, **kwargs):
+            if ip_limits:
+                # forwarded headers set by the client are not trusted
+                ip = get_remote_ip(request)
+                for limit in ip_limits:
+                    if not limit.hit(ip, rate_limit_scope):
+                        return error_response(_("Too many requests"), 429)
+            request.rate_limits = data_limits
+            request.rate_limit_scope = rate_limit_scope
             
             if request.user.is_anonymous and not public:
                 return permission_denied()
             
-            _params = params
-
-            if isinstance(_params, list):
-                # check if params are list of RequestParam
-                # and convert to dict
-                _params_dict = {}
-                for p in _params:
-                    _params_dict[p.key] = p
-                _params = _params_dict
-            
             request.project = None
             request.project_membership = None
             
@@ -94,19 +125,25 @@ def request_handler(
             request.project_required = project_required
             request.public = public
             request.index_field = index_field
-            request = request_params_handler(request, _params)
+            request.allow_unknown_keys = allow_unknown_keys
+            if max_body_size is not None:
+                request.max_body_size = max_body_size
+            if max_json_depth is not None:
+                request.max_json_depth = max_json_depth
+            request = request_params_handler(request, schema)
             if isinstance(request, JsonResponse):
                 return request
             
             perm = public
             
-            if can_do:
-                if isinstance(can_do, str):
-                    can_do = [can_do]
-                for cdo in can_do:
-                    perm = check_perm(request.user, cdo, request.project)
-                    if not perm:
-                        break
+            if permissions:
+                # all actions are evaluated at once over the compiled permission set
+                perm = check_perms(
+                    request.user,
+                    permissions,
+                    request.project,
+                    membership=request.project_membership,
+                )
 
                 # # TODO: log permission check
                 # permissions = []
@@ -1,17 +1,88 @@
 import json
 import logging
+import re
+import warnings
 from collections import namedtuple
 
 from django.apps import apps
 from django.http.response import JsonResponse
 
-from nets_core.params import RequestParam
-from nets_core.responses import permission_denied
+from nets_core.params import RequestParam, RequestParamsSchema
+from nets_core.responses import error_response, permission_denied
 from django.utils.translation import gettext_lazy as _
 from django.conf import settings
 
 logger = logging.getLogger(__name__)
 
+# keys read by request_params_handler and get_request_obj besides declared params
+RESERVED_DATA_KEYS = frozenset(["project_id", "action", "page", "paginated_by"])
+
+MAX_BODY_SIZE = getattr(settings, "NETS_CORE_MAX_BODY_SIZE", None)
+MAX_JSON_DEPTH = getattr(settings, "NETS_CORE_MAX_JSON_DEPTH", None)
+
+_JSON_WHITESPACE = re.compile(r"[ \t\n\r]*")
+
+
+class _JsonDepth(int):
+    # returned instead of dicts while skipping JSON values
+    pass
+
+
+_JSON_DEPTHS = [_JsonDepth(i) for i in range(64)]
+
+
+def _json_value_depth(value) -> int:
+    if type(value) is _JsonDepth:
+        return value
+    if type(value) is list:
+        depth = 0
+        for v in value:
+            if type(v) is _JsonDepth or type(v) is list:
+                d = _json_value_depth(v)
+                if d > depth:
+                    depth = d
+        return depth + 1
+    return 0
+
+
+def _json_data_depth(value) -> int:
+    # depth of decoded JSON data, dicts and lists count as one level
+    if type(value) is dict:
+        value = value.values()
+    elif type(value) is not list:
+        return 0
+    depth = 0
+    for v in value:
+        if type(v) is dict or type(v) is list:
+            d = _json_data_depth(v)
+            if d > depth:
+                depth = d
+    return depth + 1
+
+
+def _json_object_depth(pairs):
+    depth = 0
+    for _key, v in pairs:
+        if type(v) is _JsonDepth or type(v) is list:
+            d = _json_value_depth(v)
+            if d > depth:
+                depth = d
+    depth += 1
+    if depth < len(_JSON_DEPTHS):
+        return _JSON_DEPTHS[depth]
+    return _JsonDepth(depth)
+
+
+# decodes JSON values with the C scanner discarding objects, only their depth is kept
+_json_depth_decoder = json.JSONDecoder(object_pairs_hook=_json_object_depth)
+_json_decoder = json.JSONDecoder()
+
+
+class RequestBodyError(ValueError):
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.status = status
+
 
 def get_project_from_db(project_id):
     if not hasattr(settings, "NETS_CORE_PROJECT_MODEL"):
@@ -38,77 +109,197 @@ def get_project_membership_from_db(project_id, user):
 
 
 def get_value_from_data_key(data, key, params, project, files):
-    # Get value from data calling parse_param
-    # to validate type and validate if is required
-    # additional add customer to RequestParam instances
-    # to ensure validation
-
-    try:
-        value = data[key]
-        if not key in params.keys():
-            return value
-    except KeyError:
-        pass
-
-    param_type = params[key]
-    if isinstance(param_type, RequestParam):
-        if project:
-            # Append project to parameter to validate
-            # is required by RequestParam
-            param_type.project = project
-        if param_type.type == "file":
+    """
+    Deprecated, use RequestParamsSchema(params).parse_value.
+    Value of key in data parsed by its param, as received if key is not a param.
+    """
+    warnings.warn(
+        "get_value_from_data_key is deprecated, use RequestParamsSchema.parse_value",
+        DeprecationWarning,
+        stacklevel=2,
+    )
+    if key not in params:
+        return data[key]
+    return RequestParamsSchema({key: params[key]}).parse_value(data, key, project, files)
 
-            return param_type.get_file(files)
 
-        return param_type.get_value(data)
+def parse_param(data, k):
+    """
+    Deprecated, use RequestParam(key, type).get_value.
+    k is a key (value as received) or [key, type or RequestParam].
+    """
+    warnings.warn(
+        "parse_param is deprecated, use RequestParam.get_value",
+        DeprecationWarning,
+        stacklevel=2,
+    )
+    if isinstance(k, str):
+        return data.get(k, None)
 
-    value = parse_param(data, [key, param_type])
+    data_key, data_type = k
+    if not isinstance(data_type, RequestParam):
+        data_type = RequestParam(data_key, data_type)
+    value = data_type.get_value(data)
+    if not value and data_type.optional:
+        return None
     return value
 
 
-def parse_param(data, k):
+def _skip_json_value(text: str, index: int, max_depth: int = None) -> int:
+    """
+    Find the end of the JSON value starting at index without keeping it,
+    raise RequestBodyError if its nesting is deeper than max_depth.
+    """
+    try:
+        value, end = _json_depth_decoder.raw_decode(text, index)
+    except RecursionError:
+        raise RequestBodyError(_("JSON body nesting too deep"))
+    if max_depth is not None and _json_value_depth(value) > max_depth:
+        raise RequestBodyError(_("JSON body nesting too deep"))
+    return end
 
-    if isinstance(k, str):
-        d = data.get(k, None)
-        return d
 
-    elif isinstance(k, list):
-        data_key = k[0]
-        data_type = k[1]
+def _decode_json_value(text: str, index: int, max_depth: int = None):
+    """
+    Decode the JSON value starting at index, its depth is checked on the
+    decoded data so it is scanned once.
+    """
+    try:
+        value, end = _json_decoder.raw_decode(text, index)
+        if max_depth is not None and _json_data_depth(value) > max_depth:
+            raise RequestBodyError(_("JSON body nesting too deep"))
+    except RecursionError:
+        # without max_depth the decoder recursion limit is the limit
+        raise RequestBodyError(_("JSON body nesting too deep"))
+    return value, end
 
-        if not isinstance(data_type, RequestParam):
-            # build RequestParam object
-            data_type = RequestParam(data_key, data_type)
 
-        # Exceptions handle by request_params_handler
-        value = data_type.get_value(data)
-        if not value and data_type.optional:
-            print("returning default", data_type.default)
-            return None
+def parse_json_body(body: bytes, keys=None, max_depth: int = None):
+    """
+    Parse a JSON body already read in memory, it is not a streaming parser:
+    the body is decoded to a str and parsed at once, memory used is
+    proportional to the size of the body (see max_body_size of extract_data).
+    If keys is provided and body is an object, only those keys are decoded into
+    the returned data, values of other keys are scanned by the C decoder and
+    discarded without building their objects.
+    max_depth limit the nesting of the body, the top level object is depth 1.
+    """
+    if isinstance(body, bytes):
+        body = body.decode(json.detect_encoding(body), "surrogatepass")
+
+    pos = _JSON_WHITESPACE.match(body, 0).end()
+    if keys is None or body[pos : pos + 1] != "{":
+        data, end = _decode_json_value(body, pos, max_depth)
+        if body[end:].strip(" \t\n\r"):
+            raise RequestBodyError(_("Invalid JSON body"))
+        return data
+
+    value_depth = max_depth - 1 if max_depth is not None else None
+    data = {}
+    pos = _JSON_WHITESPACE.match(body, pos + 1).end()
+    if body[pos : pos + 1] == "}":
+        return data
+
+    while True:
+        if body[pos : pos + 1] != '"':
+            raise RequestBodyError(_("Invalid JSON body"))
+        key, pos = json.decoder.scanstring(body, pos + 1)
+
+        pos = _JSON_WHITESPACE.match(body, pos).end()
+        if body[pos : pos + 1] != ":":
+            raise RequestBodyError(_("Invalid JSON body"))
+        pos = _JSON_WHITESPACE.match(body, pos + 1).end()
+
+        if key in keys:
+            data[key], end = _decode_json_value(body, pos, value_depth)
+        else:
+            end = _skip_json_value(body, pos, value_depth)
+
+        pos = _JSON_WHITESPACE.match(body, end).end()
+        c = body[pos : pos + 1]
+        if c == "}":
+            break
+        if c != ",":
+            raise RequestBodyError(_("Invalid JSON body"))
+        pos = _JSON_WHITESPACE.match(body, pos + 1).end()
+
+    if body[pos + 1 :].strip(" \t\n\r"):
+        raise RequestBodyError(_("Invalid JSON body"))
+    return data
 
-        return data_type.get_value(data)
 
+def extract_data(request, keys=None, max_body_size: int = None, max_depth: int = None):
+    """
+    Extract request data from GET, POST or JSON body.
+    keys: if provided, only these keys are decoded from a JSON body, see parse_json_body
+    max_body_size: max size in bytes of the body, checked before reading it,
+        the body is read at once and is the bound of the memory used to parse it
+    max_depth: max nesting depth of a JSON body
 
-def extract_data(request):
+    Raise RequestBodyError if body is too large or not valid.
+    """
 
     if request.method == "GET":
         return request.GET
 
+    if max_body_size is not None:
+        try:
+            content_length = int(request.META.get("CONTENT_LENGTH") or 0)
+        except ValueError:
+            content_length = 0
+        if content_length > max_body_size:
+            raise RequestBodyError(_("Request body too large"), 413)
+
     data = request.POST
 
     content_type = request.META.get("CONTENT_TYPE", "application/x-www-form-urlencoded")
 
     if content_type.startswith("application/json"):
-        data = json.loads(request.body)
+        body = request.body
+        if max_body_size is not None and len(body) > max_body_size:
+            raise RequestBodyError(_("Request body too large"), 413)
+        try:
+            data = parse_json_body(body, keys, max_depth)
+        except ValueError as e:
+            if isinstance(e, RequestBodyError):
+                raise
+            raise RequestBodyError(_("Invalid JSON body"))
 
     return data
 
 
-def request_params_handler(request, params: dict | list = {}):
-    data = extract_data(request)
-
+def request_params_handler(request, params: dict | list | RequestParamsSchema = {}):
     if request.user.is_anonymous and not request.public:
         return permission_denied()
+
+    schema = params
+    if not isinstance(schema, RequestParamsSchema):
+        # request_handler compiles params once, direct calls compile here
+        schema = RequestParamsSchema(params)
+
+    # views that do not allow unknown keys only decode declared params from JSON bodies
+    allow_unknown_keys = getattr(request, "allow_unknown_keys", True)
+    keys = None
+    if not allow_unknown_keys:
+        keys = schema.keys | RESERVED_DATA_KEYS
+        index_field = getattr(request, "index_field", None)
+        if index_field:
+            keys = keys | {index_field}
+
+    try:
+        data = extract_data(
+            request,
+            keys=keys,
+            max_body_size=getattr(request, "max_body_size", MAX_BODY_SIZE),
+            max_depth=getattr(request, "max_json_depth", MAX_JSON_DEPTH),
+        )
+    except RequestBodyError as e:
+        return JsonResponse({"res": 0, "message": e.__str__()}, status=e.status)
+
+    # limits by username, device... read the raw values, before parsing and queries
+    for limit in getattr(request, "rate_limits", ()):
+        if not limit.hit(limit.get_value(data), request.rate_limit_scope):
+            return error_response(_("Too many requests"), 429)
     # TODO: Add support for multi customer projects
     project = None
     project_membership = None
@@ -126,26 +317,12 @@ def request_params_handler(request, params: dict | list = {}):
     request.project_id = project_id
     request.project_membership = project_membership
 
-    parsed_data = {}
-    # found_params = []
-
-    for k in data:
-        # parse data from request
-        try:
-            parsed_data[k] = get_value_from_data_key(
-                data, k, params, request.project, request.FILES
-            )
-        except Exception as e:
-            # Error parsing values
-            msg = e.__str__()
-            return JsonResponse({"res": 0, "message": msg}, status=400)
-
-    # extract files
-    for k in request.FILES:
-        if k in params.keys():
-            parsed_data[k] = get_value_from_data_key(
-                data, k, params, request.project, request.FILES
-            )
+    try:
+        parsed_data = schema.parse(data, request.FILES, request.project, keys=keys)
+    except Exception as e:
+        # Error parsing values
+        msg = e.__str__()
+        return JsonResponse({"res": 0, "message": msg}, status=400)
 
     if "action" in parsed_data.keys():
         if not "paginated_by" in parsed_data.keys():
@@ -153,20 +330,7 @@ def request_params_handler(request, params: dict | list = {}):
         if not "page" in parsed_data.keys():
             parsed_data["page"] = 1
 
-    missing_params = []
-
-    for p in params:
-        optional = False
-        if isinstance(params[p], RequestParam):
-            optional = params[p].optional
-            default = params[p].default if hasattr(params[p], "default") else None
-            if not p in parsed_data.keys() and optional:
-                parsed_data[p] = default
-
-        if p not in parsed_data.keys() and not optional:
-            # Omit missing if is instance of RequestParams
-            # because this class check and validate if self
-            missing_params.append(p)
+    missing_params = schema.missing(parsed_data)
 
     if missing_params:
         message = "Missing params: {}".format(", ".join(missing_params))
@@ -0,0 +1,542 @@
+"""
+Compiled model to json serializer.
+
+Same field spec as nets_core_postgre_model_to_json, e.g.
+"id,name,owner_id:[auth_user;id;username]", but the final SELECT is built in
+python once per (model, fields, vendor) and cached: plain fields and nested
+relations are written as json objects over LEFT JOINs and aggregated
+subqueries, the database runs a single parameterised query without calling
+plpgsql functions per row.
+
+PostgreSQL uses it with NETS_CORE_JSON_ENGINE = "compiled" or for nested fields,
+SQLite (JSON1) and MySQL (8.0.14+, JSON_ARRAYAGG as window function keeps the
+order of arrays) always use it, selected by connection.vendor.
+"""
+from functools import lru_cache
+from itertools import count
+
+from django.conf import settings
+from django.db import models
+from django.db.models import Window
+from django.db.models.functions import RowNumber
+from django.utils.translation import gettext_lazy as _
+
+# function: plpgsql functions created on migrate (default)
+# compiled: SQL built and cached by nets_core.json_compiler
+JSON_ENGINE = getattr(settings, "NETS_CORE_JSON_ENGINE", "function")
+JSON_PLAN_CACHE_SIZE = getattr(settings, "NETS_CORE_JSON_PLAN_CACHE_SIZE", 512)
+# levels of nested relations, deeper relations are serialized as ids
+JSON_MAX_DEPTH = getattr(settings, "NETS_CORE_JSON_MAX_DEPTH", 3)
+
+# json_build_object accepts 100 arguments at most, SQLite functions 127
+MAX_OBJECT_PAIRS = 50
+
+# fields containing any of these words are not serialized,
+# unless the model sets PROTECTED_FIELDS
+GLOBAL_PROTECTED_FIELDS = getattr(
+    settings, "NETS_CORE_GLOBAL_PROTECTED_FIELDS", ["password", "superuser"]
+)
+
+
+def _literal(value: str) -> str:
+    # % is escaped, compiled SQL is always executed with params
+    return "'%s'" % value.replace("'", "''").replace("%", "%%")
+
+
+class PostgresqlDialect():
+    """
+    pairs are (key, SQL expression) of a json object, rows of the model
+    are encoded by row_to_json, nested objects by json_build_object
+    """
+
+    vendor = "postgresql"
+
+    def quote(self, name: str) -> str:
+        return '"%s"' % name.replace('"', '""').replace("%", "%%")
+
+    def json_object(self, pairs: list) -> str:
+        if len(pairs) <= MAX_OBJECT_PAIRS:
+            return "json_build_object(%s)" % ", ".join(f"{_literal(k)}, {v}" for k, v in pairs)
+        # more than 50 fields, objects are merged as jsonb, keys are sorted by jsonb
+        chunks = [
+            self.json_object(pairs[i:i + MAX_OBJECT_PAIRS]) + "::jsonb"
+            for i in range(0, len(pairs), MAX_OBJECT_PAIRS)
+        ]
+        return "(%s)::json" % " || ".join(chunks)
+
+    def column(self, field, expr: str) -> str:
+        return expr
+
+    def _columns(self, pairs: list) -> str:
+        return ", ".join(f"{v} AS {self.quote(k)}" for k, v in pairs)
+
+    def select_rows(self, pairs: list, from_sql: str, text: bool = False) -> str:
+        # one json object per row of from_sql
+        cast = "::text" if text else ""
+        return f"SELECT row_to_json(_r){cast} FROM (SELECT {self._columns(pairs)} {from_sql}) _r"
+
+    def json_array(self, pairs: list, from_sql: str, order_sql: str) -> str:
+        # scalar subquery, json array of the rows of from_sql, [] if empty
+        return (
+            "(SELECT COALESCE(json_agg(row_to_json(_r)), '[]'::json) "
+            f"FROM (SELECT {self._columns(pairs)} {from_sql} ORDER BY {order_sql}) _r)"
+        )
+
+    def to_many(self, pairs: list, from_sql: str, order_sql: str, alias: str, joins: list) -> str:
+        joins.append(
+            f"LEFT JOIN LATERAL (SELECT {self.json_array(pairs, from_sql, order_sql)} AS value) "
+            f"{alias} ON true"
+        )
+        return f"{alias}.value"
+
+    def pk_queryset(self, queryset):
+        # query of the ids of queryset for ids_sql, in the order of queryset
+        return queryset.values_list("pk", flat=True)
+
+    def ids_sql(self, pk_sql: str) -> str:
+        # ids of pk_sql with their position as _ids(id, ord)
+        return f"unnest(ARRAY({pk_sql})) WITH ORDINALITY AS _ids(id, ord)"
+
+    def text(self, expr: str) -> str:
+        return f"({expr})::text"
+
+
+class SqliteDialect(PostgresqlDialect):
+    vendor = "sqlite"
+
+    def json_object(self, pairs: list) -> str:
+        obj = "json_object(%s)" % ", ".join(
+            f"{_literal(k)}, {v}" for k, v in pairs[:MAX_OBJECT_PAIRS]
+        )
+        for i in range(MAX_OBJECT_PAIRS, len(pairs), MAX_OBJECT_PAIRS):
+            # more than 50 fields, keys are appended by json_set
+            paths = ", ".join(
+                "%s, %s" % (_literal('$."%s"' % k), v) for k, v in pairs[i:i + MAX_OBJECT_PAIRS]
+            )
+            obj = f"json_set({obj}, {paths})"
+        return obj
+
+    def column(self, field, expr: str) -> str:
+        # booleans are stored as integers
+        if isinstance(field, models.BooleanField):
+            return f"CASE WHEN {expr} IS NULL THEN NULL WHEN {expr} THEN json('true') ELSE json('false') END"
+        # json is stored as text, json() nests it as a value (json(NULL) is NULL)
+        if isinstance(field, models.JSONField):
+            return f"json({expr})"
+        return expr
+
+    def select_rows(self, pairs: list, from_sql: str, text: bool = False) -> str:
+        return f"SELECT {self.json_object(pairs)} {from_sql}"
+
+    def json_array(self, pairs: list, from_sql: str, order_sql: str) -> str:
+        # values of a subquery are text, json() keeps them as json in the array
+        return (
+            f"json((SELECT COALESCE(json_group_array(json(_r.value)), '[]') FROM "
+            f"(SELECT {self.json_object(pairs)} AS value {from_sql} ORDER BY {order_sql}) _r))"
+        )
+
+    def to_many(self, pairs: list, from_sql: str, order_sql: str, alias: str, joins: list) -> str:
+        return self.json_array(pairs, from_sql, order_sql)
+
+    def pk_queryset(self, queryset):
+        """
+        (pk, position) of the rows of queryset, positions are numbered by
+        ROW_NUMBER() OVER (ORDER BY <ordering of queryset>) as the order of a
+        subquery is not kept (MySQL drops ORDER BY of derived tables)
+        """
+        query = queryset.query
+        if query.order_by:
+            ordering = list(query.order_by)
+        elif query.default_ordering:
+            ordering = list(query.get_meta().ordering)
+        else:
+            ordering = []
+        # pk breaks ties, random ordering can not be numbered
+        ordering = [order for order in ordering if order != "?"] + ["pk"]
+
+        # slices are applied after rows are numbered
+        low, high = query.low_mark, query.high_mark
+        queryset = queryset.all()
+        queryset.query.clear_limits()
+        queryset = queryset.annotate(
+            _nc_ord=Window(RowNumber(), order_by=ordering)
+        ).values_list("pk", "_nc_ord")
+        queryset.query.set_limits(low, high)
+        return queryset
+
+    def ids_sql(self, pk_sql: str) -> str:
+        # the columns of pk_sql are named by the CTE, their aliases depend on django
+        return f"(WITH _q(id, ord) AS ({pk_sql}) SELECT _q.id, _q.ord FROM _q) _ids"
+
+    def text(self, expr: str) -> str:
+        return expr
+
+
+class MysqlDialect(SqliteDialect):
+    """
+    Arrays are ordered by the window of JSON_ARRAYAGG. Positions of the ids of a
+    queryset (ids_sql) are numbered by the ids query, see pk_queryset.
+    """
+
+    vendor = "mysql"
+
+    def quote(self, name: str) -> str:
+        return "`%s`" % name.replace("`", "``").replace("%", "%%")
+
+    def json_object(self, pairs: list) -> str:
+        return "JSON_OBJECT(%s)" % ", ".join(f"{_literal(k)}, {v}" for k, v in pairs)
+
+    def column(self, field, expr: str) -> str:
+        if isinstance(field, models.BooleanField):
+            return (
+                f"CASE WHEN {expr} IS NULL THEN NULL WHEN {expr} THEN CAST('true' AS JSON) "
+                "ELSE CAST('false' AS JSON) END"
+            )
+        return expr
+
+    def select_rows(self, pairs: list, from_sql: str, text: bool = False) -> str:
+        obj = self.json_object(pairs)
+        return f"SELECT {self.text(obj) if text else obj} {from_sql}"
+
+    def json_array(self, pairs: list, from_sql: str, order_sql: str) -> str:
+        # JSON_ARRAYAGG has no ORDER BY and MySQL drops ORDER BY of a derived table
+        # that is aggregated, as a window function it reads the rows in the order
+        # of its frame, every row holds the whole array
+        return (
+            f"COALESCE((SELECT JSON_ARRAYAGG({self.json_object(pairs)}) OVER ("
+            f"ORDER BY {order_sql} ROWS BETWEEN UNBOUNDED PRECEDING AND UNBOUNDED FOLLOWING) "
+            f"{from_sql} LIMIT 1), JSON_ARRAY())"
+        )
+
+    def text(self, expr: str) -> str:
+        return f"CAST(({expr}) AS CHAR)"
+
+
+DIALECTS = {
+    "postgresql": PostgresqlDialect(),
+    "sqlite": SqliteDialect(),
+    "mysql": MysqlDialect(),
+}
+
+
+def _get_concrete_field(model, name: str):
+    for field in model._meta.concrete_fields:
+        if name in (field.column, field.attname, field.name):
+            return field
+    raise ValueError(_("Field %(field)s not found") % {"field": name})
+
+
+def _get_relation(model, name: str):
+    for field in model._meta.concrete_fields:
+        if name in (field.attname, field.name) and field.is_relation:
+            return field
+    try:
+        # reverse relations and many to many
+        field = model._meta.get_field(name)
+    except Exception:
+        raise ValueError(_("Field %(field)s not found") % {"field": name})
+    if not field.is_relation or field.related_model is None:
+        raise ValueError(_("Field %(field)s is not a relation") % {"field": name})
+    return field
+
+
+def split_field_spec(spec: str, separator: str = ",") -> list:
+    """
+    Split a field spec by separator out of brackets,
+    "id,role_id:[nets_core_role;id;name]" -> ["id", "role_id:[nets_core_role;id;name]"]
+    """
+    parts = []
+    depth = 0
+    start = 0
+    for i, char in enumerate(spec):
+        if char == "[":
+            depth += 1
+        elif char == "]":
+            depth -= 1
+        elif char == separator and depth == 0:
+            parts.append(spec[start:i])
+            start = i + 1
+    parts.append(spec[start:])
+    return [part for part in parts if part]
+
+
+def _is_globally_protected(name: str) -> bool:
+    name = name.lower()
+    return any(word.lower() in name for word in GLOBAL_PROTECTED_FIELDS)
+
+
+@lru_cache(maxsize=None)
+def get_protected_fields(model) -> frozenset:
+    """
+    Lowercase names of model fields that are never serialized: PROTECTED_FIELDS
+    of the model, or fields containing a word of NETS_CORE_GLOBAL_PROTECTED_FIELDS.
+    A protected field hides its name, attname and column (user, user_id).
+    """
+    protected = getattr(model, "PROTECTED_FIELDS", None)
+    if protected is not None:
+        protected = {name.lower() for name in protected}
+
+    names = set(protected or ())
+    for f in model._meta.get_fields():
+        aliases = {f.name.lower()}
+        if f.concrete:
+            aliases.update((f.attname.lower(), f.column.lower()))
+        if protected is None:
+            if any(_is_globally_protected(alias) for alias in aliases):
+                names.update(aliases)
+        elif aliases & protected:
+            names.update(aliases)
+    return frozenset(names)
+
+
+def is_protected_field(model, name: str) -> bool:
+    if name.lower() in get_protected_fields(model):
+        return True
+    # names that are not fields of the model (kept as is if ending with _id)
+    return not hasattr(model, "PROTECTED_FIELDS") and _is_globally_protected(name)
+
+
+def _related_json_fields(field) -> tuple:
+    related_model = field.related_model
+    if not getattr(related_model, "JSON_DATA_FIELDS", None):
+        raise ValueError(
+            _("Field %s is a related model but has no JSON_DATA_FIELDS") % field.name
+        )
+    try:
+        return tuple(related_model.JSON_DATA_FIELDS)
+    except Exception:
+        raise ValueError(_("Fields must be a tuple or list"))
+
+
+def resolve_field_spec(model, fields: tuple, depth: int = 0) -> tuple:
+    """
+    Field spec of fields for the model to json functions and JsonPlan.
+    Relations to models with JSON_DATA_FIELDS are nested:
+    foreign keys as role_id:[nets_core_role;name;...], reverse foreign keys
+    and many to many as permissions:[nets_core_permission;name;...].
+    Relations deeper than NETS_CORE_JSON_MAX_DEPTH are written as their id
+    (foreign keys) or skipped. Names ending with _id and specs are kept as is.
+    Protected fields are removed at every level, see get_protected_fields.
+    """
+    by_name = {}
+    for f in model._meta.get_fields():
+        by_name.setdefault(f.name, f)
+        if f.concrete:
+            by_name.setdefault(f.attname, f)
+            by_name.setdefault(f.column, f)
+
+    final_fields = []
+    for name in fields:
+        if is_protected_field(model, name.split(":", 1)[0]):
+            continue
+        if ":" in name:
+            final_fields.append(name)
+            continue
+        f = by_name.get(name)
+        if f is None:
+            # add fields that are not in schema and end with _id as user should be user_id
+            if name.endswith("_id"):
+                final_fields.append(name)
+            continue
+        if not f.is_relation or f.related_model is None or name != f.name:
+            final_fields.append(name)
+            continue
+
+        forward = f.concrete and (f.many_to_one or f.one_to_one)
+        if depth >= JSON_MAX_DEPTH:
+            if forward:
+                final_fields.append(f.attname)
+            continue
+
+        related_model = f.related_model
+        related_fields = resolve_field_spec(related_model, _related_json_fields(f), depth + 1)
+        nested = ";".join([related_model._meta.db_table, *related_fields])
+        # replace field for related format as field_name:[table_name; ...related_fields]
+        final_fields.append(f"{f.attname if forward else f.name}:[{nested}]")
+
+    return tuple(final_fields)
+
+
+class JsonPlan():
+    """
+    SQL of a (model, fields, vendor) signature, t0 is the alias of the model table.
+
+    pairs: (key, SQL expression) of the json object of a row
+    joins_sql: joins of nested objects required by pairs
+    single_sql: SELECT of one object, params [pk]
+
+    Foreign keys and reverse one to one are LEFT JOINs, reverse foreign keys and
+    many to many are json arrays aggregated from a subquery ordered by pk
+    (LEFT JOIN LATERAL in PostgreSQL), nesting is limited to NETS_CORE_JSON_MAX_DEPTH.
+    """
+
+    __slots__ = (
+        "model",
+        "fields",
+        "dialect",
+        "table",
+        "pk_column",
+        "pairs",
+        "joins_sql",
+        "single_sql",
+    )
+
+    def __init__(self, model, fields: str, vendor: str = "postgresql"):
+        if vendor not in DIALECTS:
+            raise ValueError(_("Database %(vendor)s not supported") % {"vendor": vendor})
+        self.model = model
+        self.fields = fields
+        self.dialect = DIALECTS[vendor]
+        self.table = self.dialect.quote(model._meta.db_table)
+        self.pk_column = self.dialect.quote(model._meta.pk.column)
+        joins = []
+        self.pairs = self._compile(model, split_field_spec(fields), "t0", joins, count(1), 0)
+        self.joins_sql = " ".join(joins)
+        self.single_sql = self.dialect.select_rows(
+            self.pairs,
+            f"FROM {self.table} t0 {self.joins_sql} WHERE t0.{self.pk_column} = %s",
+        )
+
+    def _compile(self, model, specs: list, alias: str, joins: list, aliases, depth: int) -> list:
+        quote = self.dialect.quote
+        pairs = []
+        for spec in specs:
+            # protected fields are not serialized, also in specs written by hand
+            if is_protected_field(model, spec.split(":", 1)[0]):
+                continue
+            if ":" not in spec:
+                field = _get_concrete_field(model, spec)
+                pairs.append(
+                    (spec, self.dialect.column(field, f"{alias}.{quote(field.column)}"))
+                )
+                continue
+
+            # role_id:[nets_core_role;id;name], nested specs are split by ;
+            name, nested = spec.split(":", 1)
+            nested = split_field_spec(nested.strip()[1:-1], ";")
+            if depth >= JSON_MAX_DEPTH:
+                raise ValueError(
+                    _("Nested fields deeper than %(depth)s") % {"depth": JSON_MAX_DEPTH}
+                )
+            field = _get_relation(model, name)
+            related_model = field.related_model
+            if not nested or nested[0] != related_model._meta.db_table:
+                raise ValueError(
+                    _("Table %(table)s is not the table of %(field)s")
+                    % {"table": nested[0] if nested else "", "field": name}
+                )
+            related_table = quote(related_model._meta.db_table)
+            related_alias = f"t{next(aliases)}"
+            related_pk = f"{related_alias}.{quote(related_model._meta.pk.column)}"
+
+            if field.concrete and (field.many_to_one or field.one_to_one):
+                # foreign key, the related object or null
+                target = f"{related_alias}.{quote(field.target_field.column)}"
+                joins.append(
+                    f"LEFT JOIN {related_table} {related_alias} "
+                    f"ON {target} = {alias}.{quote(field.column)}"
+                )
+                related_object = self.dialect.json_object(
+                    self._compile(related_model, nested[1:], related_alias, joins, aliases, depth + 1)
+                )
+                key = name[:-3] if name.endswith("_id") else name
+                pairs.append(
+                    (key, f"CASE WHEN {target} IS NULL THEN NULL ELSE {related_object} END")
+                )
+                continue
+
+            if field.one_to_one:
+                # reverse one to one, the related object or null
+                remote = field.remote_field
+                joins.append(
+                    f"LEFT JOIN {related_table} {related_alias} "
+                    f"ON {related_alias}.{quote(remote.column)} = "
+                    f"{alias}.{quote(remote.target_field.column)}"
+                )
+                related_object = self.dialect.json_object(
+                    self._compile(related_model, nested[1:], related_alias, joins, aliases, depth + 1)
+                )
+                pairs.append(
+                    (name, f"CASE WHEN {related_pk} IS NULL THEN NULL ELSE {related_object} END")
+                )
+                continue
+
+            # to many, json array of related objects
+            related_joins = []
+            related_pairs = self._compile(
+                related_model, nested[1:], related_alias, related_joins, aliases, depth + 1
+            )
+            if field.many_to_many:
+                m2m = field if field.concrete else field.remote_field
+                through_alias = f"t{next(aliases)}"
+                if field.concrete:
+                    source, target = m2m.m2m_column_name(), m2m.m2m_reverse_name()
+                else:
+                    source, target = m2m.m2m_reverse_name(), m2m.m2m_column_name()
+                from_sql = (
+                    f"FROM {quote(m2m.m2m_db_table())} {through_alias} "
+                    f"JOIN {related_table} {related_alias} "
+                    f"ON {related_pk} = {through_alias}.{quote(target)} "
+                    f"{' '.join(related_joins)} "
+                    f"WHERE {through_alias}.{quote(source)} = "
+                    f"{alias}.{quote(model._meta.pk.column)}"
+                )
+            else:
+                # reverse foreign key
+                remote = field.remote_field
+                from_sql = (
+                    f"FROM {related_table} {related_alias} {' '.join(related_joins)} "
+                    f"WHERE {related_alias}.{quote(remote.column)} = "
+                    f"{alias}.{quote(remote.target_field.column)}"
+                )
+            value = self.dialect.to_many(
+                related_pairs, from_sql, related_pk, f"l{next(aliases)}", joins
+            )
+            pairs.append((name, value))
+        return pairs
+
+    def _from_ids(self, pk_sql: str) -> str:
+        return (
+            f"FROM {self.dialect.ids_sql(pk_sql)} "
+            f"JOIN {self.table} t0 ON t0.{self.pk_column} = _ids.id {self.joins_sql}"
+        )
+
+    def pk_queryset(self, queryset):
+        """
+        Query of the ids of queryset to compile as pk_sql of array_sql and rows_sql
+        """
+        return self.dialect.pk_queryset(queryset)
+
+    def array_sql(self, pk_sql: str) -> str:
+        """
+        Scalar subquery returning the json array of the objects in pk_sql
+        (see pk_queryset), ordered as pk_sql, [] if empty
+        """
+        return self.dialect.json_array(self.pairs, self._from_ids(pk_sql), "_ids.ord")
+
+    def rows_sql(self, pk_sql: str) -> str:
+        """
+        SELECT of one json text per row of pk_sql, ordered as pk_sql
+        """
+        return self.dialect.select_rows(
+            self.pairs, f"{self._from_ids(pk_sql)} ORDER BY _ids.ord", text=True
+        )
+
+    def text(self, expr: str) -> str:
+        # json expression as text, for RawJSON
+        return self.dialect.text(expr)
+
+
+def use_json_plan(fields: str, vendor: str = "postgresql") -> bool:
+    # plpgsql functions only exist in PostgreSQL and only nest foreign keys of
+    # single objects, nested fields are always compiled
+    return vendor != "postgresql" or JSON_ENGINE == "compiled" or ":" in fields
+
+
+@lru_cache(maxsize=JSON_PLAN_CACHE_SIZE)
+def get_json_plan(model, fields: str, vendor: str = "postgresql") -> JsonPlan:
+    """
+    Cached JsonPlan of model and fields for the database vendor,
+    fields as passed to nets_core_postgre_model_to_json (comma separated)
+    """
+    return JsonPlan(model, fields, vendor)
@@ -1,84 +1,71 @@
 from nets_core.firebase_messages import send_user_device_notification
-from nets_core.models import NetsCoreBaseModel, VerificationCode
+from nets_core.models import (
+    NetsCoreBaseModel,
+    VerificationCode,
+    Permission,
+    Role,
+    RolePermission,
+    UserRole,
+)
 from django.db.models.signals import (
     post_delete,
     post_save,
     pre_delete,
     post_migrate,
     post_init,
-    pre_save,
+    m2m_changed,
 )
 from django.dispatch import receiver
 from nets_core.mail import send_email
 from nets_core.models import EmailTemplate
 from django.core.cache import cache
 from django.utils.translation import gettext_lazy as _
-from django.utils import timezone
+from nets_core.utils import bump_permissions_version, sync_permissions_registry
+from nets_core.serializers import bump_json_cache_version, json_cache_enabled
 
 import logging
 
 logger = logging.getLogger(__name__)
 
 
-@receiver(pre_save)
-def pre_save_base_model_handler(sender, instance, **kwargs):
-    if not instance.pk:
-        return  # created
-
-    if issubclass(sender, NetsCoreBaseModel):
-        # NetsCoreBaseModel implements updated_fields property to track fields that have changed
-        # is a dict of field_name: [{'old': old_value, 'new': new_value, 'time': time}]
-        untracked_fields = ["password", "token", "updated_fields"]
-        try:
-            previous_instance = sender.objects.get(pk=instance.pk)
-        except sender.DoesNotExist:
-            return
-        for field in instance._meta.fields:
-            if not hasattr(field, "column") or field.column in (
-                "created_at",
-                "updated_at",
-            ):
-                continue
-            # check if field is hasattr auto_now or auto_now_add or is BigAutoField
-            if (
-                hasattr(field, "auto_now")
-                or hasattr(field, "auto_now_add")
-                or field.__class__.__name__ == "BigAutoField"
-            ):
-                continue
-
-            field_name = field.name
-            if field_name in untracked_fields:
-                continue
-
-            if getattr(previous_instance, field_name) != getattr(instance, field_name):
-                if not hasattr(instance, "updated_fields"):
-                    instance.updated_fields = {}
-                if field_name not in instance.updated_fields:
-                    instance.updated_fields[field_name] = []
-
-                # ensure values are strings for JSON serialization
-                try:
-                    old_value = str(getattr(previous_instance, field_name))
-                except:
-                    old_value = None
-
-                try:
-                    new_value = str(getattr(instance, field_name))
-                except:
-                    new_value = None
-
-                if not old_value and not new_value:
-                    continue
-
-                if old_value != new_value:
-                    instance.updated_fields[field_name].append(
-                        {
-                            "old": old_value,
-                            "new": new_value,
-                            "time": str(timezone.now()),
-                        }
-                    )
+def invalidate_json_cache_handler(sender, instance, **kwargs):
+    # cached to_json of the row are versioned, bump the version to discard them
+    bump_json_cache_version(sender, instance.pk)
+
+
+def connect_json_cache_handlers():
+    """
+    Connect invalidate_json_cache_handler to models with the json cache enabled,
+    saves of other models do not pay the cache round trip. Called from AppConfig.ready()
+    """
+    from django.apps import apps
+
+    for model in apps.get_models():
+        if issubclass(model, NetsCoreBaseModel) and json_cache_enabled(model):
+            uid = f"nets_core_json_cache_{model._meta.label_lower}"
+            post_save.connect(invalidate_json_cache_handler, sender=model, dispatch_uid=uid)
+            post_delete.connect(invalidate_json_cache_handler, sender=model, dispatch_uid=uid)
+
+
+@receiver(post_save, sender=Permission)
+@receiver(post_delete, sender=Permission)
+@receiver(post_save, sender=Role)
+@receiver(post_delete, sender=Role)
+@receiver(post_save, sender=RolePermission)
+@receiver(post_delete, sender=RolePermission)
+@receiver(post_save, sender=UserRole)
+@receiver(post_delete, sender=UserRole)
+def invalidate_permissions_handler(sender, **kwargs):
+    # compiled permission sets are versioned, bump the version to discard them
+    bump_permissions_version()
+
+
+@receiver(m2m_changed, sender=Role.permissions.through)
+def role_permissions_changed_handler(sender, action, **kwargs):
+    # role.permissions.add/remove/clear bulk create or delete RolePermission
+    # rows without sending post_save/post_delete
+    if action in ("post_add", "post_remove", "post_clear"):
+        bump_permissions_version()
 
 
 @receiver(post_save, sender=VerificationCode)
@@ -178,3 +165,10 @@ def post_migrate_handler(sender, **kwargs):
 
                     if created:
                         logger.info(f"Created permission {permission}")
+
+    # permissions used in request_handler(can_do=...), once per migrate
+    if sender.label != "nets_core":
+        return
+    created = sync_permissions_registry(using=kwargs.get("using", "default"))
+    for codename in created:
+        logger.info(f"Created permission {codename}")
@@ -0,0 +1,159 @@
+import timeit
+
+from django.core.management.base import BaseCommand
+from django.db import connections, transaction
+
+from nets_core import json_compiler, serializers
+from nets_core.models import Permission, Role, RolePermission
+from nets_core.params import RequestParam, RequestParamsSchema
+from nets_core.responses import dumps
+from nets_core.serializers import NetsCoreModelToJson, NetsCoreQuerySetToJson
+
+
+class Command(BaseCommand):
+    help = """
+        Micro-benchmarks of nets_core hot paths.
+
+        params: per request parse cost of RequestParam specs with 5, 20 and 100 params
+        compiled once as request_handler does, run it on other versions to compare.
+
+        serializers: model to json of one instance, a queryset and nested relations
+        with each engine available in the database (plpgsql functions and compiled
+        SQL in PostgreSQL, compiled SQL in SQLite and MySQL) against values() encoded
+        in python. Rows are created in a transaction rolled back at the end.
+    """
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--iterations", default=2000, type=int, help="iterations per case"
+        )
+        parser.add_argument(
+            "--only", choices=["params", "serializers"], help="run one benchmark"
+        )
+        parser.add_argument(
+            "--rows", default=1000, type=int, help="rows serialized by queryset cases"
+        )
+        parser.add_argument("--database", default="default", help="database alias")
+
+    def handle(self, *args, **options):
+        if options["only"] in (None, "params"):
+            self.benchmark_params(options["iterations"])
+        if options["only"] in (None, "serializers"):
+            self.benchmark_serializers(
+                max(options["iterations"] // 20, 1), options["rows"], options["database"]
+            )
+
+    def build_params(self, size: int):
+        # mix of types found in views: str, int, bool, float, dict, email and optionals
+        types = [
+            (str, "value"),
+            (int, "10"),
+            (bool, "true"),
+            (float, "1.5"),
+            ("email", "Someone@Mail.com"),
+            (dict, {"value": 1}),
+        ]
+        params = []
+        data = {}
+        for i in range(size):
+            param_type, value = types[i % len(types)]
+            key = f"param_{i}"
+            params.append(RequestParam(key, param_type, optional=i % 4 == 0))
+            data[key] = value
+        return params, data
+
+    def benchmark_params(self, iterations: int):
+        self.stdout.write("params parse (microseconds per request)")
+        self.stdout.write(f"{'params':>8} {'compiled':>12}")
+        for size in (5, 20, 100):
+            params, data = self.build_params(size)
+            schema = RequestParamsSchema(params)
+
+            def compiled():
+                parsed = schema.parse(data)
+                schema.missing(parsed)
+
+            # warm up lazy translations and regex compilation
+            compiled()
+            compiled_us = timeit.timeit(compiled, number=iterations) / iterations * 1e6
+            self.stdout.write(f"{size:>8} {compiled_us:>12.2f}")
+
+    def benchmark_serializers(self, iterations: int, rows: int, using: str):
+        vendor = connections[using].vendor
+        engines = ["function", "compiled"] if vendor == "postgresql" else ["compiled"]
+        self.stdout.write("")
+        self.stdout.write(f"serializers on {vendor} (milliseconds per call, {rows} rows)")
+        self.stdout.write(
+            f"{'case':>10}" + "".join(f"{engine:>12}" for engine in engines + ["values"])
+        )
+
+        with transaction.atomic(using=using):
+            permissions = Permission.objects.using(using).bulk_create(
+                [Permission(name=f"bench {i}", codename=f"nets-benchmark-{i}") for i in range(rows)]
+            )
+            role = Role.objects.using(using).create(name="nets-benchmark", codename="nets-benchmark")
+            RolePermission.objects.using(using).bulk_create(
+                [RolePermission(role=role, permission=p) for p in permissions[:100]]
+            )
+            queryset = Permission.objects.using(using).filter(
+                codename__startswith="nets-benchmark-"
+            ).order_by("id")
+            fields = ("id", "name", "codename", "description", "created")
+            role_permissions = RolePermission.objects.using(using).filter(role=role).order_by("id")
+
+            cases = [
+                (
+                    "instance",
+                    lambda: NetsCoreModelToJson(permissions[0], fields, using).to_json(),
+                    lambda: dumps(queryset.values(*fields).get(pk=permissions[0].pk)),
+                ),
+                (
+                    "queryset",
+                    lambda: NetsCoreQuerySetToJson(queryset, fields, using).to_json(raw=True),
+                    lambda: dumps(list(queryset.values(*fields))),
+                ),
+                (
+                    "nested",
+                    lambda: NetsCoreQuerySetToJson(
+                        role_permissions, ("id", "role", "permission"), using
+                    ).to_json(raw=True),
+                    lambda: dumps(
+                        [
+                            {
+                                "id": rp.id,
+                                "role": {"name": rp.role.name, "codename": rp.role.codename},
+                                "permission": {
+                                    "name": rp.permission.name,
+                                    "codename": rp.permission.codename,
+                                },
+                            }
+                            for rp in role_permissions.select_related("role", "permission")
+                        ]
+                    ),
+                ),
+            ]
+
+            engine = json_compiler.JSON_ENGINE
+            try:
+                for name, serializer, values in cases:
+                    line = f"{name:>10}"
+                    for json_engine in engines:
+                        if name == "nested" and json_engine == "function":
+                            # nested fields are always compiled
+                            line += f"{'-':>12}"
+                            continue
+                        json_compiler.JSON_ENGINE = json_engine
+                        # specs keep the plan chosen for the engine
+                        serializers._get_json_spec.cache_clear()
+                        line += f"{self.time_call(serializer, iterations):>12.3f}"
+                    line += f"{self.time_call(values, iterations):>12.3f}"
+                    self.stdout.write(line)
+            finally:
+                json_compiler.JSON_ENGINE = engine
+                serializers._get_json_spec.cache_clear()
+                transaction.set_rollback(True, using=using)
+
+    def time_call(self, func, iterations: int) -> float:
+        # warm up caches (compiled plans, prepared functions)
+        func()
+        return timeit.timeit(func, number=iterations) / iterations * 1e3
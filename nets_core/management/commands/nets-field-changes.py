@@ -0,0 +1,79 @@
+from django.apps import apps
+from django.contrib.contenttypes.models import ContentType
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.utils.dateparse import parse_datetime
+
+from nets_core.models import FieldChange, NetsCoreBaseModel
+
+
+class Command(BaseCommand):
+    help = """
+        Manage FieldChange history of NetsCoreBaseModel instances.
+        --cleanup deletes changes older than NETS_CORE_FIELD_CHANGES_RETENTION_DAYS (or --days),
+        --migrate moves the legacy updated_fields column of every model to FieldChange
+        and empties it.
+    """
+
+    def add_arguments(self, parser):
+        parser.add_argument("--cleanup", action="store_true")
+        parser.add_argument("--days", default=None, type=int)
+        parser.add_argument("--migrate", action="store_true")
+        parser.add_argument("--batch-size", default=500, type=int)
+        parser.add_argument("--database", default="default", type=str)
+
+    def handle(self, *args, **options):
+        using = options["database"]
+        if options["migrate"]:
+            for model in apps.get_models():
+                if issubclass(model, NetsCoreBaseModel):
+                    moved = self.migrate_updated_fields(model, options["batch_size"], using)
+                    if moved:
+                        self.stdout.write(
+                            self.style.SUCCESS(f"{model.__name__}: {moved} changes moved")
+                        )
+
+        if options["cleanup"]:
+            deleted = FieldChange.objects.db_manager(using).delete_expired(options["days"])
+            self.stdout.write(f"{deleted} expired changes deleted")
+
+    def migrate_updated_fields(self, model, batch_size: int, using: str) -> int:
+        content_type = ContentType.objects.db_manager(using).get_for_model(model)
+        query = (
+            model._base_manager.using(using)
+            .exclude(updated_fields__isnull=True)
+            .exclude(updated_fields={})
+            .order_by("pk")
+            .values_list("pk", "updated_fields")
+        )
+        moved = 0
+        while True:
+            # rows are emptied, the next batch starts again from the first row left
+            rows = list(query[:batch_size])
+            if not rows:
+                return moved
+
+            changes = []
+            for pk, updated_fields in rows:
+                if not isinstance(updated_fields, dict):
+                    continue
+                for field, values in updated_fields.items():
+                    for value in values or []:
+                        created = parse_datetime(str(value.get("time") or ""))
+                        change = FieldChange(
+                            content_type=content_type,
+                            object_id=str(pk),
+                            field=field,
+                            old=value.get("old"),
+                            new=value.get("new"),
+                        )
+                        if created:
+                            change.created = created
+                        changes.append(change)
+
+            with transaction.atomic(using=using):
+                FieldChange.objects.using(using).bulk_create(changes, batch_size=batch_size)
+                model._base_manager.using(using).filter(
+                    pk__in=[pk for pk, _updated_fields in rows]
+                ).update(updated_fields={})
+            moved += len(changes)
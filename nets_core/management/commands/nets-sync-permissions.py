@@ -0,0 +1,23 @@
+from django.core.management.base import BaseCommand
+
+from nets_core.utils import PERMISSIONS_REGISTRY, sync_permissions_registry
+
+
+class Command(BaseCommand):
+    help = """
+        Create permissions used in request_handler(can_do=...) that does not exist in database.
+        check_perm does not create permissions, run this command after deploy
+        or rely on post_migrate that runs the same sync.
+    """
+
+    def add_arguments(self, parser):
+        parser.add_argument("--database", default="default", type=str)
+
+    def handle(self, *args, **options):
+        created = sync_permissions_registry(using=options["database"])
+        for codename in created:
+            self.stdout.write(self.style.SUCCESS(f"Created permission {codename}"))
+
+        self.stdout.write(
+            f"{len(PERMISSIONS_REGISTRY)} registered permissions, {len(created)} created"
+        )
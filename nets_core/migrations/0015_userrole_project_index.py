@@ -0,0 +1,24 @@
+# Generated by Django 5.2.18 on 2026-10-17 15:37
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('contenttypes', '0002_remove_content_type_name'),
+        ('nets_core', '0014_rolepermission_remove_permission_permission_index_and_more'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='rolepermission',
+            index=models.Index(fields=['role', 'permission'], name='role_permission_index'),
+        ),
+        migrations.AddIndex(
+            model_name='userrole',
+            index=models.Index(fields=['user', 'project_content_type', 'project_id'], name='user_role_project_index'),
+        ),
+    ]
@@ -0,0 +1,34 @@
+# Generated by Django 5.2.18 on 2026-10-17 16:07
+
+import django.db.models.deletion
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('contenttypes', '0002_remove_content_type_name'),
+        ('nets_core', '0015_userrole_project_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='FieldChange',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('object_id', models.CharField(max_length=64, verbose_name='Object id')),
+                ('field', models.CharField(max_length=150, verbose_name='Field')),
+                ('old', models.TextField(blank=True, null=True, verbose_name='Old value')),
+                ('new', models.TextField(blank=True, null=True, verbose_name='New value')),
+                ('created', models.DateTimeField(default=django.utils.timezone.now, verbose_name='Created')),
+                ('content_type', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='contenttypes.contenttype')),
+            ],
+            options={
+                'verbose_name': 'Field Change',
+                'verbose_name_plural': 'Field Changes',
+                'db_table': 'nets_core_field_change',
+                'indexes': [models.Index(fields=['content_type', 'object_id', 'created'], name='field_change_object_index'), models.Index(fields=['created'], name='field_change_created_index')],
+            },
+        ),
+    ]
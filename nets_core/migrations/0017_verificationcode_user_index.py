@@ -0,0 +1,19 @@
+# Generated by Django 5.2.18 on 2026-10-17 16:10
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('nets_core', '0016_fieldchange'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='verificationcode',
+            index=models.Index(fields=['user', '-created'], name='verification_code_user_index'),
+        ),
+    ]
@@ -1,6 +1,10 @@
+import copy
 import json
 import shortuuid
 
+from collections.abc import Mapping
+from datetime import timedelta
+from functools import lru_cache
 from uuid import uuid4
 
 
@@ -11,11 +15,12 @@ from django.utils.translation import gettext_lazy as _
 from django.contrib.contenttypes.models import ContentType
 from django.contrib.contenttypes.fields import GenericForeignKey
 from django.core.cache import cache
-from django.contrib.auth.hashers import check_password, make_password
 from django.utils import timezone
 from django.contrib.auth import get_user_model
 
 
+from nets_core.audit import add_field_changes
+from nets_core.json_compiler import resolve_field_spec
 from nets_core.utils import generate_int_uuid
 
 token_timeout_seconds = 15 * 60  # 15 minutes default
@@ -25,42 +30,195 @@ except Exception as e:
     # Settings not present use default
     pass
 
+# saves of NetsCoreBaseModel instances loaded from the database without changes
+# in their fields are skipped, can be set per model with SKIP_UNCHANGED_SAVES
+SKIP_UNCHANGED_SAVES = getattr(settings, "NETS_CORE_SKIP_UNCHANGED_SAVES", False)
+# fields compared on save but not written to FieldChange
+UNTRACKED_FIELDS = ("password", "token", "updated_fields")
+# changed fields are stored in FieldChange, models can opt out with TRACK_FIELD_CHANGES = False
+TRACK_FIELD_CHANGES = getattr(settings, "NETS_CORE_TRACK_FIELD_CHANGES", True)
+# days FieldChange rows are kept, None keeps them forever, see nets-field-changes
+FIELD_CHANGES_RETENTION_DAYS = getattr(settings, "NETS_CORE_FIELD_CHANGES_RETENTION_DAYS", None)
+
+
+@lru_cache(maxsize=None)
+def get_tracked_fields(model) -> tuple:
+    """
+    (name, attname, mutable) of the fields of model compared on save,
+    every concrete field but auto fields and auto_now dates
+    """
+    tracked = []
+    for field in model._meta.concrete_fields:
+        if getattr(field, "auto_now", False) or field.__class__.__name__ in (
+            "AutoField",
+            "BigAutoField",
+            "SmallAutoField",
+        ):
+            continue
+        tracked.append((field.name, field.attname, isinstance(field, models.JSONField)))
+    return tuple(tracked)
+
+
+@lru_cache(maxsize=None)
+def get_untracked_fields(model) -> frozenset:
+    """
+    Names of the tracked fields of model not written to FieldChange:
+    UNTRACKED_FIELDS, auto_now_add dates and created_at / updated_at columns
+    """
+    return frozenset(
+        field.name
+        for field in model._meta.concrete_fields
+        if field.name in UNTRACKED_FIELDS
+        or getattr(field, "auto_now_add", False)
+        or field.column in ("created_at", "updated_at")
+    )
+
+
+class FieldSnapshot():
+    """
+    Values of the tracked fields of an instance as loaded from the database,
+    in the order of get_tracked_fields. Changes are found comparing the
+    instance with its snapshot, without reading the row again.
+    """
+
+    __slots__ = ("values",)
+
+    # field not loaded (deferred)
+    DEFERRED = object()
+
+    def __init__(self, instance, update_fields=None, previous=None):
+        loaded = instance.__dict__
+        values = []
+        tracked = get_tracked_fields(instance.__class__)
+        for index, (name, attname, mutable) in enumerate(tracked):
+            if update_fields is not None and name not in update_fields and attname not in update_fields:
+                # not saved, keep the loaded value
+                values.append(previous.values[index])
+                continue
+            value = loaded.get(attname, self.DEFERRED)
+            # json values can be changed in place
+            values.append(copy.deepcopy(value) if mutable else value)
+        self.values = tuple(values)
+
+    def changes(self, instance, update_fields=None) -> list:
+        """
+        (name, old, new) of the tracked fields changed, only update_fields if given
+        """
+        loaded = instance.__dict__
+        changes = []
+        for (name, attname, mutable), old in zip(
+            get_tracked_fields(instance.__class__), self.values
+        ):
+            if update_fields is not None and name not in update_fields and attname not in update_fields:
+                continue
+            new = loaded.get(attname, self.DEFERRED)
+            if new is self.DEFERRED:
+                continue
+            if old is self.DEFERRED or old != new:
+                # old value of fields deferred at load is unknown, DEFERRED
+                changes.append((name, old, new))
+        return changes
+
+
+class UpdatedFieldsHistory(Mapping):
+    """
+    Changes of an instance in the updated_fields format
+    {field_name: [{'old': old_value, 'new': new_value, 'time': time}]},
+    legacy updated_fields column first, then FieldChange rows.
+    Rows are read on first access.
+    """
+
+    __slots__ = ("instance", "_data")
+
+    def __init__(self, instance):
+        self.instance = instance
+        self._data = None
+
+    def _load(self) -> dict:
+        if self._data is None:
+            data = {}
+            legacy = self.instance.updated_fields
+            if isinstance(legacy, dict):
+                for name, changes in legacy.items():
+                    data[name] = list(changes)
+            for name, old, new, created in (
+                FieldChange.objects.for_instance(self.instance)
+                .order_by("created", "id")
+                .values_list("field", "old", "new", "created")
+            ):
+                data.setdefault(name, []).append(
+                    {"old": old, "new": new, "time": str(created)}
+                )
+            self._data = data
+        return self._data
+
+    def __getitem__(self, key):
+        return self._load()[key]
+
+    def __iter__(self):
+        return iter(self._load())
+
+    def __len__(self):
+        return len(self._load())
+
 
 class NetsCoreBaseManager(models.Manager):
 
-    def to_json(self, fields: tuple = None):
+    def to_json(self, fields: tuple = None, raw: bool = False):
+        """
+        raw: if True return nets_core.responses.RawJSON with the json text
+        produced by the database, see success_response
+        """
         query = self.get_queryset()
-        if not query:
+        # two pks at most tell if query is empty or a single object
+        # without loading instances
+        pks = list(query.values_list("pk", flat=True)[:2])
+        if not pks:
             raise ValueError(_("Query must be provided"))
 
-        # get the query instance and check if JSON_DATA_FIELDS is present
-        if hasattr(self.model, "JSON_DATA_FIELDS") and not fields:
-            if not self.model.JSON_DATA_FIELDS:
-                raise ValueError(_("Fields must be provided"))
-            if not isinstance(self.model.JSON_DATA_FIELDS, tuple):
-                try:
-                    fields = tuple(self.model.JSON_DATA_FIELDS)
-                except Exception as e:
-                    raise ValueError(_("Fields must be a tuple or list"))
-
-        if not fields:
-            raise ValueError(_("Fields must be provided"))
-        if fields == "__all__":
-            # get fiels to tupple but names from columns in db table schema, user should be user_id
-            schema = self.model._meta.get_fields()
-            fields = tuple(
-                [field.column for field in schema if hasattr(field, "column")]
-            )
-
-        if not isinstance(fields, tuple):
-            raise ValueError(_("Fields must be a tuple"))
-
         from nets_core.serializers import NetsCoreModelToJson, NetsCoreQuerySetToJson
 
-        if query.count() == 1:
-            return NetsCoreModelToJson(query.first(), fields).to_json()
-
-        return NetsCoreQuerySetToJson(query, fields).to_json()
+        if len(pks) == 1:
+            # instance only referenced by pk, NetsCoreModelToJson does not read other fields
+            return NetsCoreModelToJson(self.model(pk=pks[0]), fields).to_json(raw=raw)
+
+        return NetsCoreQuerySetToJson(query, fields).to_json(raw=raw)
+
+    def to_json_page(
+        self, page: int = 1, paginated_by: int = 25, fields: tuple = None, raw: bool = False
+    ):
+        """
+        Page of the queryset, see NetsCoreQuerySetPageToJson
+        Returns {"data": [...], "page": n, "paginated_by": n, "total": n, "has_more": bool}
+        """
+        from nets_core.serializers import NetsCoreQuerySetPageToJson
+
+        return NetsCoreQuerySetPageToJson(
+            self.get_queryset(), fields, page=page, paginated_by=paginated_by
+        ).to_json(raw=raw)
+
+    def to_json_cursor(
+        self,
+        cursor: str = None,
+        limit: int = 25,
+        fields: tuple = None,
+        raw: bool = False,
+        descending: bool = False,
+    ):
+        """
+        Keyset page of the queryset ordered by pk, see NetsCoreQuerySetCursorToJson
+        Returns {"data": [...], "cursor": str or None, "has_more": bool},
+        pass cursor back to get the next page
+        """
+        from nets_core.serializers import NetsCoreQuerySetCursorToJson
+
+        return NetsCoreQuerySetCursorToJson(
+            self.get_queryset(),
+            fields,
+            cursor=cursor,
+            limit=limit,
+            descending=descending,
+        ).to_json(raw=raw)
 
 
 class NetsCoreBaseModel(models.Model):
@@ -76,78 +234,129 @@ class NetsCoreBaseModel(models.Model):
         abstract = True
 
     def validate_fields(self, fields: tuple):
-        schema = self._meta.get_fields()
-        # add fields that are not in schema and end with _id as user should be user_id and not present in schema
-        final_fields = [f for f in fields if f.endswith("_id")]
-        for f in schema:
-            if f.name in fields and not f.name in final_fields:
-                if isinstance(f, models.ForeignKey):
-                    related_model = f.related_model
-
-                    if (
-                        hasattr(related_model, "JSON_DATA_FIELDS")
-                        and related_model.JSON_DATA_FIELDS
-                    ):
-                        if not isinstance(related_model.JSON_DATA_FIELDS, tuple):
-                            try:
-                                related_fields = tuple(related_model.JSON_DATA_FIELDS)
-                            except Exception as e:
-                                raise ValueError(_("Fields must be a tuple or list"))
-                        else:
-                            related_fields = fields
-                        # replace field for related format as field_name:[table_name; ...related_fields]
-                        table_name = related_model._meta.db_table
-                        related_fields = [table_name] + list(related_fields)
-                        final_fields.append(f"{f.name}_id:[{';'.join(related_fields)}]")
-                        # final_fields = final_fields + (f"{f.name}:[{';'.join(related_fields)}]",)
-
-                    else:
-                        raise ValueError(
-                            _(
-                                "Field %s is a related model but has no JSON_DATA_FIELDS"
-                                % f.name
-                            )
-                        )
-                else:
-                    final_fields.append(f.name)
-
-        return tuple(final_fields)
-
-    def to_json(self, fields: tuple = None):
-        # check if JSON_DATA_FIELDS is present
-        if hasattr(self, "JSON_DATA_FIELDS") and not fields:
-            if not self.JSON_DATA_FIELDS:
-                raise ValueError(_("Fields must be provided"))
-            if not isinstance(self.JSON_DATA_FIELDS, tuple):
-                try:
-                    fields = tuple(self.JSON_DATA_FIELDS)
-                except Exception as e:
-                    raise ValueError(_("Fields must be a tuple or list"))
-
-        if not fields:
-            raise ValueError(_("Fields must be provided"))
-        if fields == "__all__":
-            # get fields to tuple but names from columns in db table schema, user should be user_id
-            schema = self._meta.get_fields()
-            fields = tuple(
-                [field.column for field in schema if hasattr(field, "column")]
-            )
-            related_fields = [
-                field.name for field in schema if hasattr(field, "related_model")
-            ]
-            fields = self.validate_fields(fields + tuple(related_fields))
+        """
+        Field spec of fields, relations to models with JSON_DATA_FIELDS are nested
+        see nets_core.json_compiler.resolve_field_spec
+        """
+        return resolve_field_spec(self.__class__, fields)
+
+    def to_json(self, fields: tuple = None, raw: bool = False, cached: bool = None):
+        """
+        raw: if True return nets_core.responses.RawJSON with the json text
+        produced by the database, see success_response
+        cached: False skips the json cache, only models with JSON_CACHE (or
+        NETS_CORE_JSON_CACHE) are cached as only their rows are invalidated,
+        see nets_core.serializers.cached_model_json
+        """
+        # fields are resolved once per (model, fields), see nets_core.serializers.get_json_spec
+        from nets_core.serializers import (
+            NetsCoreModelToJson,
+            cached_model_json,
+            json_cache_enabled,
+        )
+
+        if cached is not False and json_cache_enabled(self.__class__):
+            return cached_model_json(self, fields, raw=raw)
+        return NetsCoreModelToJson(self, fields).to_json(raw=raw)
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super(NetsCoreBaseModel, cls).from_db(db, field_names, values)
+        instance._nc_snapshot = FieldSnapshot(instance)
+        return instance
+
+    def refresh_from_db(self, using=None, fields=None, *args, **kwargs):
+        # also called by django to load deferred fields on access
+        super(NetsCoreBaseModel, self).refresh_from_db(using, fields, *args, **kwargs)
+        snapshot = getattr(self, "_nc_snapshot", None)
+        if snapshot is None or fields is None:
+            self._nc_snapshot = FieldSnapshot(self)
         else:
-            fields = self.validate_fields(fields)
-        if not isinstance(fields, tuple):
-            raise ValueError(_("Fields must be a tuple"))
-
-        from nets_core.serializers import NetsCoreModelToJson
-
-        return NetsCoreModelToJson(self, fields).to_json()
+            # only fields were reloaded, keep the snapshot of the others
+            self._nc_snapshot = FieldSnapshot(self, set(fields), snapshot)
+
+    def _resolve_deferred_changes(self, changes: list) -> list:
+        # fields deferred at load were set without reading them, their old
+        # values are read from the database in one query
+        deferred = [name for name, old, _new in changes if old is FieldSnapshot.DEFERRED]
+        if not deferred:
+            return changes
+        row = (
+            self.__class__._base_manager.using(self._state.db)
+            .filter(pk=self.pk)
+            .values(*deferred)
+            .first()
+        ) or {}
+        resolved = []
+        for name, old, new in changes:
+            if old is FieldSnapshot.DEFERRED:
+                old = row.get(name)
+                if old == new:
+                    continue
+            resolved.append((name, old, new))
+        return resolved
+
+    def get_changed_fields(self, update_fields=None) -> list:
+        """
+        (name, old, new) of the fields changed since the instance was loaded
+        or saved, empty for instances not loaded from the database
+        """
+        snapshot = getattr(self, "_nc_snapshot", None)
+        if snapshot is None or self._state.adding:
+            return []
+        return self._resolve_deferred_changes(snapshot.changes(self, update_fields))
+
+    @property
+    def field_history(self) -> UpdatedFieldsHistory:
+        """
+        Changes of the instance in the updated_fields dict format, read lazily
+        """
+        return UpdatedFieldsHistory(self)
+
+    def _get_field_changes(self, changes: list) -> list:
+        # FieldChange rows of changes, values as strings
+        content_type = ContentType.objects.get_for_model(self.__class__)
+        untracked = get_untracked_fields(self.__class__)
+        now = timezone.now()
+        rows = []
+        for name, old, new in changes:
+            if name in untracked:
+                continue
+            old_value = None if old is None else str(old)
+            new_value = None if new is None else str(new)
+            if not old_value and not new_value:
+                continue
+            if old_value != new_value:
+                rows.append(
+                    FieldChange(
+                        content_type=content_type,
+                        object_id=str(self.pk),
+                        field=name,
+                        old=old_value,
+                        new=new_value,
+                        created=now,
+                    )
+                )
+        return rows
 
     def save(self, *args, **kwargs):
+        update_fields = kwargs.get("update_fields")
+        if update_fields is not None:
+            update_fields = set(update_fields)
+        snapshot = getattr(self, "_nc_snapshot", None)
+        changes = []
+        if snapshot is not None and not self._state.adding:
+            changes = self._resolve_deferred_changes(snapshot.changes(self, update_fields))
+            if not changes and getattr(self, "SKIP_UNCHANGED_SAVES", SKIP_UNCHANGED_SAVES):
+                return
 
         super(NetsCoreBaseModel, self).save(*args, **kwargs)
+        if changes and getattr(self, "TRACK_FIELD_CHANGES", TRACK_FIELD_CHANGES):
+            # written once per transaction, see nets_core.audit
+            add_field_changes(self._get_field_changes(changes), self._state.db)
+        if snapshot is None:
+            update_fields = None
+        self._nc_snapshot = FieldSnapshot(self, update_fields, snapshot)
 
 
 class OwnedModel(NetsCoreBaseModel):
@@ -159,6 +368,59 @@ class OwnedModel(NetsCoreBaseModel):
         abstract = True
 
 
+class FieldChangeManager(models.Manager):
+
+    def for_instance(self, instance):
+        return self.filter(
+            content_type=ContentType.objects.get_for_model(instance.__class__),
+            object_id=str(instance.pk),
+        )
+
+    def delete_expired(self, days: int = None) -> int:
+        """
+        Delete changes older than days (NETS_CORE_FIELD_CHANGES_RETENTION_DAYS),
+        returns the number of rows deleted
+        """
+        days = FIELD_CHANGES_RETENTION_DAYS if days is None else days
+        if days is None:
+            return 0
+        deleted, _rows = self.filter(
+            created__lt=timezone.now() - timedelta(days=days)
+        ).delete()
+        return deleted
+
+
+class FieldChange(models.Model):
+    """
+    Append only history of the fields changed in NetsCoreBaseModel instances,
+    replaces the updated_fields column, see NetsCoreBaseModel.field_history
+    """
+
+    content_type = models.ForeignKey(ContentType, on_delete=models.CASCADE)
+    object_id = models.CharField(_("Object id"), max_length=64)
+    field = models.CharField(_("Field"), max_length=150)
+    old = models.TextField(_("Old value"), null=True, blank=True)
+    new = models.TextField(_("New value"), null=True, blank=True)
+    created = models.DateTimeField(_("Created"), default=timezone.now)
+
+    objects = FieldChangeManager()
+
+    class Meta:
+        verbose_name = _("Field Change")
+        verbose_name_plural = _("Field Changes")
+        db_table = "nets_core_field_change"
+        indexes = [
+            models.Index(
+                fields=["content_type", "object_id", "created"],
+                name="field_change_object_index",
+            ),
+            models.Index(fields=["created"], name="field_change_created_index"),
+        ]
+
+    def __str__(self):
+        return f"{self.content_type} {self.object_id} {self.field}"
+
+
 class Permission(NetsCoreBaseModel):
     name = models.CharField(_("Name"), max_length=150)
     codename = models.CharField(_("Codename"), max_length=150, unique=True)
@@ -252,6 +514,11 @@ class RolePermission(NetsCoreBaseModel):
         verbose_name = _("Role Permission")
         verbose_name_plural = _("Role Permissions")
         db_table = "nets_core_role_permission"
+        indexes = [
+            models.Index(
+                fields=["role", "permission"], name="role_permission_index"
+            )
+        ]
 
     def __str__(self):
         if self.project:
@@ -285,6 +552,12 @@ class UserRole(NetsCoreBaseModel):
         verbose_name = _("User Role")
         verbose_name_plural = _("User Roles")
         db_table = "nets_core_user_role"
+        indexes = [
+            models.Index(
+                fields=["user", "project_content_type", "project_id"],
+                name="user_role_project_index",
+            )
+        ]
 
     def __str__(self):
         if self.project:
@@ -313,17 +586,44 @@ class VerificationCode(OwnedModel):
 
     class Meta:
         db_table = "nets_core_verification_code"
+        indexes = [
+            models.Index(
+                fields=["user", "-created"], name="verification_code_user_index"
+            )
+        ]
 
-    def get_token_cache_key(self):
+    @staticmethod
+    def get_cache_key(user_pk) -> str:
         token_key_prefix = "NC_T"
         try:
             token_key_prefix = settings.NETS_CORE_VERIFICATION_CODE_CACHE_KEY
         except:
             pass
 
-        return f"{token_key_prefix}{self.user.pk}"
+        return f"{token_key_prefix}{user_pk}"
+
+    def get_token_cache_key(self):
+        return self.get_cache_key(self.user_id)
+
+    def get_validation_cache_key(self):
+        return self.get_validation_key(self.user_id)
+
+    @classmethod
+    def get_validation_key(cls, user_pk) -> str:
+        # {"id", "token", "device"} of the last code of the user, see nets_core.security.authenticate
+        return f"{cls.get_cache_key(user_pk)}_V"
+
+    @classmethod
+    def get_used_key(cls, user_pk, pk) -> str:
+        # set once when the code is used
+        return f"{cls.get_cache_key(user_pk)}_U{pk}"
 
     def save(self, *args, **kwargs):
+        if not self._state.adding and self.token:
+            # token is generated once, later saves (verified) keep it
+            super(VerificationCode, self).save(*args, **kwargs)
+            return
+
         token = 123456
         if hasattr(settings, "NETS_CORE_DEBUG_VERIFICATION_CODE"):
             token = settings.NETS_CORE_DEBUG_VERIFICATION_CODE
@@ -357,20 +657,39 @@ class VerificationCode(OwnedModel):
         if  hasattr(settings, "NETS_CORE_EMAIL_DEBUG_ENABLED"):
             email_enabled = settings.NETS_CORE_EMAIL_DEBUG_ENABLED
 
+        new_token = True
         if (not settings.DEBUG or email_enabled) and not is_tester :
             # Check cache if token is present and return the same token
             token = cache.get(cache_token_key)
-            if not token:
+            if token:
+                new_token = False
+            else:
                 # Generate a new numeric token six digits
                 token = generate_int_uuid(6)
 
         # Set token in cache system
         cache.set(cache_token_key, "{}".format(token), token_timeout_seconds)
 
-        # Encrypt the token and send email
-        self.token = make_password(str(token))
+        # Hash the token and send email
+        from nets_core.security import hash_verification_code, reset_verification_code_attempts
+
+        self.token = hash_verification_code(str(token), str(self.user_id))
         super(VerificationCode, self).save(*args, **kwargs)
 
+        if new_token:
+            # attempts of a token reused from cache are kept
+            reset_verification_code_attempts(self.user_id)
+        # validated from cache without reading the table, same expiration as the code
+        cache.set(
+            self.get_validation_cache_key(),
+            {
+                "id": self.pk,
+                "token": self.token,
+                "device": str(self.device.uuid) if self.device_id else None,
+            },
+            token_timeout_seconds,
+        )
+
     def validate(self, token: str = None, device_uuid: str = None):
         if not token or not self.token:
             return False
@@ -384,7 +703,9 @@ class VerificationCode(OwnedModel):
             self.delete()
             return False
 
-        return check_password(token, self.token)
+        from nets_core.security import check_verification_code
+
+        return check_verification_code(str(token), self.token, str(self.user_id))
 
 
 TEMPLATES_USES = (
@@ -1,6 +1,8 @@
 import mimetypes
 from datetime import date, datetime
 import json
+import logging
+from types import MappingProxyType
 import pytz
 from django.conf import settings
 from django.core.exceptions import ValidationError
@@ -11,6 +13,11 @@ from nets_core.utils import local_datetime
 from dateutil.parser import parse
 from django.utils.translation import gettext_lazy as _
 
+builtins_type = type
+
+logger = logging.getLogger(__name__)
+
+
 def is_email(email: str):
     validate_email(email)
     return email.lower()
@@ -25,7 +32,7 @@ def is_datetime(s: str, tz: str = settings.TIME_ZONE):
         try:
             naive = pytz.timezone(tz).localize(naive, is_dst=None)
         except Exception as e:
-            print('timezone error', e)
+            logger.debug(f"timezone {tz} not applied: {e}")
    
     return timezone.localtime(naive)
 
@@ -53,7 +60,7 @@ def is_date(s: str):
             try:
                 d = local_datetime(d)
             except Exception as e:
-                print('e', e)
+                logger.debug(f"date {d} not localized: {e}")
                 
             # d = timezone.localtime(d)
         
@@ -79,6 +86,28 @@ MAP_INSTANCES = {
 }
 
 class RequestParam():
+    """
+    Param spec declared in request_handler(params=[...]).
+    Instances are shared by every request of the decorated view, so they are
+    immutable once built, per request context (project) is passed to get_value.
+    """
+    __slots__ = (
+        'default',
+        'value',
+        'filetypes',
+        'key',
+        'type',
+        'optional',
+        'validate',
+        '_is_bool',
+        '_is_file',
+        '_is_callable',
+        '_is_list',
+        '_is_dict',
+        '_instance_type',
+        '_unknown_type',
+        '_frozen',
+    )
     errors = {
         'required': 'El parámetro {} es obligatorio',
         'invalid_value': 'El valor del parámetro {} no es válido',
@@ -95,9 +124,27 @@ class RequestParam():
         self.type = type
         self.optional = optional
         self.validate = validate
-        self.project = None
 
-        pass
+        # resolve type dispatch once, get_value only executes it
+        self._is_bool = type in ['bool', bool]
+        self._is_file = type == 'file'
+        self._is_callable = isinstance(type, builtins_type) or callable(type)
+        self._is_list = type == list
+        self._is_dict = type == dict
+        self._instance_type = None
+        self._unknown_type = False
+        if isinstance(type, str):
+            if type in MAP_INSTANCES:
+                self._instance_type = MAP_INSTANCES[type]
+            else:
+                self._unknown_type = True
+
+        self._frozen = True
+
+    def __setattr__(self, name, value) -> None:
+        if getattr(self, '_frozen', False):
+            raise AttributeError(f"RequestParam {self.key} is immutable, can not set {name}")
+        object.__setattr__(self, name, value)
     
     def __str__(self) -> str:
         return f'{self.key}, Type: {self.type}, Optional? {self.optional}, default: {self.default}'
@@ -121,11 +168,11 @@ class RequestParam():
             raise ValueError(f"RP file01: {self.errors['required'].format(self.key)} ")
         
         
-    def get_value(self, data):
+    def get_value(self, data, project=None):
         
         v = data.get(self.key, None)
         # Handle boolean values 
-        if self.type in ['bool', bool]:
+        if self._is_bool:
             if not v:
                 return False
             if v in ['true', 'True', '1', 1, True]:
@@ -135,35 +182,34 @@ class RequestParam():
         if v in [0, '0']:
             return 0
         
-        if not v and not self.optional and not self.type in ['bool', bool]:
+        if not v and not self.optional:
             raise ValueError(f"RP value01: {self.errors['required'].format(self.key)} ")
         
         if not v and self.optional:
-            print('param is optional, check default', self.default)
             v = self.default if self.default else None
             return v
 
         if isinstance(v, dict):
-            if not self.type == dict:
+            if not self._is_dict:
                 # Check if value was post as dict from select {value: str, label: str}
                 if 'value' in v:
                     v = v['value']
 
-        if v == None and not self.optional and not self.type in ['bool', bool]:
+        if v == None and not self.optional:
             raise ValueError(f"RP01: {self.errors['required'].format(self.key)}")
 
-        if v == None and not self.type in [bool, 'bool']:
+        if v == None:
             return None
 
-        if isinstance(self.type, type) or callable(self.type):
+        if self._is_callable:
 
             try:
-                if self.type == list and isinstance(v, str):
+                if self._is_list and isinstance(v, str):
                     # Check if value is a list of values
                     # then convert to list
                     v = v.replace('[', '').replace(']', '').replace("'", '').replace('"', '')
                     v = v.split(',')
-                elif self.type == dict and isinstance(v, str):
+                elif self._is_dict and isinstance(v, str):
                     # Check if value is a dict
                     # then convert to dict
                     v = json.loads(v)
@@ -176,28 +222,105 @@ class RequestParam():
                 raise ValueError(
                     f"RP02: {self.errors['invalid_value'].format(self.key)}:  {v} no es {self.type}")
 
-        if isinstance(self.type, str):
-            # Check type by MAP_INSTANCES
-            if not self.type in MAP_INSTANCES:
-                raise KeyError(
-                    f"RP03: {self.errors['invalid_type'].format(self.type)}; {MAP_INSTANCES.keys().__str__()}")
+        if self._unknown_type:
+            raise KeyError(
+                f"RP03: {self.errors['invalid_type'].format(self.type)}; {MAP_INSTANCES.keys().__str__()}")
 
-            instance_type = MAP_INSTANCES[self.type]
+        if self._instance_type is not None:
+            # Check type by MAP_INSTANCES
+            instance_type = self._instance_type
             try:
                 
                 v = instance_type(v)
             except Exception as e:
-                print('call', v, self.type, instance_type)
+                logger.debug(f"{self.key} value not parsed as {self.type}: {e}")
                 raise ValueError(
                     f"RP04: {self.errors['invalid_value'].format(self.key)}: {v} no es {self.type} ")
 
         if self.validate:
-            if self.project:
-                valid = self.validate(v, self.project)
+            if project:
+                valid = self.validate(v, project)
             else:
                 valid = self.validate(v)
             if not valid:
                 raise ValueError(
                     f"RP05: {self.errors['invalid_value'].format(self.key)}: {v} no es {self.type}")
         
-        return v
\ No newline at end of file
+        return v
+
+
+class RequestParamsSchema():
+    """
+    Param spec of a view compiled once when request_handler decorates it.
+    Holds RequestParam instances by key, required keys in declaration order,
+    optional defaults and file params, parse only executes the plan.
+    The schema is read only, parse is reentrant and safe to share between
+    threads and async tasks.
+    """
+    __slots__ = ('params', 'keys', 'required', 'optional_defaults', 'file_keys')
+
+    def __init__(self, params: dict | list = None) -> None:
+        if isinstance(params, RequestParamsSchema):
+            params = params.params
+
+        _params = {}
+        if isinstance(params, list):
+            for p in params:
+                _params[p.key] = p
+        elif params:
+            for key, p in params.items():
+                if not isinstance(p, RequestParam):
+                    # build RequestParam object
+                    p = RequestParam(key, p)
+                _params[key] = p
+
+        self.params = MappingProxyType(_params)
+        self.keys = frozenset(_params)
+        self.required = tuple(k for k, p in _params.items() if not p.optional)
+        self.optional_defaults = MappingProxyType({
+            k: p.default for k, p in _params.items() if p.optional
+        })
+        self.file_keys = frozenset(k for k, p in _params.items() if p._is_file)
+
+    def __str__(self) -> str:
+        return f'RequestParamsSchema: {", ".join(self.params)}'
+
+    def __contains__(self, key) -> bool:
+        return key in self.keys
+
+    def parse_value(self, data, key, project=None, files=None):
+        p = self.params[key]
+        if p._is_file:
+            return p.get_file(files)
+        # project is passed to RequestParam validate function
+        return p.get_value(data, project)
+
+    def parse(self, data, files=None, project=None, keys=None) -> dict:
+        """
+        Parse and validate data with compiled params.
+        Keys not declared are returned as received, if keys is provided
+        keys not declared and not in keys are dropped.
+        Raise ValueError or KeyError if a value is not valid.
+        """
+        parsed_data = {}
+        params = self.params
+        for k in data:
+            if k in params:
+                parsed_data[k] = self.parse_value(data, k, project, files)
+            elif keys is None or k in keys:
+                parsed_data[k] = data[k]
+
+        if files:
+            for k in files:
+                if k in params:
+                    parsed_data[k] = self.parse_value(data, k, project, files)
+
+        return parsed_data
+
+    def missing(self, parsed_data: dict) -> list:
+        # set defaults of optional params and return required params not present
+        for k, default in self.optional_defaults.items():
+            if k not in parsed_data:
+                parsed_data[k] = default
+
+        return [k for k in self.required if k not in parsed_data]
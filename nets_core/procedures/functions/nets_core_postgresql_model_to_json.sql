@@ -98,24 +98,79 @@ END;
 $$ LANGUAGE plpgsql;
 
 
-CREATE OR REPLACE FUNCTION nets_core_postgre_array_model_to_json(table_name text, fields text, object_ids int[])
+-- object_ids was int[] before, drop it to avoid keeping an ambiguous overload
+DROP FUNCTION IF EXISTS nets_core_postgre_array_model_to_json(text, text, int[]);
+-- Usage:
+-- RAW SQL: SELECT nets_core_postgre_array_model_to_json('auth_user', 'id,username', ARRAY(SELECT id FROM auth_user ORDER BY id));
+-- Returns a JSON array ordered as object_ids, an empty array if no object is found
+CREATE OR REPLACE FUNCTION nets_core_postgre_array_model_to_json(table_name text, fields text, object_ids bigint[])
 RETURNS json AS $$
 DECLARE
     _model text;
     _fields text;
-    _object_ids int[];
     _json json;
 BEGIN
     _model := table_name;
-    _fields := fields;
-    _object_ids := object_ids;
     -- enclose fields in double quotes to avoid SQL injection
-    
+    _fields := REPLACE(fields, ',', '",t1."');
+    _fields := format('t1."%s"', _fields);
+
     -- invoke dynamic SQL to convert model to JSON object, each field should be t1."field_name" using t1 as alias for the model
-    fields := REPLACE(fields, ',', '",t1."');
-    fields := format('t1."%s"', fields);
-    EXECUTE format('SELECT json_agg(row_to_json(t)) FROM (SELECT %s FROM %s t1 WHERE id = ANY(%s)) t', _fields, _model, _object_ids) INTO _json;
+    -- object_ids are passed as parameter, unnest WITH ORDINALITY keeps their order
+    EXECUTE format(
+        'SELECT COALESCE(json_agg(row_to_json(t)), ''[]''::json) FROM (SELECT %s FROM unnest($1) WITH ORDINALITY AS ids(id, ord) JOIN %s t1 ON t1.id = ids.id ORDER BY ids.ord) t',
+        _fields,
+        _model
+    ) USING object_ids INTO _json;
     
     RETURN _json;
 END;
 $$ LANGUAGE plpgsql;
+
+
+-- Usage:
+-- RAW SQL: SELECT nets_core_postgre_page_model_to_json('auth_user', 'id,username', ARRAY(SELECT id FROM auth_user ORDER BY id LIMIT 25 OFFSET 25), 2, 25, (SELECT count(*) FROM auth_user));
+-- Returns {"data": [...], "page": 2, "paginated_by": 25, "total": n, "has_more": bool}
+-- object_ids are the ids of the requested page only
+CREATE OR REPLACE FUNCTION nets_core_postgre_page_model_to_json(table_name text, fields text, object_ids bigint[], page integer, paginated_by integer, total bigint)
+RETURNS json AS $$
+BEGIN
+    RETURN json_build_object(
+        'data', nets_core_postgre_array_model_to_json(table_name, fields, object_ids),
+        'page', page,
+        'paginated_by', paginated_by,
+        'total', total,
+        'has_more', total > page::bigint * paginated_by
+    );
+END;
+$$ LANGUAGE plpgsql;
+
+
+-- Usage:
+-- RAW SQL: SELECT nets_core_postgre_keyset_model_to_json('auth_user', 'id,username', ARRAY(SELECT id FROM auth_user WHERE id > 100 ORDER BY id LIMIT 26), 25);
+-- Returns {"data": [...], "cursor": "...", "has_more": bool}
+-- object_ids holds up to page_size + 1 ids in keyset order, the extra id only tells there is a next page.
+-- cursor is url safe base64 of {"pk": last id of the page}, null on the last page
+CREATE OR REPLACE FUNCTION nets_core_postgre_keyset_model_to_json(table_name text, fields text, object_ids bigint[], page_size integer)
+RETURNS json AS $$
+DECLARE
+    _count integer;
+    _ids bigint[];
+    _cursor text;
+BEGIN
+    _count := COALESCE(array_length(object_ids, 1), 0);
+    _ids := object_ids[1:page_size];
+    IF _count > page_size THEN
+        _cursor := rtrim(
+            translate(encode(convert_to(json_build_object('pk', _ids[page_size])::text, 'UTF8'), 'base64'), E'+/\n', '-_'),
+            '='
+        );
+    END IF;
+
+    RETURN json_build_object(
+        'data', nets_core_postgre_array_model_to_json(table_name, fields, _ids),
+        'cursor', _cursor,
+        'has_more', _count > page_size
+    );
+END;
+$$ LANGUAGE plpgsql;
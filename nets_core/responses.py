@@ -2,10 +2,121 @@ import json
 from collections import namedtuple
 from typing import NamedTuple
 
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
 from django.db.models import Model
-from django.http import HttpRequest, JsonResponse
+from django.http import HttpRequest, HttpResponse, JsonResponse, StreamingHttpResponse
 from django.utils.translation import gettext_lazy as _
 
+# JSON encoder used by responses: auto (orjson if installed, or json), orjson,
+# ujson or json. ujson writes Decimal as a number and is only used if set
+JSON_ENCODER = getattr(settings, "NETS_CORE_JSON_ENCODER", "auto")
+
+_django_encoder = DjangoJSONEncoder()
+
+
+def _default(o):
+    # types not supported natively by the backend: lazy translations,
+    # datetime, Decimal, UUID, etc. encoded as django does
+    return _django_encoder.default(o)
+
+
+def _json_dumps(data) -> bytes:
+    return json.dumps(data, cls=DjangoJSONEncoder).encode("utf-8")
+
+
+def _get_dumps(backend: str):
+    if backend in ("auto", "orjson"):
+        try:
+            import orjson
+
+            # datetimes are passed to _default to keep django format
+            options = orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_NON_STR_KEYS
+
+            def _orjson_dumps(data) -> bytes:
+                try:
+                    return orjson.dumps(data, default=_default, option=options)
+                except TypeError:
+                    # ints wider than 64 bits, json encodes them
+                    return _json_dumps(data)
+
+            return _orjson_dumps
+        except ImportError:
+            if backend == "orjson":
+                raise
+
+    if backend == "ujson":
+        import ujson
+
+        def _ujson_dumps(data) -> bytes:
+            return ujson.dumps(
+                data, default=_default, escape_forward_slashes=False
+            ).encode("utf-8")
+
+        return _ujson_dumps
+
+    return _json_dumps
+
+
+dumps = _get_dumps(JSON_ENCODER)
+
+
+class RawJSON():
+    """
+    JSON text already encoded, e.g. produced by PostgreSQL.
+    Response helpers write it as is, without decoding and encoding it again.
+    """
+
+    __slots__ = ("content",)
+
+    def __init__(self, content: str | bytes):
+        if isinstance(content, str):
+            content = content.encode("utf-8")
+        self.content = content
+
+    def __bytes__(self) -> bytes:
+        return self.content
+
+    def __str__(self) -> str:
+        return self.content.decode("utf-8")
+
+    def __bool__(self) -> bool:
+        return bool(self.content)
+
+    def loads(self):
+        return json.loads(self.content)
+
+
+def encode_json(data) -> bytes:
+    """
+    Encode data with the configured backend.
+    RawJSON values of a top level dict are spliced verbatim.
+    """
+    if isinstance(data, RawJSON):
+        return data.content
+
+    if isinstance(data, dict) and any(isinstance(v, RawJSON) for v in data.values()):
+        items = []
+        for key, value in data.items():
+            if isinstance(value, RawJSON):
+                items.append(dumps(str(key)) + b":" + value.content)
+            else:
+                items.append(dumps(str(key)) + b":" + dumps(value))
+        return b"{" + b",".join(items) + b"}"
+
+    return dumps(data)
+
+
+class NetsCoreJsonResponse(JsonResponse):
+    """
+    JsonResponse encoded with the backend set in NETS_CORE_JSON_ENCODER.
+    Subclass of JsonResponse to keep isinstance checks of request handlers.
+    """
+
+    def __init__(self, data, status: int = 200, **kwargs):
+        kwargs.setdefault("content_type", "application/json")
+        HttpResponse.__init__(self, content=encode_json(data), status=status, **kwargs)
+
 
 def success_response(data, extra=None):
     """
@@ -13,21 +124,64 @@ def success_response(data, extra=None):
     to json response
     """
     if extra:
-        return JsonResponse({"res": 1, "data": data, "extra": extra})
+        return NetsCoreJsonResponse({"res": 1, "data": data, "extra": extra})
 
-    return JsonResponse({"res": 1, "data": data})
+    return NetsCoreJsonResponse({"res": 1, "data": data})
 
 
 def permission_denied():
-    return JsonResponse({"res": 0, "message": _("permission denied")}, status=403)
+    return NetsCoreJsonResponse({"res": 0, "message": _("permission denied")}, status=403)
 
 
 def notfound_response():
-    return JsonResponse({"res": 0, "message": _("not found")}, status=404)
+    return NetsCoreJsonResponse({"res": 0, "message": _("not found")}, status=404)
 
 
 def error_response(message: str = None, error: int = 400, data=None):
-    return JsonResponse(
+    return NetsCoreJsonResponse(
         {"res": 0, "message": message if message else _("Bad request"), "data": data},
         status=error,
     )
+
+
+def streaming_response(
+    queryset,
+    fields: tuple = None,
+    ndjson: bool = False,
+    chunk_size: int = 2000,
+    using: str = "default",
+    filename: str = None,
+):
+    """
+    Stream a queryset as a JSON array, or NDJSON (one object per line) if ndjson,
+    for exports of large querysets. Rows are read with a server side cursor in
+    chunks of chunk_size and written as encoded by PostgreSQL.
+
+    Parameters:
+        queryset: queryset to export, fields default to model JSON_DATA_FIELDS
+        filename: if set the response is sent as attachment
+    """
+    from nets_core.serializers import NetsCoreQuerySetToJson
+
+    # fields are validated and the query compiled before the response starts
+    chunks = NetsCoreQuerySetToJson(queryset, fields, using).iter_json(chunk_size)
+
+    def _json_array():
+        yield b"["
+        separator = b""
+        for rows in chunks:
+            yield separator + ",".join(rows).encode("utf-8")
+            separator = b","
+        yield b"]"
+
+    def _ndjson():
+        for rows in chunks:
+            yield ("\n".join(rows) + "\n").encode("utf-8")
+
+    response = StreamingHttpResponse(
+        _ndjson() if ndjson else _json_array(),
+        content_type="application/x-ndjson" if ndjson else "application/json",
+    )
+    if filename:
+        response["Content-Disposition"] = f'attachment; filename="{filename}"'
+    return response
@@ -1,11 +1,14 @@
 import hmac
 import hashlib
+import logging
+import time
 from django.apps import apps
 from django.conf import settings
 from django.utils.translation import gettext_lazy as _
 from django.utils import timezone
 from django.contrib.contenttypes.models import ContentType
 from django.core.cache import cache
+from django.db import transaction
 from django.contrib.auth.hashers import check_password, make_password
 from base64 import b64decode, b64encode
 from oauthlib import common
@@ -13,6 +16,49 @@ from oauth2_provider.models import Application, AccessToken, RefreshToken
 
 # TODO: create middleware to restring token_access with device_uuid
 
+logger = logging.getLogger(__name__)
+
+token_timeout_seconds = getattr(settings, "NETS_CORE_VERIFICATION_CODE_EXPIRE_SECONDS", 15 * 60)
+# used codes are marked verified by the mark_verification_code_verified celery task,
+# otherwise when the request transaction commits
+VERIFICATION_CODE_ASYNC = getattr(settings, "NETS_CORE_VERIFICATION_CODE_ASYNC", False)
+# failed attempts allowed per code, a new token resets them (not codes reusing
+# the cached token)
+VERIFICATION_CODE_MAX_ATTEMPTS = getattr(settings, "NETS_CORE_VERIFICATION_CODE_MAX_ATTEMPTS", 5)
+
+# prefix of verification codes hashed by hash_verification_code,
+# other values are django password hashes (make_password) of older codes
+VERIFICATION_CODE_HASH_PREFIX = "nc_hmac$"
+
+
+def _secure_hmac(value: str) -> str:
+    # HMAC-SHA256 with settings.NETS_CORE_SECURE_CACHE_KEY or settings.SECRET_KEY
+    secret_key = getattr(settings, "NETS_CORE_SECURE_CACHE_KEY", settings.SECRET_KEY)
+    return hmac.new(
+        secret_key.encode("utf-8"), value.encode("utf-8"), hashlib.sha256
+    ).hexdigest()
+
+
+def hash_verification_code(code: str, salt: str = "") -> str:
+    """
+    Keyed hash of a short lived verification code, salt binds it to the user.
+    Codes expire in minutes and attempts are limited, a password hasher
+    (hundreds of thousands of iterations) is not required.
+    """
+    return f"{VERIFICATION_CODE_HASH_PREFIX}{_secure_hmac(f'{salt}:{code}')}"
+
+
+def check_verification_code(code: str, encoded: str, salt: str = "") -> bool:
+    """
+    Constant time check of code against hash_verification_code,
+    hashes made with make_password by older versions are checked with check_password
+    """
+    if not code or not encoded:
+        return False
+    if not encoded.startswith(VERIFICATION_CODE_HASH_PREFIX):
+        return check_password(code, encoded)
+    return hmac.compare_digest(hash_verification_code(code, salt), encoded)
+
 
 def validate_verification_code(user, code: str) -> bool:
     """
@@ -29,12 +75,85 @@ def validate_verification_code(user, code: str) -> bool:
         from nets_core.models import VerificationCode
     except:
         raise Exception(_("nets_core.models not found"))
-    vcode = VerificationCode.objects.filter(user=user).last()
+    valid = check_cached_verification_code(user, code)
+    if valid is not None:
+        return bool(valid)
+    vcode = VerificationCode.objects.filter(user=user).order_by("-created").first()
     if not vcode:
         return False
     return vcode.validate(code)
 
 
+def check_cached_verification_code(user, code: str, device_uuid: str = None):
+    """
+    Validate the last verification code of user from cache, without reading
+    the table. Returns the code id if valid, False if not valid or already
+    used, None if not cached (check VerificationCode).
+    """
+    from nets_core.models import VerificationCode
+
+    record = cache.get(VerificationCode.get_validation_key(user.pk))
+    if not record:
+        return None
+    if cache.get(VerificationCode.get_used_key(user.pk, record["id"])):
+        return False
+    if record["device"] and (not device_uuid or str(device_uuid) != record["device"]):
+        return False
+    if not check_verification_code(str(code), record["token"], str(user.pk)):
+        return False
+    return record["id"]
+
+
+def _incr(key: str, timeout: int) -> int:
+    # atomic counter, created with timeout on first use
+    cache.add(key, 0, timeout)
+    try:
+        return cache.incr(key)
+    except ValueError:
+        # expired between add and incr
+        cache.set(key, 1, timeout)
+        return 1
+
+
+def _verification_attempts_key(user_pk) -> str:
+    return SecureCache().secure_key(f"NC_VCA_{user_pk}")
+
+
+def reset_verification_code_attempts(user_pk):
+    # called when a code with a new token is created
+    cache.delete(_verification_attempts_key(user_pk))
+
+
+def mark_verification_code_verified(vcode_id: int):
+    """
+    Set verified and device last_login of a used code. The code is loaded and
+    saved so post_save listeners (new login email and notification) run.
+    """
+    from nets_core.models import VerificationCode
+
+    vcode = VerificationCode.objects.select_related("device").filter(pk=vcode_id).first()
+    if not vcode or vcode.verified:
+        return
+    if vcode.device:
+        vcode.device.last_login = timezone.now()
+        vcode.device.save()
+    vcode.verified = True
+    vcode.save()
+
+
+def _verify_code_later(vcode_id: int):
+    # the response does not wait for the verified flag and the listeners
+    if VERIFICATION_CODE_ASYNC:
+        try:
+            from nets_core.tasks import mark_verification_code_verified as mark_verified_task
+
+            mark_verified_task.delay(vcode_id)
+            return
+        except Exception as e:
+            logger.warning(f"Verification code {vcode_id} marked synchronously: {e}")
+    transaction.on_commit(lambda: mark_verification_code_verified(vcode_id))
+
+
 def authenticate(
     user, code: str, client_id: str, client_secret: str, device_uuid: str = None
 ) -> dict:
@@ -74,20 +193,33 @@ def authenticate(
     except Application.DoesNotExist:
         raise Exception(_("Invalid client_id"))
 
-    vcode = VerificationCode.objects.filter(user=user).order_by("-created").first()
-    if not vcode:
-        raise Exception(_("User has not requested verification code"))
+    # every attempt is counted before the code is checked, concurrent guesses
+    # get distinct counts from incr and can not pass the limit
+    attempts_key = _verification_attempts_key(user.pk)
+    if _incr(attempts_key, token_timeout_seconds) > VERIFICATION_CODE_MAX_ATTEMPTS:
+        raise Exception(_("Too many attempts, request a new code"))
+
+    vcode_id = check_cached_verification_code(user, code, device_uuid)
+    if vcode_id is None:
+        # not cached (cache cleared), read the last code
+        vcode = VerificationCode.objects.filter(user=user).order_by("-created").first()
+        if not vcode:
+            raise Exception(_("User has not requested verification code"))
+
+        vcode_id = vcode.pk if vcode.validate(code, device_uuid=device_uuid) else False
 
-    if not vcode.validate(code, device_uuid=device_uuid):
+    if vcode_id is False:
         raise Exception(_("Invalid code for this user and device"))
 
-    if vcode.device:
-        vcode.device.last_login = timezone.now()
-        vcode.device.save()
+    # codes are used once, add is atomic for concurrent requests
+    if not cache.add(
+        VerificationCode.get_used_key(user.pk, vcode_id), True, token_timeout_seconds
+    ):
+        raise Exception(_("Invalid code for this user and device"))
 
+    cache.delete(attempts_key)
     # update code as verified
-    vcode.verified = True
-    vcode.save()
+    _verify_code_later(vcode_id)
 
     if hasattr(user, "email_verified") and not user.email_verified:
         user.email_verified = True
@@ -310,13 +442,7 @@ class SecureCache:
 
     def secure_value(self, value: str) -> str: 
         # use settings.NETS_CORE_SECURE_CACHE_KEY or settings.SECRET_KEY as secret key
-        secret_key = getattr(
-            settings, "NETS_CORE_SECURE_CACHE_KEY", settings.SECRET_KEY
-        )
-        value = hmac.new(
-            secret_key.encode("utf-8"), value.encode("utf-8"), hashlib.sha256
-        ).hexdigest()
-        return value
+        return _secure_hmac(value)
 
     def set(self, key: str, value: str, expiration: int) -> None:
         self.key = self.secure_key(key)
@@ -358,4 +484,60 @@ class SecureCache:
         return len(self.key)
 
     def validate(self, key: str, value: str) -> bool:
-        return self.secure_value(value) == self.get(key)
+        stored = self.get(key)
+        if not stored:
+            return False
+        # constant time, the stored value is not leaked by timing
+        return hmac.compare_digest(self.secure_value(value), str(stored))
+
+
+class RateLimit():
+    """
+    Sliding window rate limit: at most limit requests every window seconds per key.
+
+    by: "ip" (get_remote_ip) or a key of the request data, dotted for nested
+    values ("username", "device.uuid"). Values are hashed in SecureCache keys,
+    they are not stored in cache. Requests without the value are not limited.
+
+    The window slides over two fixed windows: the count of the previous one
+    weighted by the time left plus the current one, incremented atomically.
+    See request_handler(rate_limit=...).
+    """
+
+    __slots__ = ("limit", "window", "by", "path")
+
+    def __init__(self, limit: int, window: int = 60, by: str = "ip"):
+        if limit < 1 or window < 1:
+            raise ValueError(_("Rate limit and window must be positive"))
+        self.limit = limit
+        self.window = window
+        self.by = by
+        self.path = tuple(by.split("."))
+
+    def get_value(self, data):
+        value = data
+        for key in self.path:
+            if not hasattr(value, "get"):
+                return None
+            value = value.get(key)
+        if value is None or value == "":
+            return None
+        # same counter for User@mail.com and user@mail.com
+        return str(value).strip().lower()
+
+    def hit(self, value, scope: str = "") -> bool:
+        """
+        Count a request of value, False if the limit is exceeded
+        """
+        if value is None:
+            return True
+        now = time.time()
+        window = int(now // self.window)
+        key = SecureCache().secure_key(f"NC_RL_{scope}_{self.by}_{value}")
+        previous = cache.get(f"{key}_{window - 1}") or 0
+        current = _incr(f"{key}_{window}", self.window * 2)
+        elapsed = (now % self.window) / self.window
+        return previous * (1 - elapsed) + current <= self.limit
+
+    def __repr__(self) -> str:
+        return f"RateLimit({self.limit}, {self.window}, {self.by!r})"
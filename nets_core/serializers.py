@@ -1,36 +1,279 @@
+import base64
+import hashlib
 import json
+import logging
+import threading
+import time
+import warnings
+from functools import lru_cache
+from operator import attrgetter
+
+from django.apps import apps
 from django.db import models, connections
+from django.db.models import Prefetch, prefetch_related_objects
 from django.conf import settings
+from django.core.cache import cache
+from django.core.exceptions import EmptyResultSet
 from django.utils.translation import gettext_lazy as _
 
-GLOBAL_PROTECTED_FIELDS = [
-    'password',    
-    'superuser',    
-]
+from nets_core.json_compiler import (
+    DIALECTS,
+    JSON_MAX_DEPTH,
+    _get_concrete_field,
+    _get_relation,
+    get_json_plan,
+    get_protected_fields,
+    is_protected_field,
+    resolve_field_spec,
+    split_field_spec,
+    use_json_plan,
+)
+from nets_core.responses import RawJSON, encode_json
+
+# upper bound of paginated_by / limit requested by clients
+MAX_PAGINATED_BY = getattr(settings, "NETS_CORE_MAX_PAGINATED_BY", 100)
+# resolved fields kept per (model, fields, database)
+FIELD_SPEC_CACHE_SIZE = getattr(settings, "NETS_CORE_FIELD_SPEC_CACHE_SIZE", 1024)
+# json of NetsCoreBaseModel.to_json kept in django cache, opt-in for all models
+# or per model with JSON_CACHE = True. Entries are versioned per row, saves and
+# deletes bump the version (see nets_core.listeners)
+JSON_CACHE = getattr(settings, "NETS_CORE_JSON_CACHE", False)
+JSON_CACHE_TIMEOUT = getattr(settings, "NETS_CORE_JSON_CACHE_TIMEOUT", 5 * 60)
+JSON_CACHE_KEY_PREFIX = "NC_JSON"
+
+_json_cache_stats = {"hits": 0, "misses": 0}
+_json_cache_stats_lock = threading.Lock()
+
+logger = logging.getLogger(__name__)
+
+
+def get_model_json_fields(model, fields=None) -> tuple:
+    """
+    Fields requested for model: fields, JSON_DATA_FIELDS if not given, or
+    "__all__" for every column plus relations to models with JSON_DATA_FIELDS
+    """
+    if not fields:
+        # check if model has JSON_DATA_FIELDS attribute
+        if not getattr(model, "JSON_DATA_FIELDS", None):
+            raise ValueError(_("Fields must be provided"))
+        try:
+            return tuple(model.JSON_DATA_FIELDS)
+        except Exception as e:
+            raise ValueError(_("Fields must be a tuple or list"))
+
+    if fields == "__all__":
+        # columns from db table schema, user should be user_id
+        related_fields = tuple(
+            field.name
+            for field in model._meta.get_fields()
+            if field.is_relation and getattr(field.related_model, "JSON_DATA_FIELDS", None)
+        )
+        return tuple(field.column for field in model._meta.concrete_fields) + related_fields
+
+    if not isinstance(fields, (tuple, list)):
+        raise ValueError(_("Fields must be a tuple or list"))
+    return tuple(fields)
+
+
+class JsonSpec():
+    """
+    fields: field spec of the model to json functions (comma separated)
+    plan: compiled JsonPlan, None if serialized by the plpgsql functions
+    key: hash of fields, part of json cache keys
+    nested: True if fields include nested relations, their rows are not
+        versioned by the json cache
+    """
+
+    __slots__ = ("fields", "plan", "key", "nested")
+
+    def __init__(self, fields: str, plan):
+        self.fields = fields
+        self.plan = plan
+        self.key = hashlib.blake2b(fields.encode("utf-8"), digest_size=8).hexdigest()
+        self.nested = any(":" in field for field in split_field_spec(fields))
+
+
+@lru_cache(maxsize=FIELD_SPEC_CACHE_SIZE)
+def _get_json_spec(model, fields, using: str) -> JsonSpec:
+    # protected fields are removed by resolve_field_spec
+    fields = ",".join(resolve_field_spec(model, get_model_json_fields(model, fields)))
+    vendor = connections[using].vendor
+    plan = get_json_plan(model, fields, vendor) if use_json_plan(fields, vendor) else None
+    return JsonSpec(fields, plan)
+
+
+def get_json_spec(model, fields: tuple = None, using: str = "default") -> JsonSpec:
+    """
+    Resolved fields of model (JSON_DATA_FIELDS if not given, nested relations,
+    protected fields removed) and its compiled plan, memoised per
+    (model, fields, using). Serializers only execute the query.
+    """
+    if isinstance(fields, list):
+        # lists are not hashable, same spec as the tuple
+        fields = tuple(fields)
+    elif fields and not isinstance(fields, (tuple, str)):
+        raise ValueError(_("Fields must be a tuple or list"))
+    return _get_json_spec(model, fields or None, using)
+
+
+def warm_json_specs():
+    """
+    Resolve protected fields of every installed model and JSON_DATA_FIELDS
+    for every database, called from AppConfig.ready()
+    """
+    for model in apps.get_models():
+        get_protected_fields(model)
+        if not getattr(model, "JSON_DATA_FIELDS", None):
+            continue
+        for using in connections.databases:
+            try:
+                get_json_spec(model, None, using)
+            except Exception as e:
+                # to_json raises the same error when called
+                logger.debug(f"JSON_DATA_FIELDS of {model.__name__} not resolved: {e}")
+
+
+def json_cache_enabled(model) -> bool:
+    return getattr(model, "JSON_CACHE", JSON_CACHE)
+
+
+def _json_cache_version_key(model, pk) -> str:
+    return f"{JSON_CACHE_KEY_PREFIX}_V_{model._meta.db_table}_{pk}"
+
+
+def get_json_cache_version(model, pk) -> int:
+    """
+    Current json cache version of a row, time based as permissions version
+    so a version evicted from cache never collides with an older one
+    """
+    key = _json_cache_version_key(model, pk)
+    version = cache.get(key)
+    if version is None:
+        cache.add(key, int(time.time() * 1000), None)
+        version = cache.get(key, int(time.time() * 1000))
+    return version
+
+
+def bump_json_cache_version(model, pk):
+    """
+    Invalidate every cached json of a row, called on post_save and post_delete.
+    Without a version nothing is cached, the next version is time based.
+    """
+    try:
+        return cache.incr(_json_cache_version_key(model, pk))
+    except ValueError:
+        return None
+
+
+def get_json_cache_stats() -> dict:
+    """
+    Hits and misses of the json cache in this process
+    """
+    with _json_cache_stats_lock:
+        stats = dict(_json_cache_stats)
+    total = stats["hits"] + stats["misses"]
+    stats["hit_ratio"] = stats["hits"] / total if total else 0.0
+    return stats
+
+
+def cached_model_json(instance, fields: tuple = None, raw: bool = False, using: str = "default"):
+    """
+    NetsCoreModelToJson(instance, fields).to_json(raw) read from django cache,
+    keyed by (table, pk, version, fields hash, updated). A hit skips the query
+    and the json construction, raw returns the cached text as is.
+    Fields with nested relations are not cached, only the version of the row
+    is bumped on save so changes of related rows would not be seen.
+    """
+    model = instance.__class__
+    spec = get_json_spec(model, fields, using)
+    if spec.nested:
+        return NetsCoreModelToJson(instance, fields, using).to_json(raw=raw)
+    updated = getattr(instance, "updated", None)
+    key = (
+        f"{JSON_CACHE_KEY_PREFIX}_{model._meta.db_table}_{instance.pk}"
+        f"_{get_json_cache_version(model, instance.pk)}_{spec.key}_{using}"
+        f"_{updated.timestamp() if updated else 0}"
+    )
+    content = cache.get(key)
+    if content is None:
+        with _json_cache_stats_lock:
+            _json_cache_stats["misses"] += 1
+        data = NetsCoreModelToJson(instance, fields, using).to_json(raw=True)
+        if data is None:
+            return None
+        content = bytes(data)
+        cache.set(key, content, JSON_CACHE_TIMEOUT)
+    else:
+        with _json_cache_stats_lock:
+            _json_cache_stats["hits"] += 1
+
+    if raw:
+        return RawJSON(content)
+    return json.loads(content)
+
+
+def _positive_int(value, name: str) -> int:
+    try:
+        value = int(value)
+    except (TypeError, ValueError):
+        raise ValueError(_("%(name)s must be an integer") % {"name": name})
+    if value < 1:
+        raise ValueError(_("%(name)s must be greater than 0") % {"name": name})
+    return value
+
+
+def encode_cursor(pk: int) -> str:
+    """
+    Opaque cursor as produced by nets_core_postgre_keyset_model_to_json,
+    url safe base64 of {"pk": pk} without padding
+    """
+    payload = json.dumps({"pk": pk}).encode("utf-8")
+    return base64.urlsafe_b64encode(payload).decode("ascii").rstrip("=")
+
+
+def decode_cursor(cursor: str) -> int:
+    try:
+        payload = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        return int(json.loads(payload)["pk"])
+    except (TypeError, ValueError, KeyError, IndexError):
+        # binascii.Error, UnicodeDecodeError and JSONDecodeError are ValueError
+        raise ValueError(_("Invalid cursor"))
+
+
+def _cursor_sql(pk_sql: str) -> str:
+    # same cursor as nets_core_postgre_keyset_model_to_json, used by the compiled engine
+    return (
+        f"rtrim(translate(encode(convert_to(json_build_object('pk', {pk_sql})::text, 'UTF8'), "
+        r"'base64'), E'+/\n', '-_'), '=')"
+    )
+
+
+def _sql_literal(value) -> str:
+    # table, fields and pk written in the SQL text of returning_query
+    if value is None:
+        return "NULL"
+    if isinstance(value, int) and not isinstance(value, bool):
+        return str(value)
+    return "'%s'" % str(value).replace("'", "''")
+
+
+def _fetch_json(using: str, sql: str, params, raw: bool):
+    with connections[using].cursor() as cursor:
+        cursor.execute(sql, params)
+        row = cursor.fetchone()
+    if not row or row[0] is None:
+        return None
+    if raw:
+        return RawJSON(row[0])
+    if isinstance(row[0], (str, bytes)):
+        # json text from SQLite and MySQL
+        return json.loads(row[0])
+    return row[0]
 
-if hasattr(settings, "NETS_CORE_GLOBAL_PROTECTED_FIELDS"):
-    GLOBAL_PROTECTED_FIELDS = settings.NETS_CORE_GLOBAL_PROTECTED_FIELDS
 
 class NetsCoreQuerySetToJson():
     
     def __init__(self, queryset: models.QuerySet, fields: tuple = None, using: str = "default"):
-        if not fields:
-            # check if instance has JSON_FIELDS attribute
-            if hasattr(queryset.model, "JSON_DATA_FIELDS"):
-                if not queryset.model.JSON_DATA_FIELDS:
-                    raise ValueError(_("Fields must be provided"))
-                if not isinstance(queryset.model.JSON_DATA_FIELDS, tuple):
-                    try:
-                        fields = tuple(queryset.model.JSON_DATA_FIELDS)
-                    except Exception as e:
-                        raise ValueError(_("Fields must be a tuple or list"))
-            else:
-                
-                raise ValueError(_("Fields must be provided"))
-        
-        if not isinstance(fields, tuple):
-            raise ValueError(_("Fields must be a tuple"))
-        
         if not isinstance(queryset, models.QuerySet):
             raise ValueError(_("Queryset must be a queryset instance or subclass of models.QuerySet"))
         
@@ -41,53 +284,276 @@ class NetsCoreQuerySetToJson():
             raise ValueError(_("Database alias not found"))
         
         self.queryset = queryset
-        if len(queryset) > 1:
-            instance = queryset.first()
-            # check if instance has protected_fields
-            if hasattr(instance, "PROTECTED_FIELDS"):
-                # get the protected fields
-                protected_fields = [f.lower() for f in instance.PROTECTED_FIELDS]
-                # remove the protected fields from the fields
-                self.fields = [field for field in fields if field.lower() not in protected_fields]
-                
-            else:
-                # remove the global protected fields from the fields using contains for each GLOBAL_PROTECTED_FIELDS
-                for field in GLOBAL_PROTECTED_FIELDS:
-                    for i, f in enumerate(fields):
-                        if field.lower() in f.lower():
-                            fields = fields[:i] + fields[i+1:]
-        self.fields = ", ".join(fields)
+        # fields are read from the model class, the queryset is not evaluated
+        spec = get_json_spec(queryset.model, fields, using)
+        self.fields = spec.fields
+        self.plan = spec.plan
         self.using = using
-        
-    def to_json(self):
-        
-        query_ids = ", ".join([str(obj.pk) for obj in self.queryset])
-        with models.connections[self.using].cursor() as cursor:
-            cursor.execute(f"SELECT nets_core_postgre_array_model_to_json('{self.queryset.model._meta.db_table}', '{self.fields}', ARRAY[{query_ids}])")
-            row = cursor.fetchone()
-            return row[0]
+        self.vendor = connections[using].vendor
+
+    def _json_sql(self, plan, expr: str, raw: bool) -> str:
+        # json as text for RawJSON, SQLite and MySQL always return text
+        if raw or self.vendor != "postgresql":
+            return plan.text(expr)
+        return expr
+
+    def to_json(self, raw: bool = False):
+        """
+        Serialize the queryset in one round trip. The queryset SQL selecting pks
+        is sent as ARRAY(subquery) to nets_core_postgre_array_model_to_json,
+        instances are not loaded and ids are not inlined in the SQL text.
+        Ordering of the queryset is kept.
+
+        raw: if True, json is fetched as text (::text cast) and returned as RawJSON,
+        success_response writes it without decoding and encoding it again.
+        """
+        pk_query = self._pk_query(self.queryset)
+        try:
+            pk_sql, pk_params = pk_query.query.get_compiler(using=self.using).as_sql()
+        except EmptyResultSet:
+            # queryset.none() or filter that can not match
+            return RawJSON("[]") if raw else []
+        plan = self.plan
+        if plan:
+            sql = f"SELECT {self._json_sql(plan, plan.array_sql(pk_sql), raw)}"
+            params = pk_params
+        else:
+            cast = "::text" if raw else ""
+            sql = f"SELECT nets_core_postgre_array_model_to_json(%s, %s, ARRAY({pk_sql})){cast}"
+            params = [self.queryset.model._meta.db_table, self.fields, *pk_params]
+        return _fetch_json(self.using, sql, params, raw)
+
+    def iter_json(self, chunk_size: int = 2000):
+        """
+        Iterator of lists of json texts, one object per row, read from a server side
+        cursor chunk_size rows at a time. Rows are encoded by row_to_json and never
+        aggregated, memory used does not depend on the size of the queryset.
+        Ordering of the queryset is kept. See nets_core.responses.streaming_response
+        """
+        plan = self.plan
+        if plan:
+            try:
+                pk_sql, params = (
+                    plan.pk_queryset(self.queryset)
+                    .query.get_compiler(using=self.using)
+                    .as_sql()
+                )
+            except EmptyResultSet:
+                return iter(())
+            return self._iter_rows(plan.rows_sql(pk_sql), params, chunk_size)
+
+        # rows keyed by the names of the field spec as the compiled plans, not
+        # by the columns selected by values()
+        model = self.queryset.model
+        dialect = DIALECTS[connections[self.using].vendor]
+        fields = [_get_concrete_field(model, name) for name in split_field_spec(self.fields)]
+        pairs = [
+            (name, f"t.{dialect.quote(field.column)}")
+            for name, field in zip(split_field_spec(self.fields), fields)
+        ]
+        try:
+            sql, params = (
+                self.queryset.values(*[field.attname for field in fields])
+                .query.get_compiler(using=self.using)
+                .as_sql()
+            )
+        except EmptyResultSet:
+            return iter(())
+        return self._iter_rows(
+            dialect.select_rows(pairs, f"FROM ({sql}) t", text=True), params, chunk_size
+        )
+
+    def _pk_query(self, queryset):
+        # ids of queryset, numbered by the compiled plan outside PostgreSQL
+        if self.plan:
+            return self.plan.pk_queryset(queryset)
+        return queryset.values_list("pk", flat=True)
+
+    def _iter_rows(self, sql: str, params: tuple, chunk_size: int):
+        # chunked_cursor is a named (server side) cursor in PostgreSQL
+        with connections[self.using].chunked_cursor() as cursor:
+            cursor.execute(sql, params)
+            while True:
+                rows = cursor.fetchmany(chunk_size)
+                if not rows:
+                    break
+                yield [row[0] for row in rows]
     
 
+class NetsCoreQuerySetPageToJson(NetsCoreQuerySetToJson):
+    """
+    Serialize one page of the queryset in one round trip:
+    {"data": [...], "page": n, "paginated_by": n, "total": n, "has_more": bool}
+    Only ids of the page are selected (LIMIT / OFFSET), total is counted by the
+    database. Use page and paginated_by from request.params when action is sent.
+    """
+
+    def __init__(
+        self,
+        queryset: models.QuerySet,
+        fields: tuple = None,
+        using: str = "default",
+        page: int = 1,
+        paginated_by: int = 25,
+    ):
+        super().__init__(queryset, fields, using)
+        self.page = _positive_int(page, "page")
+        self.paginated_by = min(_positive_int(paginated_by, "paginated_by"), MAX_PAGINATED_BY)
+
+    def to_json(self, raw: bool = False):
+        offset = (self.page - 1) * self.paginated_by
+        page_query = self._pk_query(self.queryset)[offset:offset + self.paginated_by]
+        count_query = self.queryset.order_by().values("pk")
+        try:
+            page_sql, page_params = page_query.query.get_compiler(using=self.using).as_sql()
+            count_sql, count_params = count_query.query.get_compiler(using=self.using).as_sql()
+        except EmptyResultSet:
+            data = {
+                "data": [],
+                "page": self.page,
+                "paginated_by": self.paginated_by,
+                "total": 0,
+                "has_more": False,
+            }
+            return RawJSON(json.dumps(data)) if raw else data
+
+        plan = self.plan
+        if plan and self.vendor != "postgresql":
+            # envelope is written in python, data and total in one query
+            sql = (
+                f"SELECT {plan.text(plan.array_sql(page_sql))}, "
+                f"(SELECT count(*) FROM ({count_sql}) _count)"
+            )
+            with connections[self.using].cursor() as cursor:
+                cursor.execute(sql, [*page_params, *count_params])
+                data, total = cursor.fetchone()
+            return self._envelope(
+                data,
+                raw,
+                page=self.page,
+                paginated_by=self.paginated_by,
+                total=total,
+                has_more=total > self.page * self.paginated_by,
+            )
+
+        cast = "::text" if raw else ""
+        if plan:
+            sql = (
+                f"SELECT json_build_object('data', {plan.array_sql(page_sql)}, "
+                "'page', %s, 'paginated_by', %s, 'total', _c.total, 'has_more', _c.total > %s)"
+                f"{cast} FROM (SELECT count(*) AS total FROM ({count_sql}) _count) _c"
+            )
+            params = [
+                *page_params,
+                self.page,
+                self.paginated_by,
+                self.page * self.paginated_by,
+                *count_params,
+            ]
+        else:
+            sql = (
+                "SELECT nets_core_postgre_page_model_to_json(%s, %s, "
+                f"ARRAY({page_sql}), %s, %s, (SELECT count(*) FROM ({count_sql}) _count)){cast}"
+            )
+            params = [
+                self.queryset.model._meta.db_table,
+                self.fields,
+                *page_params,
+                self.page,
+                self.paginated_by,
+                *count_params,
+            ]
+        return _fetch_json(self.using, sql, params, raw)
+
+    @staticmethod
+    def _envelope(data: str, raw: bool, **values):
+        if raw:
+            return RawJSON(encode_json({"data": RawJSON(data), **values}))
+        return {"data": json.loads(data), **values}
+
+
+class NetsCoreQuerySetCursorToJson(NetsCoreQuerySetToJson):
+    """
+    Keyset pagination ordered by pk, one round trip per page:
+    {"data": [...], "cursor": "...", "has_more": bool}
+    Pass cursor back to get the next page, cursor is None on the last page.
+    Unlike OFFSET, cost of a page does not grow with its position,
+    ordering of the queryset is replaced by pk (or -pk if descending).
+    """
+
+    def __init__(
+        self,
+        queryset: models.QuerySet,
+        fields: tuple = None,
+        using: str = "default",
+        cursor: str = None,
+        limit: int = 25,
+        descending: bool = False,
+    ):
+        super().__init__(queryset, fields, using)
+        self.limit = min(_positive_int(limit, "limit"), MAX_PAGINATED_BY)
+        self.descending = descending
+        self.after = decode_cursor(cursor) if cursor else None
+
+    def to_json(self, raw: bool = False):
+        queryset = self.queryset
+        if self.after is not None:
+            if self.descending:
+                queryset = queryset.filter(pk__lt=self.after)
+            else:
+                queryset = queryset.filter(pk__gt=self.after)
+        # one extra id tells if there is a next page
+        ids_query = queryset.order_by("-pk" if self.descending else "pk").values_list(
+            "pk", flat=True
+        )[: self.limit + 1]
+        try:
+            ids_sql, ids_params = ids_query.query.get_compiler(using=self.using).as_sql()
+        except EmptyResultSet:
+            data = {"data": [], "cursor": None, "has_more": False}
+            return RawJSON(json.dumps(data)) if raw else data
+
+        plan = self.plan
+        if plan and self.vendor != "postgresql":
+            # page, one extra id for has_more and last id of the page in one query
+            ordered = plan.pk_queryset(queryset.order_by("-pk" if self.descending else "pk"))
+            page_sql, page_params = (
+                ordered[: self.limit].query.get_compiler(using=self.using).as_sql()
+            )
+            last = "MIN" if self.descending else "MAX"
+            sql = (
+                f"SELECT {plan.text(plan.array_sql(page_sql))}, "
+                f"(SELECT count(*) FROM ({ids_sql}) _more), "
+                f"(WITH _last(id, ord) AS ({page_sql}) SELECT {last}(_last.id) FROM _last)"
+            )
+            with connections[self.using].cursor() as cursor:
+                cursor.execute(sql, [*page_params, *ids_params, *page_params])
+                data, fetched, last_pk = cursor.fetchone()
+            has_more = fetched > self.limit
+            return NetsCoreQuerySetPageToJson._envelope(
+                data,
+                raw,
+                cursor=encode_cursor(last_pk) if has_more else None,
+                has_more=has_more,
+            )
+
+        cast = "::text" if raw else ""
+        if plan:
+            sql = (
+                "SELECT json_build_object('data', "
+                f"{plan.array_sql('SELECT unnest(_k.ids[1:%s])')}, "
+                f"'cursor', CASE WHEN cardinality(_k.ids) > %s THEN {_cursor_sql('_k.ids[%s]')} END, "
+                f"'has_more', cardinality(_k.ids) > %s){cast} FROM (SELECT ARRAY({ids_sql}) AS ids) _k"
+            )
+            params = [self.limit, self.limit, self.limit, self.limit, *ids_params]
+        else:
+            sql = f"SELECT nets_core_postgre_keyset_model_to_json(%s, %s, ARRAY({ids_sql}), %s){cast}"
+            params = [self.queryset.model._meta.db_table, self.fields, *ids_params, self.limit]
+        return _fetch_json(self.using, sql, params, raw)
+
+
 class NetsCoreModelToJson():
 
     def __init__(self, instance: models.Model, fields: tuple = None, using: str = "default"):
-        if not fields:
-            # check if instance has JSON_FIELDS attribute
-            if hasattr(instance, "JSON_DATA_FIELDS"):
-                if not instance.JSON_DATA_FIELDS:
-                    raise ValueError(_("Fields must be provided"))
-                if not isinstance(instance.JSON_DATA_FIELDS, tuple):
-                    try:
-                        fields = tuple(instance.JSON_DATA_FIELDS)
-                    except Exception as e:
-                        raise ValueError(_("Fields must be a tuple or list"))
-            else:
-                raise ValueError(_("Fields must be provided"))            
-            
-        
-        if not isinstance(fields, tuple):
-            raise ValueError(_("Fields must be a tuple"))
-        
         if not isinstance(instance, models.Model):
             raise ValueError(_("Instance must be a model instance or subclass of models.Model"))
         
@@ -98,32 +564,250 @@ class NetsCoreModelToJson():
             raise ValueError(_("Database alias not found"))
         
         self.instance = instance
+        spec = get_json_spec(instance.__class__, fields, using)
+        self.fields = spec.fields
+        self.plan = spec.plan
+        self.using = using
+        self.vendor = connections[using].vendor
 
-        # check if instance has protected_fields
-        if hasattr(instance, "PROTECTED_FIELDS"):
-            # get the protected fields
-            protected_fields = [f.lower() for f in instance.PROTECTED_FIELDS]
-            # remove the protected fields from the fields
-            self.fields = [field for field in fields if field.lower() not in protected_fields]
-            
+    def get_query(self, raw: bool = False) -> tuple:
+        """
+        (sql, params) of to_json, values are never formatted in the SQL text
+        """
+        plan = self.plan
+        if plan:
+            t_query = f"SELECT ({plan.single_sql})"
+            if raw or self.vendor != "postgresql":
+                t_query = f"SELECT {plan.text(f'({plan.single_sql})')}"
+            params = [self.instance.pk]
         else:
-            # remove the global protected fields from the fields
-            for field in GLOBAL_PROTECTED_FIELDS:
-                for i, f in enumerate(fields):
-                    if field.lower() in f.lower():
-                        fields = fields[:i] + fields[i+1:]
+            cast = "::text" if raw else ""
+            t_query = f"SELECT nets_core_postgre_model_to_json(%s, %s, %s){cast}"
+            params = [self.instance._meta.db_table, self.fields, self.instance.pk]
+        return t_query, params
 
-        self.fields = ",".join(fields)
-        self.using = using
-        
-    def to_json(self, returning_query: bool = False):
-        with connections[self.using].cursor() as cursor:
-            t_query = f"SELECT nets_core_postgre_model_to_json('{self.instance._meta.db_table}', '{self.fields}', {self.instance.pk})"
-            if returning_query:
-                return t_query
-            cursor.execute(t_query)
-            row = cursor.fetchone()
-            if not row:
-                return None
-            return row[0]
+    def to_json(self, returning_query: bool = False, raw: bool = False):
+        """
+        raw: if True, json is fetched as text (::text cast) and returned as RawJSON,
+        success_response writes it without decoding and encoding it again.
+        returning_query: deprecated, use get_query. If True return the SQL text
+        with its values written as literals instead of executing it.
+        """
+        t_query, params = self.get_query(raw)
+        if returning_query:
+            warnings.warn(
+                "to_json(returning_query=True) is deprecated, use get_query",
+                DeprecationWarning,
+                stacklevel=2,
+            )
+            return t_query % tuple(_sql_literal(value) for value in params)
+        return _fetch_json(self.using, t_query, params, raw)
         
+
+
+def _python_value(field, connection):
+    # values as decoded from the json written by the database
+    if connection.vendor != "postgresql" and isinstance(
+        field, (models.DateTimeField, models.UUIDField)
+    ):
+        # SQLite and MySQL write the text of the column: datetimes in the
+        # database time zone with a space, uuids as 32 hex digits
+        return lambda value: (
+            None if value is None else field.get_db_prep_value(value, connection)
+        )
+    if isinstance(field, (models.DateField, models.TimeField)):
+        return lambda value: None if value is None else value.isoformat()
+    if isinstance(field, models.DecimalField):
+        return lambda value: None if value is None else float(value)
+    if isinstance(field, models.UUIDField):
+        return lambda value: None if value is None else str(value)
+    return None
+
+
+class InstancePlan():
+    """
+    Field spec of a model read from loaded instances, values are formatted as
+    the json of the database of using.
+
+    keys: keys of the json object in spec order
+    getter: attrgetter of the plain fields, one call per instance
+    relations: (key, field, InstancePlan) of nested fields, serialized from the
+    related objects loaded by select_related / prefetch_related, relations that
+    were not loaded are fetched with one query per relation for all instances
+    """
+
+    __slots__ = (
+        "model",
+        "keys",
+        "value_keys",
+        "attnames",
+        "getter",
+        "converters",
+        "relations",
+    )
+
+    def __init__(self, model, specs: list, using: str = "default", depth: int = 0):
+        self.model = model
+        self.keys = []
+        self.value_keys = []
+        self.converters = []
+        self.relations = []
+        attnames = []
+        # prefetching a foreign key reads its column
+        relation_attnames = []
+        for spec in specs:
+            if is_protected_field(model, spec.split(":", 1)[0]):
+                continue
+            if ":" not in spec:
+                field = _get_concrete_field(model, spec)
+                converter = _python_value(field, connections[using])
+                if converter:
+                    self.converters.append((len(attnames), converter))
+                self.keys.append(spec)
+                self.value_keys.append(spec)
+                attnames.append(field.attname)
+                continue
+
+            name, nested = spec.split(":", 1)
+            nested = split_field_spec(nested.strip()[1:-1], ";")
+            if depth >= JSON_MAX_DEPTH:
+                raise ValueError(
+                    _("Nested fields deeper than %(depth)s") % {"depth": JSON_MAX_DEPTH}
+                )
+            field = _get_relation(model, name)
+            related_model = field.related_model
+            if not nested or nested[0] != related_model._meta.db_table:
+                raise ValueError(
+                    _("Table %(table)s is not the table of %(field)s")
+                    % {"table": nested[0] if nested else "", "field": name}
+                )
+            forward = field.concrete and (field.many_to_one or field.one_to_one)
+            if forward:
+                relation_attnames.append(field.attname)
+            key = name[:-3] if forward and name.endswith("_id") else name
+            self.keys.append(key)
+            self.relations.append(
+                (key, field, InstancePlan(related_model, nested[1:], using, depth + 1))
+            )
+
+        self.attnames = frozenset(attnames + relation_attnames)
+        if len(attnames) > 1:
+            self.getter = attrgetter(*attnames)
+        elif attnames:
+            name = attnames[0]
+            self.getter = lambda obj: (getattr(obj, name),)
+        else:
+            self.getter = lambda obj: ()
+
+    def _load_deferred(self, instances: list, using: str):
+        # fields deferred by only() / defer() loaded in one query, not one per instance
+        attnames = self.attnames
+        missing = [obj for obj in instances if not attnames <= obj.__dict__.keys()]
+        if not missing:
+            return
+        names = sorted(attnames - set.intersection(*(set(obj.__dict__) for obj in missing)))
+        rows = (
+            self.model._base_manager.using(using)
+            .filter(pk__in=[obj.pk for obj in missing])
+            .values_list("pk", *names)
+        )
+        values = {row[0]: row[1:] for row in rows}
+        for obj in missing:
+            if obj.pk in values:
+                for name, value in zip(names, values[obj.pk]):
+                    obj.__dict__.setdefault(name, value)
+
+    def serialize(self, instances: list, using: str = "default") -> list:
+        """
+        json objects (dicts) of instances, same keys and values as the SQL serializers
+        """
+        if not instances:
+            return []
+        self._load_deferred(instances, using)
+
+        getter = self.getter
+        converters = self.converters
+        value_keys = self.value_keys
+        keys = self.keys
+        rows = []
+        for obj in instances:
+            values = getter(obj)
+            if converters:
+                values = list(values)
+                for index, converter in converters:
+                    values[index] = converter(values[index])
+            row = dict.fromkeys(keys)
+            row.update(zip(value_keys, values))
+            rows.append(row)
+
+        for key, field, plan in self.relations:
+            if field.many_to_many or field.one_to_many:
+                accessor = field.name if field.concrete else field.get_accessor_name()
+                missing = [
+                    obj
+                    for obj in instances
+                    if accessor not in getattr(obj, "_prefetched_objects_cache", {})
+                ]
+                if missing:
+                    # same order as the SQL serializers
+                    queryset = field.related_model._base_manager.using(using).order_by("pk")
+                    prefetch_related_objects(missing, Prefetch(accessor, queryset=queryset))
+                groups = [list(getattr(obj, accessor).all()) for obj in instances]
+                values = iter(plan.serialize([o for group in groups for o in group], using))
+                for row, group in zip(rows, groups):
+                    row[key] = [next(values) for _ in group]
+                continue
+
+            # foreign key or one to one, the related object or None
+            accessor = field.name if field.concrete else field.get_accessor_name()
+            missing = [obj for obj in instances if not field.is_cached(obj)]
+            if missing:
+                prefetch_related_objects(missing, accessor)
+            related = [field.get_cached_value(obj, None) for obj in instances]
+            values = iter(plan.serialize([o for o in related if o is not None], using))
+            for row, obj in zip(rows, related):
+                row[key] = None if obj is None else next(values)
+        return rows
+
+
+@lru_cache(maxsize=FIELD_SPEC_CACHE_SIZE)
+def get_instance_plan(model, fields: str, using: str = "default") -> InstancePlan:
+    """
+    Cached InstancePlan of model, fields (comma separated field spec) and database
+    """
+    return InstancePlan(model, split_field_spec(fields), using)
+
+
+class NetsCoreInstancesToJson():
+    """
+    Serialize instances already loaded (e.g. a list from a queryset with
+    select_related / prefetch_related) in python, without a query per instance.
+    Same fields, protected fields and output as NetsCoreQuerySetToJson,
+    relations that were not loaded are fetched with one query each.
+    """
+
+    def __init__(self, instances, fields: tuple = None, using: str = "default"):
+        if isinstance(instances, models.Model):
+            instances = [instances]
+        instances = list(instances)
+
+        if not using in connections.databases:
+            raise ValueError(_("Database alias not found"))
+
+        model = instances[0].__class__ if instances else None
+        if any(obj.__class__ is not model for obj in instances):
+            raise ValueError(_("Instances must be of the same model"))
+
+        self.instances = instances
+        self.using = using
+        self.fields = get_json_spec(model, fields, using).fields if model else ""
+        self.plan = get_instance_plan(model, self.fields, using) if model else None
+
+    def to_json(self, raw: bool = False):
+        """
+        List of dicts, raw: if True returns RawJSON with the encoded list
+        """
+        data = self.plan.serialize(self.instances, self.using) if self.plan else []
+        if raw:
+            return RawJSON(encode_json(data))
+        return data
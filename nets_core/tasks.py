@@ -20,6 +20,26 @@ def send_user_devices_notifications(user_id:  int, title: str, message: str, dat
     data = {k: str(v) for k, v in data.items()}
     send_user_device_notification(user, title, message, data, channel)
 
+@shared_task
+def write_field_changes(changes: list, using: str = "default"):
+    # FieldChange rows serialized by nets_core.audit.serialize_field_changes
+    from django.utils.dateparse import parse_datetime
+    from nets_core.models import FieldChange
+
+    FieldChange.objects.using(using).bulk_create(
+        [
+            FieldChange(**dict(change, created=parse_datetime(change["created"])))
+            for change in changes
+        ],
+        batch_size=1000,
+    )
+
+@shared_task
+def mark_verification_code_verified(vcode_id: int):
+    from nets_core.security import mark_verification_code_verified
+
+    mark_verification_code_verified(vcode_id)
+
 @shared_task
 def check_permissions(user_id: int, permission: str):
     user = User.objects.get(id=user_id)
@@ -0,0 +1,1166 @@
+import json
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from io import StringIO
+from unittest import mock
+from decimal import Decimal
+from importlib.util import find_spec
+
+from django.apps.registry import Apps
+from django.contrib.auth import get_user_model
+from django.contrib.auth.hashers import make_password
+from django.contrib.auth.models import AnonymousUser
+from django.core.cache import cache
+from django.core.management import call_command
+from django.db import connection, models, transaction
+from django.db.models.signals import post_delete, post_save
+from django.test import RequestFactory, TestCase, override_settings
+from django.utils import timezone
+from oauth2_provider.models import Application
+
+from nets_core.decorators import request_handler
+from nets_core.handlers import (
+    RequestBodyError,
+    _json_decoder,
+    _json_depth_decoder,
+    get_value_from_data_key,
+    parse_json_body,
+    parse_param,
+)
+from nets_core.models import (
+    FieldChange,
+    NetsCoreBaseModel,
+    Permission,
+    Role,
+    RolePermission,
+    UserDevice,
+    UserRole,
+    VerificationCode,
+)
+from nets_core.params import RequestParam, RequestParamsSchema
+from nets_core.responses import _get_dumps, _json_dumps, streaming_response, success_response
+from nets_core.security import (
+    VERIFICATION_CODE_MAX_ATTEMPTS,
+    RateLimit,
+    authenticate,
+    check_cached_verification_code,
+    check_verification_code,
+    hash_verification_code,
+)
+from nets_core.json_compiler import get_protected_fields
+from nets_core.listeners import connect_json_cache_handlers, invalidate_json_cache_handler
+from nets_core.serializers import (
+    NetsCoreInstancesToJson,
+    NetsCoreModelToJson,
+    NetsCoreQuerySetCursorToJson,
+    NetsCoreQuerySetPageToJson,
+    NetsCoreQuerySetToJson,
+    _get_json_spec,
+    get_json_cache_stats,
+)
+from nets_core.utils import (
+    PERMISSIONS_REGISTRY,
+    PERMISSIONS_VERSION_CACHE_KEY,
+    _get_bulk_user_permissions,
+    _project_key,
+    bump_permissions_version,
+    check_perms_bulk,
+    get_remote_ip,
+    get_user_permissions,
+    register_permissions,
+    sync_permissions_registry,
+)
+from nets_core.views import auth, auth_get_profile, get_auth_rate_limits, update_user
+
+
+# tests do not depend on the cache server of the project settings
+cache_settings = override_settings(
+    CACHES={"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}}
+)
+
+
+def setUpModule():
+    cache_settings.enable()
+
+
+def tearDownModule():
+    cache_settings.disable()
+
+
+class PlainUser():
+    # user models not extending NetsCoreBaseModel define to_json(fields)
+    is_anonymous = False
+    is_superuser = False
+
+    def __init__(self, username):
+        self.username = username
+
+    def save(self):
+        pass
+
+    def to_json(self, fields=None):
+        return {"username": self.username, "fields": fields}
+
+
+class ModelToJsonTestCase(TestCase):
+
+    def setUp(self):
+        self.permission = Permission.objects.create(
+            name="View reports", codename="view_reports"
+        )
+
+    def test_to_json_fields_list(self):
+        data = self.permission.to_json(["name", "codename"])
+        self.assertEqual(data, {"name": "View reports", "codename": "view_reports"})
+        self.assertEqual(data, self.permission.to_json(("name", "codename")))
+
+    def fetch(self, sql, params=None):
+        with connection.cursor() as cursor:
+            cursor.execute(sql, params)
+            data = cursor.fetchone()[0]
+        if isinstance(data, str):
+            data = json.loads(data)
+        return data
+
+    def test_get_query(self):
+        serializer = NetsCoreModelToJson(self.permission, ("name", "codename"))
+        sql, params = serializer.get_query()
+        self.assertEqual(params[-1], self.permission.pk)
+        self.assertEqual(self.fetch(sql, params), serializer.to_json())
+
+    def test_to_json_returning_query(self):
+        # SQL text as returned before get_query
+        serializer = NetsCoreModelToJson(self.permission, ("name", "codename"))
+        with self.assertWarns(DeprecationWarning):
+            sql = serializer.to_json(returning_query=True)
+        self.assertIsInstance(sql, str)
+        self.assertIn(str(self.permission.pk), sql)
+        self.assertEqual(self.fetch(sql), serializer.to_json())
+
+    def test_to_json_json_field(self):
+        # JSONField is an object, not its text, on every database
+        Permission.objects.filter(pk=self.permission.pk).update(
+            updated_fields={"name": [{"old": "View", "new": "View reports"}]}
+        )
+        data = self.permission.to_json(("codename", "updated_fields"))
+        self.assertEqual(
+            data["updated_fields"], {"name": [{"old": "View", "new": "View reports"}]}
+        )
+
+        Permission.objects.filter(pk=self.permission.pk).update(updated_fields=None)
+        self.assertIsNone(self.permission.to_json(("codename", "updated_fields"))["updated_fields"])
+
+
+class JsonCacheTestCase(TestCase):
+
+    fields = ("name", "codename")
+
+    def setUp(self):
+        cache.clear()
+        patcher = mock.patch.object(Permission, "JSON_CACHE", True, create=True)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        connect_json_cache_handlers()
+        uid = f"nets_core_json_cache_{Permission._meta.label_lower}"
+        for signal in (post_save, post_delete):
+            self.addCleanup(
+                signal.disconnect, invalidate_json_cache_handler, sender=Permission, dispatch_uid=uid
+            )
+        self.permission = Permission.objects.create(name="View reports", codename="view_reports")
+
+    def assertStats(self, hits, misses):
+        stats = get_json_cache_stats()
+        self.assertEqual(
+            (stats["hits"] - self.stats["hits"], stats["misses"] - self.stats["misses"]),
+            (hits, misses),
+        )
+
+    def test_hit_and_miss(self):
+        self.stats = get_json_cache_stats()
+        data = self.permission.to_json(self.fields)
+        self.assertStats(0, 1)
+        with self.assertNumQueries(0):
+            self.assertEqual(self.permission.to_json(self.fields), data)
+        self.assertStats(1, 1)
+        self.assertEqual(json.loads(bytes(self.permission.to_json(self.fields, raw=True))), data)
+        # other fields are other entries
+        self.permission.to_json(("codename",))
+        self.assertStats(2, 2)
+
+    def test_invalidated_on_save(self):
+        self.permission.to_json(self.fields)
+        self.permission.name = "Reports"
+        self.permission.save()
+        self.stats = get_json_cache_stats()
+        self.assertEqual(self.permission.to_json(self.fields)["name"], "Reports")
+        self.assertStats(0, 1)
+
+    def test_invalidated_on_delete(self):
+        self.permission.to_json(self.fields)
+        pk = self.permission.pk
+        self.permission.delete()
+        self.permission.pk = pk
+        self.stats = get_json_cache_stats()
+        self.assertIsNone(self.permission.to_json(self.fields))
+        self.assertStats(0, 1)
+
+    def test_nested_relations_not_cached(self):
+        role = Role.objects.create(name="Editor", codename="editor", description="editor")
+        role_permission = RolePermission.objects.create(role=role, permission=self.permission)
+        fields = ("id", "permission")
+        self.stats = get_json_cache_stats()
+        with mock.patch.object(RolePermission, "JSON_CACHE", True, create=True):
+            role_permission.to_json(fields)
+            # a change of the related row is seen at once
+            Permission.objects.filter(pk=self.permission.pk).update(name="Reports")
+            data = role_permission.to_json(fields)
+        self.assertEqual(data["permission"]["name"], "Reports")
+        self.assertStats(0, 0)
+
+
+class ProtectedFieldsTestCase(TestCase):
+
+    def setUp(self):
+        self.user = get_user_model().objects.create_user(
+            "protected", "protected@example.com", password="secret"
+        )
+        self.device = UserDevice.objects.create(
+            user=self.user, name="phone", device_token="token", firebase_token="firebase"
+        )
+        self.user_spec = f"{get_user_model()._meta.db_table};id;username;password;is_superuser"
+
+    def to_json(self, instance, fields):
+        return NetsCoreModelToJson(instance, fields).to_json()
+
+    def test_requested_directly(self):
+        # PROTECTED_FIELDS of the model
+        data = self.to_json(self.device, ("name", "device_token", "Firebase_Token"))
+        self.assertEqual(data, {"name": "phone"})
+        # NETS_CORE_GLOBAL_PROTECTED_FIELDS
+        data = self.to_json(self.user, ("username", "password", "is_superuser"))
+        self.assertEqual(data, {"username": "protected"})
+
+    def test_requested_nested(self):
+        data = self.to_json(self.device, ("name", f"user_id:[{self.user_spec}]"))
+        self.assertEqual(data, {"name": "phone", "user": {"id": self.user.pk, "username": "protected"}})
+
+        spec = "userdevice:[nets_core_user_device;name;device_token;firebase_token]"
+        data = self.to_json(self.user, ("username", spec))
+        self.assertEqual(data, {"username": "protected", "userdevice": [{"name": "phone"}]})
+
+    def test_requested_by_attname(self):
+        with mock.patch.object(UserDevice, "PROTECTED_FIELDS", ["user"]):
+            get_protected_fields.cache_clear()
+            _get_json_spec.cache_clear()
+            self.addCleanup(get_protected_fields.cache_clear)
+            self.addCleanup(_get_json_spec.cache_clear)
+            data = self.to_json(
+                self.device, ("name", "user_id", "User_Id", "user", f"user_id:[{self.user_spec}]")
+            )
+        self.assertEqual(data, {"name": "phone"})
+
+
+class QuerySetToJsonOrderTestCase(TestCase):
+
+    def setUp(self):
+        # pk order is not name order
+        for name in ("b", "d", "a", "c"):
+            Permission.objects.create(name=name, codename=f"tests.order_{name}")
+        self.queryset = Permission.objects.filter(codename__startswith="tests.order_")
+
+    def names(self, data):
+        return [row["name"] for row in data]
+
+    def test_to_json_keeps_ordering(self):
+        for ordering, names in (("name", "abcd"), ("-name", "dcba"), ("pk", "bdac")):
+            data = NetsCoreQuerySetToJson(self.queryset.order_by(ordering), ("name",)).to_json()
+            self.assertEqual(self.names(data), list(names))
+
+    def test_sliced_and_paged(self):
+        queryset = self.queryset.order_by("-name")
+        data = NetsCoreQuerySetToJson(queryset[1:3], ("name",)).to_json()
+        self.assertEqual(self.names(data), ["c", "b"])
+        page = NetsCoreQuerySetPageToJson(queryset, ("name",), page=2, paginated_by=3).to_json()
+        self.assertEqual(self.names(page["data"]), ["a"])
+        self.assertEqual(page["total"], 4)
+
+    def test_iter_json_keeps_ordering(self):
+        chunks = NetsCoreQuerySetToJson(self.queryset.order_by("-name"), ("name",)).iter_json(3)
+        rows = [json.loads(row) for chunk in chunks for row in chunk]
+        self.assertEqual(self.names(rows), ["d", "c", "b", "a"])
+
+
+class PaginatedToJsonTestCase(TestCase):
+
+    def setUp(self):
+        self.permissions = [
+            Permission.objects.create(name=f"p{i}", codename=f"tests.page_{i}") for i in range(5)
+        ]
+        self.queryset = Permission.objects.filter(codename__startswith="tests.page_").order_by("pk")
+
+    def test_page(self):
+        page = NetsCoreQuerySetPageToJson(self.queryset, ("name",), page=2, paginated_by=2).to_json()
+        self.assertEqual(
+            page,
+            {
+                "data": [{"name": "p2"}, {"name": "p3"}],
+                "page": 2,
+                "paginated_by": 2,
+                "total": 5,
+                "has_more": True,
+            },
+        )
+        last = NetsCoreQuerySetPageToJson(self.queryset, ("name",), page=3, paginated_by=2)
+        self.assertFalse(last.to_json()["has_more"])
+        raw = NetsCoreQuerySetPageToJson(self.queryset.none(), ("name",)).to_json(raw=True)
+        self.assertEqual(json.loads(bytes(raw))["data"], [])
+        with self.assertRaises(ValueError):
+            NetsCoreQuerySetPageToJson(self.queryset, ("name",), page=0)
+
+    def test_cursor(self):
+        names = []
+        cursor = None
+        for _ in range(3):
+            page = NetsCoreQuerySetCursorToJson(
+                self.queryset, ("name",), cursor=cursor, limit=2
+            ).to_json()
+            names += [row["name"] for row in page["data"]]
+            cursor = page["cursor"]
+            self.assertEqual(page["has_more"], cursor is not None)
+        self.assertEqual(names, ["p0", "p1", "p2", "p3", "p4"])
+        self.assertIsNone(cursor)
+
+        page = Permission.objects.to_json_cursor(limit=2, fields=("name",), descending=True)
+        self.assertEqual(page["data"][0], {"name": "p4"})
+        with self.assertRaises(ValueError):
+            NetsCoreQuerySetCursorToJson(self.queryset, ("name",), cursor="invalid")
+
+
+class InstancesToJsonTestCase(TestCase):
+
+    def setUp(self):
+        for i in range(3):
+            role = Role.objects.create(name=f"r{i}", codename=f"tests.instances_{i}", description="role")
+            permission = Permission.objects.create(name=f"p{i}", codename=f"tests.instances_{i}")
+            RolePermission.objects.create(role=role, permission=permission, custom_name=f"c{i}")
+        self.queryset = RolePermission.objects.filter(
+            role__codename__startswith="tests.instances_"
+        ).order_by("pk")
+        self.fields = ("id", "custom_name", "created", "role", "permission")
+
+    def test_matches_queryset_to_json(self):
+        expected = NetsCoreQuerySetToJson(self.queryset, self.fields).to_json()
+        instances = list(self.queryset.select_related("role", "permission"))
+        with self.assertNumQueries(0):
+            data = NetsCoreInstancesToJson(instances, self.fields).to_json()
+        self.assertEqual(data, expected)
+        raw = NetsCoreInstancesToJson(instances, self.fields).to_json(raw=True)
+        self.assertEqual(json.loads(bytes(raw)), expected)
+
+    def test_relations_not_loaded(self):
+        expected = NetsCoreQuerySetToJson(self.queryset, self.fields).to_json()
+        instances = list(self.queryset)
+        # one query per relation for all the instances
+        with self.assertNumQueries(2):
+            data = NetsCoreInstancesToJson(instances, self.fields).to_json()
+        self.assertEqual(data, expected)
+
+    def test_uuid_and_datetime(self):
+        user = get_user_model().objects.create_user("instances", "instances@example.com")
+        UserDevice.objects.create(user=user, name="phone", last_login=timezone.now())
+        queryset = UserDevice.objects.filter(user=user)
+        fields = ("uuid", "last_login", "created")
+        self.assertEqual(
+            NetsCoreInstancesToJson(list(queryset), fields).to_json(),
+            NetsCoreQuerySetToJson(queryset, fields).to_json(),
+        )
+
+    def test_single_and_empty(self):
+        instance = self.queryset.first()
+        self.assertEqual(
+            NetsCoreInstancesToJson(instance, ("id", "custom_name")).to_json(),
+            [{"id": instance.pk, "custom_name": instance.custom_name}],
+        )
+        self.assertEqual(NetsCoreInstancesToJson([]).to_json(), [])
+        with self.assertRaises(ValueError):
+            NetsCoreInstancesToJson([instance, instance.role])
+
+
+class StreamingResponseTestCase(TestCase):
+
+    def setUp(self):
+        for i in range(3):
+            Permission.objects.create(name=f"p{i}", codename=f"tests.stream_{i}")
+        self.queryset = Permission.objects.filter(codename__startswith="tests.stream_").order_by("pk")
+        self.expected = [{"name": f"p{i}"} for i in range(3)]
+
+    def test_json_array(self):
+        response = streaming_response(self.queryset, ("name",), chunk_size=2, filename="permissions.json")
+        self.assertEqual(response["Content-Type"], "application/json")
+        self.assertEqual(response["Content-Disposition"], 'attachment; filename="permissions.json"')
+        self.assertEqual(json.loads(b"".join(response.streaming_content)), self.expected)
+
+    def test_ndjson(self):
+        response = streaming_response(self.queryset, ("name",), ndjson=True, chunk_size=2)
+        self.assertEqual(response["Content-Type"], "application/x-ndjson")
+        self.assertFalse(response.has_header("Content-Disposition"))
+        lines = b"".join(response.streaming_content).decode().splitlines()
+        self.assertEqual([json.loads(line) for line in lines], self.expected)
+
+    def test_empty(self):
+        response = streaming_response(self.queryset.none(), ("name",))
+        self.assertEqual(json.loads(b"".join(response.streaming_content)), [])
+
+    def test_keys_without_plan(self):
+        # rows of the plpgsql engine (no compiled plan) are keyed as the compiled plans
+        role = Role.objects.create(name="stream", codename="tests.stream", description="role")
+        for permission in self.queryset:
+            RolePermission.objects.create(role=role, permission=permission, custom_name="c")
+        queryset = RolePermission.objects.filter(role=role).order_by("pk")
+        fields = ("id", "role_id", "permission_id", "custom_name")
+
+        def rows(compiled):
+            with mock.patch("nets_core.serializers.use_json_plan", return_value=compiled):
+                _get_json_spec.cache_clear()
+                try:
+                    chunks = NetsCoreQuerySetToJson(queryset, fields).iter_json()
+                    return [json.loads(row) for chunk in chunks for row in chunk]
+                finally:
+                    _get_json_spec.cache_clear()
+
+        expected = rows(True)
+        self.assertEqual(list(expected[0]), list(fields))
+        self.assertEqual(rows(False), expected)
+
+
+@override_settings(NETS_CORE_PROJECT_MEMBER_MODEL="nets_core.ProjectMember")
+class BulkPermissionsTestCase(TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        # NETS_CORE_PROJECT_MEMBER_MODEL of the tests, roles are the projects,
+        # registered in its own apps registry
+        cls.test_apps = Apps(["nets_core"])
+
+        class ProjectMember(models.Model):
+            user = models.ForeignKey(get_user_model(), on_delete=models.CASCADE, related_name="+")
+            project = models.ForeignKey(Role, on_delete=models.CASCADE, related_name="+")
+
+            class Meta:
+                apps = cls.test_apps
+                app_label = "nets_core"
+                db_table = "nets_core_test_project_member"
+
+        cls.member_model = ProjectMember
+        with connection.schema_editor() as editor:
+            editor.create_model(ProjectMember)
+        cls.apps_patch = mock.patch("nets_core.utils.apps", cls.test_apps)
+        cls.apps_patch.start()
+        super().setUpClass()
+
+    @classmethod
+    def tearDownClass(cls):
+        super().tearDownClass()
+        cls.apps_patch.stop()
+        with connection.schema_editor() as editor:
+            editor.delete_model(cls.member_model)
+
+    def setUp(self):
+        self.user = get_user_model().objects.create_user("member", "member@example.com")
+        # projects of two models with the same pk
+        self.role_project = Role.objects.create(
+            pk=1000, name="Project", codename="project", description="project"
+        )
+        self.permission_project = Permission.objects.create(pk=1000, codename="project")
+        self.member_model.objects.create(user=self.user, project=self.role_project)
+
+        for project, codename in (
+            (self.role_project, "tests.can_edit"),
+            (self.permission_project, "tests.can_delete"),
+        ):
+            role = Role.objects.create(name=codename, codename=codename, description=codename)
+            RolePermission.objects.create(
+                role=role, permission=Permission.objects.create(codename=codename)
+            )
+            UserRole.objects.create(user=self.user, role=role, project=project)
+
+    def test_projects_with_same_pk(self):
+        projects = [self.role_project, self.permission_project]
+        perms = _get_bulk_user_permissions(self.user, projects)
+        self.assertEqual(perms[_project_key(self.role_project)], {"tests.can_edit"})
+        self.assertEqual(perms[_project_key(self.permission_project)], {"tests.can_delete"})
+
+        # only roles are projects of ProjectMember
+        self.assertEqual(
+            check_perms_bulk(self.user, ["tests.can_edit", "tests.can_delete"], projects),
+            [[True, False], [False, False]],
+        )
+
+
+class PermissionsCacheTestCase(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.user = get_user_model().objects.create_user("perms", "perms@example.com")
+        self.role = Role.objects.create(name="editor", codename="editor", description="editor")
+        self.can_edit = Permission.objects.create(codename="tests.can_edit")
+        RolePermission.objects.create(role=self.role, permission=self.can_edit)
+
+    def test_invalidated_by_role_changes(self):
+        self.assertEqual(get_user_permissions(self.user), frozenset())
+        user_role = UserRole.objects.create(user=self.user, role=self.role)
+        self.assertEqual(get_user_permissions(self.user), {"tests.can_edit"})
+
+        can_delete = Permission.objects.create(codename="tests.can_delete")
+        role_permission = RolePermission.objects.create(role=self.role, permission=can_delete)
+        self.assertEqual(get_user_permissions(self.user), {"tests.can_edit", "tests.can_delete"})
+        role_permission.delete()
+        self.assertEqual(get_user_permissions(self.user), {"tests.can_edit"})
+
+        # m2m changes do not send post_save
+        self.role.permissions.add(can_delete)
+        self.assertEqual(get_user_permissions(self.user), {"tests.can_edit", "tests.can_delete"})
+
+        user_role.delete()
+        self.assertEqual(get_user_permissions(self.user), frozenset())
+
+    def test_cache_not_available(self):
+        UserRole.objects.create(user=self.user, role=self.role)
+        self.assertEqual(get_user_permissions(self.user), {"tests.can_edit"})
+        version = cache.get(PERMISSIONS_VERSION_CACHE_KEY)
+        with mock.patch("nets_core.utils.cache.incr", side_effect=ConnectionRefusedError):
+            self.assertIsNone(bump_permissions_version())
+            # the sets compiled in this process are dropped
+            Role.objects.filter(pk=self.role.pk).update(enabled=False)
+            cache.clear()
+            cache.set(PERMISSIONS_VERSION_CACHE_KEY, version, None)
+            self.assertEqual(get_user_permissions(self.user), frozenset())
+
+
+class PermissionsRegistryTestCase(TestCase):
+
+    def tearDown(self):
+        PERMISSIONS_REGISTRY.discard("tests.Can_Export")
+
+    def test_sync_mixed_case_codename(self):
+        # rows written without Permission.save keep their case
+        permission = Permission.objects.create(codename="tests.can_export")
+        Permission.objects.filter(pk=permission.pk).update(codename="tests.Can_Export")
+        register_permissions("tests.Can_Export")
+
+        self.assertEqual(sync_permissions_registry(), [])
+        self.assertEqual(Permission.objects.filter(codename__iexact="tests.can_export").count(), 1)
+
+
+class UserToJsonTestCase(TestCase):
+
+    def get_profile(self, **params):
+        request = RequestFactory().get("/", params)
+        request.user = PlainUser("plain")
+        return json.loads(auth_get_profile(request).content)["data"]
+
+    def test_user_model_without_raw(self):
+        self.assertEqual(
+            self.get_profile(fields="username"), {"username": "plain", "fields": ["username"]}
+        )
+        self.assertEqual(self.get_profile(), {"username": "plain", "fields": None})
+
+
+class UpdateUserTestCase(TestCase):
+
+    def setUp(self):
+        # user model not extending NetsCoreBaseModel, with the updated_fields history
+        self.user = PlainUser("plain")
+        self.user.first_name = "a"
+        self.user.is_staff = False
+        self.user.doc_id = "1"
+        self.user.updated_fields = {}
+
+    def update(self, data):
+        request = RequestFactory().post("/", data, content_type="application/json")
+        request.user = self.user
+        return update_user(request)
+
+    def test_updated_fields(self):
+        self.assertEqual(self.update({"first_name": "b"}).status_code, 200)
+        self.update({"first_name": "c"})
+        self.assertEqual(self.user.first_name, "c")
+        self.assertEqual(
+            [(change["old"], change["new"]) for change in self.user.updated_fields["first_name"]],
+            [("a", "b"), ("b", "c")],
+        )
+
+    def test_prohibited_fields(self):
+        self.update({"first_name": "b", "is_staff": True, "doc_id": "2"})
+        self.assertEqual(self.user.first_name, "b")
+        self.assertFalse(self.user.is_staff)
+        self.assertEqual(self.user.doc_id, "1")
+        self.assertEqual(list(self.user.updated_fields), ["first_name"])
+
+
+class ChangeTrackingTestCase(TestCase):
+
+    def setUp(self):
+        self.permission = Permission.objects.create(name="a", codename="tests.tracking")
+
+    def save_changes(self, instance):
+        with self.captureOnCommitCallbacks(execute=True):
+            instance.save()
+        return list(
+            FieldChange.objects.for_instance(instance).values_list("field", "old", "new")
+        )
+
+    def test_deferred_field_read(self):
+        permission = Permission.objects.only("id").get(pk=self.permission.pk)
+        self.assertEqual(permission.name, "a")
+        self.assertEqual(permission.get_changed_fields(), [])
+        self.assertEqual(self.save_changes(permission), [])
+
+    def test_deferred_field_set(self):
+        # old value is read from the database, not recorded as None
+        permission = Permission.objects.only("id").get(pk=self.permission.pk)
+        permission.name = "b"
+        self.assertEqual(permission.get_changed_fields(), [("name", "a", "b")])
+        self.assertEqual(self.save_changes(permission), [("name", "a", "b")])
+
+    def test_refresh_from_db(self):
+        permission = Permission.objects.get(pk=self.permission.pk)
+        Permission.objects.filter(pk=permission.pk).update(name="b")
+        permission.refresh_from_db()
+        self.assertEqual(permission.get_changed_fields(), [])
+        self.assertEqual(self.save_changes(permission), [])
+
+        Permission.objects.filter(pk=permission.pk).update(name="c", description="c")
+        permission.description = "d"
+        permission.refresh_from_db(fields=["name"])
+        self.assertEqual(permission.get_changed_fields(), [("description", None, "d")])
+
+    def test_skip_unchanged_saves(self):
+        permission = Permission.objects.only("id").get(pk=self.permission.pk)
+        # loads the deferred field
+        self.assertEqual(permission.name, "a")
+        permission.SKIP_UNCHANGED_SAVES = True
+        updated = permission.updated
+        permission.save()
+        permission.refresh_from_db()
+        self.assertEqual(permission.updated, updated)
+
+
+class SkipUnchangedSavesTestCase(TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        # model with a password field, registered in its own apps registry
+        cls.test_apps = Apps()
+
+        class Account(NetsCoreBaseModel):
+            password = models.CharField(max_length=128)
+
+            class Meta:
+                apps = cls.test_apps
+                app_label = "tests"
+                db_table = "nets_core_test_account"
+
+        cls.account_model = Account
+        with connection.schema_editor() as editor:
+            editor.create_model(Account)
+        super().setUpClass()
+
+    @classmethod
+    def tearDownClass(cls):
+        super().tearDownClass()
+        with connection.schema_editor() as editor:
+            editor.delete_model(cls.account_model)
+
+    @mock.patch("nets_core.models.SKIP_UNCHANGED_SAVES", True)
+    def test_changed_date_field(self):
+        user = get_user_model().objects.create_user("device", "device@example.com")
+        device = UserDevice.objects.get(pk=UserDevice.objects.create(user=user, name="phone").pk)
+        last_login = timezone.now()
+        device.last_login = last_login
+        device.save()
+        device.refresh_from_db()
+        self.assertEqual(device.last_login, last_login)
+
+    @mock.patch("nets_core.models.SKIP_UNCHANGED_SAVES", True)
+    def test_changed_password_field(self):
+        account = self.account_model.objects.create(password="a")
+        account = self.account_model.objects.get(pk=account.pk)
+        account.password = "b"
+        with self.captureOnCommitCallbacks(execute=True):
+            account.save()
+        self.assertEqual(self.account_model.objects.get(pk=account.pk).password, "b")
+        # saved but not written to FieldChange
+        self.assertFalse(FieldChange.objects.for_instance(account).exists())
+
+        updated = account.updated
+        account.save()
+        self.assertEqual(self.account_model.objects.get(pk=account.pk).updated, updated)
+
+
+class FieldChangeHistoryTestCase(TestCase):
+
+    def setUp(self):
+        self.permission = Permission.objects.create(name="a", codename="tests.history")
+        self.permission = Permission.objects.get(pk=self.permission.pk)
+
+    def save(self, **kwargs):
+        with self.captureOnCommitCallbacks(execute=True):
+            self.permission.save(**kwargs)
+
+    def changes(self):
+        return list(
+            FieldChange.objects.for_instance(self.permission)
+            .order_by("id")
+            .values_list("field", "old", "new")
+        )
+
+    def test_changed_fields(self):
+        self.permission.name = "b"
+        self.permission.description = "d"
+        self.assertEqual(
+            self.permission.get_changed_fields(), [("name", "a", "b"), ("description", None, "d")]
+        )
+        self.save(update_fields=["name"])
+        self.assertEqual(self.changes(), [("name", "a", "b")])
+        # description was not saved, it is still changed
+        self.assertEqual(self.permission.get_changed_fields(), [("description", None, "d")])
+
+        self.save()
+        self.assertEqual(self.changes(), [("name", "a", "b"), ("description", None, "d")])
+        self.assertEqual(self.permission.get_changed_fields(), [])
+        # updated_fields is not written nor tracked
+        self.permission.refresh_from_db()
+        self.assertEqual(self.permission.updated_fields, {})
+
+    def test_opt_out(self):
+        self.permission.TRACK_FIELD_CHANGES = False
+        self.permission.name = "b"
+        self.save()
+        self.assertEqual(self.changes(), [])
+
+    def test_field_history(self):
+        Permission.objects.filter(pk=self.permission.pk).update(
+            updated_fields={"name": [{"old": "z", "new": "a", "time": "2020-01-01 00:00:00+00:00"}]}
+        )
+        self.permission.refresh_from_db()
+        self.permission.name = "b"
+        self.save()
+        history = self.permission.field_history
+        self.assertEqual([(c["old"], c["new"]) for c in history["name"]], [("z", "a"), ("a", "b")])
+        self.assertEqual(list(history), ["name"])
+
+    def test_migrate_updated_fields(self):
+        Permission.objects.filter(pk=self.permission.pk).update(
+            updated_fields={"name": [{"old": "z", "new": "a", "time": "2020-01-01 00:00:00+00:00"}]}
+        )
+        call_command("nets-field-changes", "--migrate", stdout=StringIO())
+        self.assertEqual(self.changes(), [("name", "z", "a")])
+        self.permission.refresh_from_db()
+        self.assertEqual(self.permission.updated_fields, {})
+        self.assertEqual(len(self.permission.field_history["name"]), 1)
+
+    def test_retention(self):
+        self.permission.name = "b"
+        self.save()
+        FieldChange.objects.for_instance(self.permission).update(
+            created=timezone.now() - timedelta(days=10)
+        )
+        self.permission.name = "c"
+        self.save()
+
+        self.assertEqual(FieldChange.objects.delete_expired(), 0)
+        self.assertEqual(FieldChange.objects.delete_expired(days=30), 0)
+        call_command("nets-field-changes", "--cleanup", "--days", "5", stdout=StringIO())
+        self.assertEqual(self.changes(), [("name", "b", "c")])
+
+
+class FieldChangeWriterTestCase(TestCase):
+
+    def setUp(self):
+        self.permission = Permission.objects.create(name="a", codename="tests.writer")
+
+    def count(self):
+        return FieldChange.objects.for_instance(self.permission).count()
+
+    def test_written_on_commit(self):
+        with self.captureOnCommitCallbacks() as callbacks:
+            self.permission.name = "b"
+            self.permission.save()
+            self.assertEqual(self.count(), 0)
+        for callback in callbacks:
+            callback()
+        self.assertEqual(self.count(), 1)
+
+    @mock.patch("nets_core.audit.FIELD_CHANGES_WRITER", "sync")
+    def test_sync_writer(self):
+        self.permission.name = "b"
+        self.permission.save()
+        self.assertEqual(self.count(), 1)
+
+    @mock.patch("nets_core.audit.FIELD_CHANGES_WRITER", "celery")
+    def test_celery_writer_without_broker(self):
+        with mock.patch(
+            "nets_core.tasks.write_field_changes.delay", side_effect=OSError("no broker")
+        ) as delay:
+            with self.captureOnCommitCallbacks(execute=True):
+                self.permission.name = "b"
+                self.permission.save()
+        delay.assert_called_once()
+        self.assertEqual(self.count(), 1)
+
+    def test_rolled_back_savepoint(self):
+        permission = self.permission
+        with self.captureOnCommitCallbacks(execute=True):
+            with transaction.atomic():
+                permission.name = "b"
+                permission.save()
+                try:
+                    with transaction.atomic():
+                        permission.name = "rolledback"
+                        permission.save()
+                        raise ValueError
+                except ValueError:
+                    pass
+        self.assertEqual(
+            list(FieldChange.objects.for_instance(permission).values_list("field", "old", "new")),
+            [("name", "a", "b")],
+        )
+
+    def test_buffer_of_rolled_back_savepoint(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            try:
+                with transaction.atomic():
+                    self.permission.name = "rolledback"
+                    self.permission.save()
+                    raise ValueError
+            except ValueError:
+                pass
+            # the buffer went with the savepoint, a new one is started
+            self.permission.name = "b"
+            self.permission.save()
+        self.assertEqual(self.count(), 1)
+
+    def test_one_write_per_transaction(self):
+        permissions = [
+            Permission.objects.create(name="a", codename=f"tests.writer_{i}") for i in range(5)
+        ]
+        with self.captureOnCommitCallbacks() as callbacks:
+            with transaction.atomic():
+                for permission in permissions:
+                    permission.name = "b"
+                    permission.save()
+        self.assertEqual(len(callbacks), 1)
+        # one bulk_create
+        with self.assertNumQueries(1):
+            callbacks[0]()
+        self.assertEqual(
+            FieldChange.objects.filter(object_id__in=[str(p.pk) for p in permissions]).count(), 5
+        )
+
+    def test_released_savepoint(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            with transaction.atomic():
+                self.permission.name = "b"
+                self.permission.save()
+                with transaction.atomic():
+                    self.permission.name = "c"
+                    self.permission.save()
+        self.assertEqual(self.count(), 2)
+
+    @mock.patch("nets_core.audit.FIELD_CHANGES_BUFFER_SIZE", 2)
+    def test_buffer_size(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            for name in ("b", "c", "d"):
+                self.permission.name = name
+                self.permission.save()
+            # written in the transaction once the buffer is full
+            self.assertEqual(self.count(), 2)
+        self.assertEqual(self.count(), 3)
+
+
+@request_handler(public=True, rate_limit=RateLimit(2, 60, "ip"))
+def rate_limited_view(request):
+    return success_response("ok")
+
+
+class RateLimitTestCase(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.factory = RequestFactory()
+
+    def get(self, **extra):
+        request = self.factory.get("/", **extra)
+        request.user = AnonymousUser()
+        return rate_limited_view(request)
+
+    def test_hit(self):
+        limit = RateLimit(2, 60, "email")
+        value = limit.get_value({"email": " User@Example.com"})
+        self.assertEqual(value, "user@example.com")
+        self.assertEqual([limit.hit(value) for _ in range(3)], [True, True, False])
+        # counted per scope and value, requests without the value are not limited
+        self.assertTrue(limit.hit(value, "other"))
+        self.assertTrue(limit.hit("other@example.com"))
+        self.assertIsNone(limit.get_value({}))
+        self.assertTrue(all(limit.hit(None) for _ in range(3)))
+
+    def test_nested_key(self):
+        limit = RateLimit(1, 60, "device.uuid")
+        self.assertEqual(limit.get_value({"device": {"uuid": "A"}}), "a")
+        self.assertIsNone(limit.get_value({"device": "A"}))
+
+    def test_forwarded_for_is_not_trusted(self):
+        statuses = [
+            self.get(HTTP_X_FORWARDED_FOR=f"10.0.0.{i}").status_code for i in range(3)
+        ]
+        self.assertEqual(statuses, [200, 200, 429])
+
+    @override_settings(NETS_CORE_TRUSTED_PROXIES=["127.0.0.1"])
+    def test_trusted_proxy(self):
+        request = self.factory.get("/", HTTP_X_FORWARDED_FOR="1.1.1.1, 2.2.2.2, 127.0.0.1")
+        self.assertEqual(get_remote_ip(request), "2.2.2.2")
+        statuses = [
+            self.get(HTTP_X_FORWARDED_FOR=f"10.0.0.{i}").status_code for i in range(3)
+        ]
+        self.assertEqual(statuses, [200, 200, 200])
+
+    def test_auth_ip_limit_is_opt_in(self):
+        limits = get_auth_rate_limits("device_uuid")
+        self.assertEqual([limit.by for limit in limits], ["username", "device_uuid"])
+        with mock.patch("nets_core.views.AUTH_RATE_LIMIT_IP", 30):
+            self.assertEqual(get_auth_rate_limits("device_uuid")[0].by, "ip")
+
+    def test_auth_behind_proxy(self):
+        # every client of a proxy has its REMOTE_ADDR, they are only limited per username
+        statuses = set()
+        for i in range(40):
+            request = self.factory.post(
+                "/",
+                {"username": f"user{i}", "code": 1, "client_id": "id", "client_secret": "secret"},
+                content_type="application/json",
+                REMOTE_ADDR="10.0.0.1",
+            )
+            request.user = AnonymousUser()
+            statuses.add(auth(request).status_code)
+        self.assertNotIn(429, statuses)
+
+
+class VerificationCodeHashTestCase(TestCase):
+
+    def test_hmac(self):
+        encoded = hash_verification_code("123456", "1")
+        self.assertTrue(encoded.startswith("nc_hmac$"))
+        self.assertNotIn("123456", encoded)
+        self.assertTrue(check_verification_code("123456", encoded, "1"))
+        self.assertFalse(check_verification_code("654321", encoded, "1"))
+        # bound to the user
+        self.assertFalse(check_verification_code("123456", encoded, "2"))
+        self.assertFalse(check_verification_code("", encoded, "1"))
+
+    def test_password_hash_of_older_codes(self):
+        encoded = make_password("123456")
+        self.assertTrue(check_verification_code("123456", encoded, "1"))
+        self.assertFalse(check_verification_code("654321", encoded, "1"))
+
+    def test_saved_code(self):
+        cache.clear()
+        user = get_user_model().objects.create_user("hashed", "hashed@example.com")
+        vcode = VerificationCode.objects.create(user=user)
+        token = cache.get(VerificationCode.get_cache_key(user.pk))
+        self.assertEqual(vcode.token, hash_verification_code(token, str(user.pk)))
+        self.assertTrue(vcode.validate(token))
+        self.assertFalse(vcode.validate("wrong"))
+
+
+class CachedVerificationCodeTestCase(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.user = get_user_model().objects.create_user("cached", "cached@example.com")
+        Application.objects.create(
+            client_id="tests",
+            client_secret="secret",
+            hash_client_secret=False,
+            client_type=Application.CLIENT_CONFIDENTIAL,
+            authorization_grant_type=Application.GRANT_PASSWORD,
+        )
+        self.vcode = VerificationCode.objects.create(user=self.user, ip="127.0.0.1")
+        self.token = cache.get(VerificationCode.get_cache_key(self.user.pk))
+
+    def test_validated_without_queries(self):
+        with self.assertNumQueries(0):
+            self.assertEqual(
+                check_cached_verification_code(self.user, self.token), self.vcode.pk
+            )
+            self.assertFalse(check_cached_verification_code(self.user, "wrong"))
+
+    def test_device(self):
+        device = UserDevice.objects.create(user=self.user, name="phone")
+        cache.delete(VerificationCode.get_cache_key(self.user.pk))
+        vcode = VerificationCode.objects.create(user=self.user, device=device)
+        token = cache.get(VerificationCode.get_cache_key(self.user.pk))
+        self.assertFalse(check_cached_verification_code(self.user, token))
+        self.assertFalse(check_cached_verification_code(self.user, token, "other"))
+        self.assertEqual(check_cached_verification_code(self.user, token, device.uuid), vcode.pk)
+
+    def test_used_once(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            self.assertIn("access_token", authenticate(self.user, self.token, "tests", "secret"))
+        self.assertFalse(check_cached_verification_code(self.user, self.token))
+        with self.assertRaisesMessage(Exception, "Invalid code"):
+            authenticate(self.user, self.token, "tests", "secret")
+        self.vcode.refresh_from_db()
+        self.assertTrue(self.vcode.verified)
+
+    def test_not_cached(self):
+        # cache cleared, the last code is read from the table
+        cache.delete(VerificationCode.get_validation_key(self.user.pk))
+        self.assertIsNone(check_cached_verification_code(self.user, self.token))
+        self.assertIn("access_token", authenticate(self.user, self.token, "tests", "secret"))
+
+
+class VerificationCodeAttemptsTestCase(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.user = get_user_model().objects.create_user("coder", "coder@example.com")
+        Application.objects.create(
+            client_id="tests",
+            client_secret="secret",
+            hash_client_secret=False,
+            client_type=Application.CLIENT_CONFIDENTIAL,
+            authorization_grant_type=Application.GRANT_PASSWORD,
+        )
+
+    def authenticate(self, code):
+        return authenticate(self.user, code, "tests", "secret")
+
+    def test_reused_token_keeps_attempts(self):
+        VerificationCode.objects.create(user=self.user)
+        for _ in range(VERIFICATION_CODE_MAX_ATTEMPTS):
+            with self.assertRaisesMessage(Exception, "Invalid code"):
+                self.authenticate("wrong")
+
+        # requesting the code again sends the cached token
+        VerificationCode.objects.create(user=self.user)
+        token = cache.get(VerificationCode.get_cache_key(self.user.pk))
+        with self.assertRaisesMessage(Exception, "Too many attempts"):
+            self.authenticate(token)
+
+        # a new token resets the attempts
+        cache.delete(VerificationCode.get_cache_key(self.user.pk))
+        VerificationCode.objects.create(user=self.user)
+        token = cache.get(VerificationCode.get_cache_key(self.user.pk))
+        self.assertIn("access_token", self.authenticate(token))
+
+
+class ParseJsonBodyTestCase(TestCase):
+
+    def test_declared_keys(self):
+        body = b'{"a": 1, "skipped": {"b": [1, {"c": 2}]}, "d": "x"}'
+        self.assertEqual(parse_json_body(body, keys={"a", "d"}), {"a": 1, "d": "x"})
+        with self.assertRaisesMessage(RequestBodyError, "nesting too deep"):
+            parse_json_body(body, keys={"a"}, max_depth=2)
+
+    def test_declared_value_decoded_once(self):
+        body = b'{"a": {"b": [1, {"c": 2}]}, "skipped": {"d": 1}}'
+        with mock.patch.object(
+            _json_decoder, "raw_decode", wraps=_json_decoder.raw_decode
+        ) as raw_decode, mock.patch.object(
+            _json_depth_decoder, "raw_decode", wraps=_json_depth_decoder.raw_decode
+        ) as skip_decode:
+            data = parse_json_body(body, keys={"a"}, max_depth=4)
+        self.assertEqual(data, {"a": {"b": [1, {"c": 2}]}})
+        self.assertEqual(raw_decode.call_count, 1)
+        # only the unknown key is scanned to skip it
+        self.assertEqual(skip_decode.call_count, 1)
+        with self.assertRaisesMessage(RequestBodyError, "nesting too deep"):
+            parse_json_body(body, keys={"a"}, max_depth=3)
+        with self.assertRaisesMessage(RequestBodyError, "nesting too deep"):
+            parse_json_body(body, max_depth=3)
+        with self.assertRaisesMessage(RequestBodyError, "Invalid JSON body"):
+            parse_json_body(b"[1] x", max_depth=3)
+
+    def test_deep_body_without_max_depth(self):
+        body = b"[" * 100000 + b"]" * 100000
+        with self.assertRaisesMessage(RequestBodyError, "nesting too deep"):
+            parse_json_body(body)
+        with self.assertRaisesMessage(RequestBodyError, "nesting too deep"):
+            parse_json_body(b'{"a": ' + body + b"}", keys={"a"})
+
+
+class JsonEncoderTestCase(TestCase):
+
+    data = {"price": Decimal("1.10"), "url": "/a/b", "big": 2**70, "name": "nets"}
+
+    @unittest.skipUnless(find_spec("orjson"), "orjson not installed")
+    def test_orjson_as_django(self):
+        dumps = _get_dumps("orjson")
+        self.assertEqual(json.loads(dumps(self.data)), json.loads(_json_dumps(self.data)))
+        self.assertEqual(json.loads(dumps(self.data))["price"], "1.10")
+
+    @unittest.skipUnless(find_spec("ujson"), "ujson not installed")
+    def test_ujson_slashes(self):
+        self.assertEqual(_get_dumps("ujson")({"url": "/a/b"}), b'{"url":"/a/b"}')
+
+    def test_auto_is_not_ujson(self):
+        self.assertNotEqual(_get_dumps("auto").__name__, "_ujson_dumps")
+
+
+class RequestParamsSchemaTestCase(TestCase):
+
+    def setUp(self):
+        self.schema = RequestParamsSchema([
+            RequestParam("age", int, validate=lambda value, project: value < project),
+            RequestParam("name", str, optional=True, default="anonymous"),
+        ])
+
+    def test_param_is_immutable(self):
+        param = self.schema.params["age"]
+        with self.assertRaises(AttributeError):
+            param.value = 10
+        with self.assertRaises(TypeError):
+            self.schema.params["other"] = param
+
+    def test_parse(self):
+        data = {"age": "10", "other": "x"}
+        self.assertEqual(self.schema.parse(data, project=20), {"age": 10, "other": "x"})
+        parsed = self.schema.parse(data, project=20, keys=())
+        self.assertEqual(parsed, {"age": 10})
+        self.assertEqual(self.schema.missing(parsed), [])
+        self.assertEqual(parsed["name"], "anonymous")
+        self.assertEqual(self.schema.missing({}), ["age"])
+        with self.assertRaises(ValueError):
+            self.schema.parse(data, project=5)
+
+    def test_parse_is_reentrant(self):
+        # the schema is shared by every request of a view, project is per call
+        def parse(i):
+            try:
+                return self.schema.parse({"age": str(i)}, project=50)["age"]
+            except ValueError:
+                return None
+
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            results = list(executor.map(parse, range(100)))
+        self.assertEqual(results, [i if i < 50 else None for i in range(100)])
+
+
+class DeprecatedParamsTestCase(TestCase):
+
+    def test_get_value_from_data_key(self):
+        params = {"age": RequestParam("age", int)}
+        data = {"age": "10", "other": "x"}
+        with self.assertWarns(DeprecationWarning):
+            self.assertEqual(get_value_from_data_key(data, "age", params, None, {}), 10)
+        with self.assertWarns(DeprecationWarning):
+            self.assertEqual(get_value_from_data_key(data, "other", params, None, {}), "x")
+
+    def test_parse_param(self):
+        with self.assertWarns(DeprecationWarning):
+            self.assertEqual(parse_param({"age": "10"}, ["age", int]), 10)
+        with self.assertWarns(DeprecationWarning):
+            self.assertEqual(parse_param({"age": "10"}, "age"), "10")
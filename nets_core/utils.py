@@ -3,15 +3,37 @@ import time
 import uuid
 import re
 from datetime import date, datetime
+from functools import lru_cache
 
 from django.contrib.contenttypes.models import ContentType
 from django.apps import apps
+from django.core.cache import cache
+from django.db.models.functions import Lower
 from django.utils import timezone
 
 import pytz
 from django.conf import settings
 from django.utils.dateparse import parse_datetime
 
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Compiled permission sets are stored in the cache under a key that includes the
+# current permissions version. Role, RolePermission and UserRole changes bump the
+# version (see nets_core.listeners) so stale sets are never read again.
+PERMISSIONS_VERSION_CACHE_KEY = "NC_PERMS_VERSION"
+PERMISSIONS_CACHE_KEY_PREFIX = "NC_PERMS"
+PERMISSIONS_CACHE_TIMEOUT = getattr(
+    settings, "NETS_CORE_PERMISSIONS_CACHE_TIMEOUT", 60 * 60
+)
+PERMISSIONS_LRU_SIZE = getattr(settings, "NETS_CORE_PERMISSIONS_LRU_SIZE", 2048)
+
+# Codenames used by request_handler(can_do=...) are registered at decoration time
+# and created by sync_permissions_registry (post_migrate or nets-sync-permissions),
+# check_perm never writes to the database.
+PERMISSIONS_REGISTRY = set()
+
 
 def local_datetime(s: str, tz: str = settings.TIME_ZONE) -> datetime:
     naive = parse_datetime(s)
@@ -44,6 +66,25 @@ def get_client_ip(request):
     return None
 
 
+def get_remote_ip(request):
+    """
+    IP of the client that can not be set by it, REMOTE_ADDR. Behind proxies
+    listed in settings.NETS_CORE_TRUSTED_PROXIES the last X-Forwarded-For
+    address not added by them. Used by rate limits, see get_client_ip.
+    """
+    ip = request.META.get("REMOTE_ADDR")
+    trusted_proxies = getattr(settings, "NETS_CORE_TRUSTED_PROXIES", ())
+    if not ip or ip not in trusted_proxies:
+        return ip
+    forwarded = request.META.get("HTTP_X_FORWARDED_FOR", "")
+    # <client>, <proxy1>, <proxy2>, addresses on the left are set by the client
+    for address in reversed(forwarded.split(",")):
+        address = address.strip()
+        if address and address not in trusted_proxies:
+            return address
+    return ip
+
+
 def generate_int_uuid(size=None):
     u = uuid.uuid1()
     n_random = "{}".format(u.time_low)
@@ -72,74 +113,363 @@ def get_upload_path(instance, filename):
     return path
 
 
-def check_perm(user, action, project=None):
-    from nets_core.models import Permission, RolePermission
+def get_permissions_version() -> int:
+    """
+    Return the current permissions version stored in cache.
+    The initial value is time based, so if the key is evicted a new version
+    never collides with sets compiled for an older one.
+    """
+    version = cache.get(PERMISSIONS_VERSION_CACHE_KEY)
+    if version is None:
+        cache.add(PERMISSIONS_VERSION_CACHE_KEY, int(time.time() * 1000), None)
+        version = cache.get(PERMISSIONS_VERSION_CACHE_KEY, int(time.time() * 1000))
+    return version
 
-    project_content_type = None
-    project_id = None
-    if user.is_superuser:
-        return True
 
+def bump_permissions_version() -> int:
+    """
+    Invalidate every compiled permission set, called when roles,
+    role permissions or user roles change.
+    If the cache can not be reached (e.g. migrate without the cache server)
+    only the sets compiled in this process are dropped and None is returned.
+    """
+    try:
+        try:
+            return cache.incr(PERMISSIONS_VERSION_CACHE_KEY)
+        except ValueError:
+            version = int(time.time() * 1000)
+            cache.set(PERMISSIONS_VERSION_CACHE_KEY, version, None)
+            return version
+    except Exception as e:
+        logger.warning(f"Permissions version not bumped, cache not available: {e}")
+        _compiled_user_permissions.cache_clear()
+        return None
+
+
+def resolve_project_permissions(
+    user_id, project_content_type_id, project_id, codenames=None
+) -> frozenset:
+    """
+    Resolve permission codenames granted to user in project with a single
+    JOIN over nets_core_user_role, nets_core_role and nets_core_role_permission.
+    Only enabled roles are used. If codenames is provided only those are
+    evaluated, returning the subset granted.
+    """
+    from nets_core.models import RolePermission
+
+    query = RolePermission.objects.filter(
+        role__enabled=True,
+        role__userrole__user_id=user_id,
+        role__userrole__project_content_type_id=project_content_type_id,
+        role__userrole__project_id=project_id,
+    )
+    if codenames is not None:
+        # codenames are compared lowercase, rows may be stored in mixed case
+        query = query.annotate(lower_codename=Lower("permission__codename")).filter(
+            lower_codename__in=[c.lower() for c in codenames]
+        )
+
+    return frozenset(
+        codename.lower()
+        for codename in query.values_list("permission__codename", flat=True).distinct()
+    )
+
+
+def _load_user_permissions(user_id, project_content_type_id=None, project_id=None):
+    from nets_core.models import RolePermission
+
+    if project_content_type_id:
+        return resolve_project_permissions(
+            user_id, project_content_type_id, project_id
+        )
+
+    query = RolePermission.objects.filter(
+        role__userrole__user_id=user_id, role__enabled=True
+    )
+    return frozenset(
+        codename.lower()
+        for codename in query.values_list("permission__codename", flat=True).distinct()
+    )
+
+
+@lru_cache(maxsize=PERMISSIONS_LRU_SIZE)
+def _compiled_user_permissions(user_id, project_content_type_id, project_id, version):
+    # version is part of the lru key, entries of older versions are never hit again
+    cache_key = f"{PERMISSIONS_CACHE_KEY_PREFIX}_{version}_{user_id}_{project_content_type_id}_{project_id}"
+    perms = cache.get(cache_key)
+    if perms is None:
+        perms = _load_user_permissions(user_id, project_content_type_id, project_id)
+        cache.set(cache_key, perms, PERMISSIONS_CACHE_TIMEOUT)
+    return frozenset(perms)
+
+
+def get_user_permissions(user, project=None) -> frozenset:
+    """
+    Return the frozenset of permission codenames granted to user by its roles.
+    If project is provided only roles assigned in that project are used.
+    Sets are cached per process and in django cache until permissions version changes.
+    """
+    project_content_type_id = None
+    project_id = None
     if project:
-        project_content_type = ContentType.objects.get_for_model(project)
+        project_content_type_id = ContentType.objects.get_for_model(project).id
         project_id = project.id
 
-    if not Permission.objects.filter(codename=action).exists():
-        # create permission and return False because this permission does not exist
-        permission = Permission.objects.create(
-            codename=action, name=action.replace("_", " ").capitalize()
+    return _compiled_user_permissions(
+        user.pk, project_content_type_id, project_id, get_permissions_version()
+    )
+
+
+def register_permissions(*codenames) -> None:
+    """
+    Register permission codenames to be created by sync_permissions_registry.
+    role:name actions are role checks and are not registered.
+    """
+    for codename in codenames:
+        if codename and not codename.startswith("role:"):
+            PERMISSIONS_REGISTRY.add(codename)
+
+
+def sync_permissions_registry(using: str = "default") -> list:
+    """
+    Create registered permissions missing in database.
+    ROOT_URLCONF is loaded first so every view decorated with
+    request_handler has registered its can_do codenames.
+
+    Returns:
+    list: codenames created
+    """
+    from django.urls import get_resolver
+    from nets_core.models import Permission
+
+    try:
+        get_resolver().url_patterns
+    except Exception as e:
+        logger.warning(f"sync_permissions_registry could not load urls: {e}")
+
+    registry = {codename.lower() for codename in PERMISSIONS_REGISTRY}
+    # rows saved in mixed case are the same permission
+    existing = set(
+        Permission.objects.using(using)
+        .annotate(lower_codename=Lower("codename"))
+        .filter(lower_codename__in=registry)
+        .values_list("lower_codename", flat=True)
+    )
+    missing = sorted(registry - existing)
+    Permission.objects.using(using).bulk_create(
+        [
+            Permission(codename=codename, name=codename.replace("_", " ").capitalize())
+            for codename in missing
+        ],
+        ignore_conflicts=True,
+    )
+    if missing:
+        bump_permissions_version()
+    return missing
+
+
+@lru_cache(maxsize=1)
+def _known_permissions(version) -> frozenset:
+    from nets_core.models import Permission
+
+    return frozenset(
+        codename.lower()
+        for codename in Permission.objects.values_list("codename", flat=True)
+    )
+
+
+def get_known_permissions() -> frozenset:
+    """
+    Return codenames of every permission in database, kept in memory
+    until permissions version changes.
+    """
+    return _known_permissions(get_permissions_version())
+
+
+def _get_missing_permissions(actions) -> set:
+    known = get_known_permissions()
+    missing = {
+        action
+        for action in actions
+        if not action.startswith("role:") and action.lower() not in known
+    }
+    for action in missing:
+        logger.warning(
+            f"Permission {action} does not exist, register it with "
+            "register_permissions and run nets-sync-permissions"
         )
-        return False
+    return missing
 
-    if project:
 
-        try:
-            project_member_model = apps.get_model(
-                settings.NETS_CORE_PROJECT_MEMBER_MODEL
-            )
-            try:
-                member = project_member_model.objects.get(user=user, project=project)
-                if hasattr(member, "enabled") and not member.enabled:
-                    return False
-                if hasattr(member, "is_superuser") and member.is_superuser:
-                    return True
-                
-                if hasattr(member, 'role'):
-                    if action.startswith('role:'):
-                        return member.role.name.lower() == action.split(':')[1].lower()
-                
-            except project_member_model.DoesNotExist:
-                return False
-        except:
-            raise Exception(
-                "check_perm failed NETS_CORE_PROJECT_MEMBER_MODEL not set in settings"
-            )
-
-        user_roles = member.user.roles.filter(
-            project_content_type=project_content_type, project_id=project_id
+def _project_key(project) -> tuple:
+    # pks of projects of different models may be equal
+    return (ContentType.objects.get_for_model(project).id, project.pk)
+
+
+def _get_project_memberships(user, projects) -> dict:
+    # memberships keyed by _project_key, only projects of the model
+    # referenced by the member model project field can have one
+    try:
+        project_member_model = apps.get_model(settings.NETS_CORE_PROJECT_MEMBER_MODEL)
+    except:
+        raise Exception(
+            "check_perm failed NETS_CORE_PROJECT_MEMBER_MODEL not set in settings"
         )
-        
-        
-        if user_roles.exists():            
-            roles = [u.role for u in user_roles]
-            return RolePermission.objects.filter(
-                role__in=roles,
-                permission__codename=action.lower(),
-            ).exists()
-        else:
+
+    project_model = project_member_model._meta.get_field("project").related_model
+    projects = [project for project in projects if isinstance(project, project_model)]
+    if not projects:
+        return {}
+    content_type_id = ContentType.objects.get_for_model(project_model).id
+    return {
+        (content_type_id, member.project_id): member
+        for member in project_member_model.objects.filter(
+            user=user, project__in=projects
+        )
+    }
+
+
+def _get_bulk_user_permissions(user, projects) -> dict:
+    # compiled sets for many projects: one cache.get_many and at most
+    # one query per project content type for the sets not cached yet
+    from nets_core.models import RolePermission
+
+    version = get_permissions_version()
+    # result is keyed by _project_key, None for global permissions
+    keys = {None if project is None else _project_key(project) for project in projects}
+
+    cache_keys = {}
+    for k in keys:
+        ct_id, project_id = k or (None, None)
+        cache_keys[f"{PERMISSIONS_CACHE_KEY_PREFIX}_{version}_{user.pk}_{ct_id}_{project_id}"] = k
+    found = cache.get_many(cache_keys.keys())
+    result = {cache_keys[key]: frozenset(perms) for key, perms in found.items()}
+
+    pending = {}
+    for cache_key, k in cache_keys.items():
+        if k in result:
+            continue
+        if k is None:
+            result[None] = _load_user_permissions(user.pk)
+            continue
+        ct_id, project_id = k
+        pending.setdefault(ct_id, []).append(project_id)
+
+    for ct_id, project_ids in pending.items():
+        granted = {project_id: set() for project_id in project_ids}
+        rows = RolePermission.objects.filter(
+            role__enabled=True,
+            role__userrole__user_id=user.pk,
+            role__userrole__project_content_type_id=ct_id,
+            role__userrole__project_id__in=project_ids,
+        ).values_list("role__userrole__project_id", "permission__codename")
+        for project_id, codename in rows:
+            granted[project_id].add(codename.lower())
+        for project_id, perms in granted.items():
+            result[(ct_id, project_id)] = frozenset(perms)
+
+    cache.set_many(
+        {
+            cache_key: result[k]
+            for cache_key, k in cache_keys.items()
+            if cache_key not in found
+        },
+        PERMISSIONS_CACHE_TIMEOUT,
+    )
+    return result
+
+
+def _evaluate_action(action, member, perms) -> bool:
+    if member is not None:
+        if hasattr(member, "enabled") and not member.enabled:
             return False
+        if hasattr(member, "is_superuser") and member.is_superuser:
+            return True
+
+        if hasattr(member, "role"):
+            if action.startswith("role:"):
+                return member.role.name.lower() == action.split(":")[1].lower()
+
+    return action.lower() in perms
+
+
+def check_perms_bulk(user, actions: list, projects: list = None) -> list:
+    """
+    Evaluate many actions over many projects in a constant number of queries.
+
+    Parameters:
+    user (instance): Instance of settings.AUTH_USER_MODEL
+    actions (list): Permission codenames or role:name actions
+    projects (list): NETS_CORE_PROJECT_MODEL instances, None evaluates global permissions
+
+    Returns:
+    list: matrix of booleans, one row per project and one column per action
+    example: check_perms_bulk(user, ["app.can_edit", "app.can_delete"], projects)[i][j]
+    is True if user can do actions[j] in projects[i]
+    """
+    if projects is None:
+        projects = [None]
+
+    if user.is_superuser:
+        return [[True for _action in actions] for _project in projects]
+
+    missing = _get_missing_permissions(actions)
+
+    project_instances = [p for p in projects if p is not None]
+    memberships = {}
+    if project_instances:
+        memberships = _get_project_memberships(user, project_instances)
 
-    else:
-        user_roles = user.roles.filter(role__enabled=True)
-        user_perms = []
-        for r in user_roles:
-            user_perms += r.role.permissions.all()
-        print(f"User: {user}", user_roles, user_perms)
-        for p in user_perms:
-            print(p.codename)
-            if p.codename == action:
-                return True
+    perms = _get_bulk_user_permissions(user, projects)
 
+    matrix = []
+    for project in projects:
+        row = []
+        member = None
+        key = None
+        if project is not None:
+            key = _project_key(project)
+            member = memberships.get(key)
+        for action in actions:
+            if action in missing or (project is not None and member is None):
+                row.append(False)
+                continue
+            row.append(_evaluate_action(action, member, perms[key]))
+        matrix.append(row)
+    return matrix
+
+
+def check_perms(user, actions: list, project=None, membership=None) -> bool:
+    """
+    Check if user can do all actions, globally or in project, at once.
+    membership is the NETS_CORE_PROJECT_MEMBER_MODEL instance of user in project
+    when already loaded (request.project_membership), avoiding a query.
+    """
+    if user.is_superuser:
+        return True
+
+    if isinstance(actions, str):
+        actions = [actions]
+
+    if _get_missing_permissions(actions):
         return False
 
+    member = None
+    if project:
+        member = membership
+        if member is None:
+            member = _get_project_memberships(user, [project]).get(_project_key(project))
+        if member is None:
+            return False
+
+    perms = get_user_permissions(user, project)
+    return all(_evaluate_action(action, member, perms) for action in actions)
+
 
+def check_perm(user, action, project=None, membership=None):
+    """
+    Check if user can do action, globally or in project.
+    membership is the NETS_CORE_PROJECT_MEMBER_MODEL instance of user in project
+    when already loaded (request.project_membership), avoiding a query.
+    """
+    return check_perms(user, [action], project, membership=membership)
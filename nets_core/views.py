@@ -6,10 +6,10 @@ from django.shortcuts import render
 import logging
 from django.utils.translation import gettext_lazy as _
 from nets_core.decorators import request_handler
-from nets_core.models import UserDevice, VerificationCode
+from nets_core.models import NetsCoreBaseModel, UserDevice, VerificationCode
 from nets_core.params import RequestParam
 from nets_core.responses import error_response, success_response
-from nets_core.security import authenticate
+from nets_core.security import RateLimit, authenticate
 from django.contrib.auth import login, logout
 from django.utils import timezone
 from django.conf import settings
@@ -44,33 +44,66 @@ except:
     pass
 
 
+# auth_login and auth requests every NETS_CORE_AUTH_RATE_LIMIT_WINDOW seconds
+# per username or device, and per ip if NETS_CORE_AUTH_RATE_LIMIT_IP is set.
+# Behind a proxy or load balancer every client has its ip, set
+# NETS_CORE_TRUSTED_PROXIES before enabling the ip limit
+AUTH_RATE_LIMIT_WINDOW = getattr(settings, "NETS_CORE_AUTH_RATE_LIMIT_WINDOW", 10 * 60)
+AUTH_RATE_LIMIT_IP = getattr(settings, "NETS_CORE_AUTH_RATE_LIMIT_IP", None)
+AUTH_RATE_LIMIT_USER = getattr(settings, "NETS_CORE_AUTH_RATE_LIMIT_USER", 5)
+
+
+def get_auth_rate_limits(device_key: str) -> list:
+    limits = [
+        RateLimit(AUTH_RATE_LIMIT_USER, AUTH_RATE_LIMIT_WINDOW, username_field),
+        RateLimit(AUTH_RATE_LIMIT_USER, AUTH_RATE_LIMIT_WINDOW, device_key),
+    ]
+    if AUTH_RATE_LIMIT_IP:
+        limits.insert(0, RateLimit(AUTH_RATE_LIMIT_IP, AUTH_RATE_LIMIT_WINDOW, "ip"))
+    return limits
+
+
+def is_prohibited_field(key: str) -> bool:
+    for field in prohibited_fields:
+        if field in key:
+            # exact match e.g. password
+            return True
+
+        if field.endswith("*") and key.startswith(field[:-1]):
+            # check if key starts with field
+            # e.g. doc_id, doc_id_type, doc_id_country
+            return True
+    return False
+
+
 def valid_gender(s):
     return s in ["male", "female", "other", "_"]
 
 
+def _user_to_json(user, **kwargs):
+    # json text is written as is for NetsCoreBaseModel users,
+    # other user models keep their own to_json
+    if isinstance(user, NetsCoreBaseModel):
+        kwargs["raw"] = True
+    return user.to_json(**kwargs)
+
+
 @request_handler(
     public=True,
     params=[
         RequestParam(username_field, str),
         RequestParam("device", dict, True, default=None),
     ],
+    rate_limit=get_auth_rate_limits("device.uuid"),
 )
 def auth_login(request):
     try:
         defaults = {}
         for key, val in request.params._asdict().items():
             if hasattr(User, key):
-                for field in prohibited_fields:
-                    if field in key:
-                        # exact match e.g. password
-                        logger.info(f"Prohibited field {key} found in auth request")
-                        continue
-                    if field.endswith("*"):
-                        # check if key starts with field
-                        # e.g. doc_id, doc_id_type, doc_id_country
-                        if key.startswith(field[:-1]):
-                            logger.info(f"Prohibited field {key} found in auth request")
-                            continue
+                if is_prohibited_field(key):
+                    logger.info(f"Prohibited field {key} found in auth request")
+                    continue
 
                 defaults[key] = val
 
@@ -181,6 +214,7 @@ def check_email(request):
         RequestParam("client_secret", str),
     ],
     public=True,
+    rate_limit=get_auth_rate_limits("device_uuid"),
 )
 def auth(request):
     user = request.obj
@@ -249,32 +283,34 @@ def auth_get_profile(request):
     if fields:
         fields = tuple(fields)
 
-    return success_response(request.user.to_json(fields=fields))
+    return success_response(_user_to_json(request.user, fields=fields))
 
 
 @request_handler()
 def update_user(request):
     user = request.user
-    updated_fields = {}
-
-    if hasattr(user, "updated_fields"):
-        updated_fields = user.updated_fields
+    # NetsCoreBaseModel users store changed fields in FieldChange when saved,
+    # other user models with updated_fields keep the history in it
+    updated_fields = None
+    if not isinstance(user, NetsCoreBaseModel) and hasattr(user, "updated_fields"):
+        updated_fields = user.updated_fields or {}
 
+    values = {}
     for key, val in request.params._asdict().items():
         if hasattr(user, key):
-            for field in prohibited_fields:
-                if field in key:
-                    # exact match e.g. password
-                    logger.info(f"Prohibited field {key} found in auth request")
-                    continue
+            values[key] = val
+
+    if request.FILES:
+        for field in request.FILES:
+            if hasattr(user, field):
+                values[field] = request.FILES[field]
 
-                if field.endswith("*"):
-                    # check if key starts with field
-                    # e.g. doc_id, doc_id_type, doc_id_country
-                    if key.startswith(field[:-1]):
-                        # logger.info(f"Prohibited field {key} found in auth request")
-                        continue
+    for key, val in values.items():
+        if is_prohibited_field(key):
+            logger.info(f"Prohibited field {key} found in auth request")
+            continue
 
+        if updated_fields is not None:
             if key not in updated_fields:
                 updated_fields[key] = []
             updated_fields[key].append(
@@ -284,45 +320,16 @@ def update_user(request):
                     "time": timezone.now().__str__(),
                 }
             )
-            setattr(user, key, val)
-
-    if request.FILES:
-        for field in request.FILES:
-            if not hasattr(user, field):
-                continue
-
-            for field in prohibited_fields:
-                if field in key:
-                    # exact match e.g. password
-                    logger.info(f"Prohibited field {key} found in auth request")
-                    continue
+        setattr(user, key, val)
 
-                if field.endswith("*"):
-                    # check if key starts with field
-                    # e.g. doc_id, doc_id_type, doc_id_country
-                    if key.startswith(field[:-1]):
-                        # logger.info(f"Prohibited field {key} found in auth request")
-                        continue
-
-                if field not in updated_fields:
-                    updated_fields[field] = []
-                updated_fields[field].append(
-                    {
-                        "old": str(getattr(user, field)),
-                        "new": str(request.FILES[field]),
-                        "time": timezone.now().__str__(),
-                    }
-                )
-
-                setattr(user, field, request.FILES[field])
-
-    user.updated_fields = updated_fields
+    if updated_fields is not None:
+        user.updated_fields = updated_fields
     try:
         user.save()
     except Exception as e:
         return error_response(e.__str__())
 
-    return success_response(user.to_json())
+    return success_response(_user_to_json(user))
 
 
 @request_handler(public=True)